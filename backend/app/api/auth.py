@@ -0,0 +1,17 @@
+"""
+接口鉴权
+"""
+import hmac
+from typing import Optional
+
+from fastapi import Header, HTTPException
+
+from app.config.settings import settings
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """管理接口鉴权：未配置 ADMIN_TOKEN 时管理接口不可用"""
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="无权访问")
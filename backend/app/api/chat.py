@@ -1,36 +1,55 @@
 """
 聊天API接口
 """
-from fastapi import APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List, Dict
+import asyncio
 import logging
 import json
 import base64
 
 from app.services.dialogue_service import dialogue_manager
 from app.services.knowledge_base_service import knowledge_service
+from app.services.history_service import conversation_store
+from app.services.lifecycle_service import service_lifecycle
+from app.services.batch_service import batch_processor, parse_jsonl_questions, BatchInputError
+from app.config.settings import settings
+from app.config.logging_config import Truncated
+from app.api.auth import require_admin
+from app.api.serialization import dumps, sse_frame, FastJSONResponse, SSE_DONE
+from app.services.scheduler_service import (
+    upstream_scheduler,
+    Lane,
+    RequestPriority,
+    UpstreamOverloadedError,
+    current_priority,
+)
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api", tags=["chat"])
 
-# 启动时加载知识库
-try:
-    knowledge_base = knowledge_service.load_all_knowledge()
-    logger.info(f"知识库加载成功，共{len(knowledge_base)}条知识")
-except Exception as e:
-    logger.error(f"知识库加载失败: {e}")
-    knowledge_base = []
+
+def _overloaded_exception(e: UpstreamOverloadedError) -> HTTPException:
+    """上游过载转换为503响应，附带Retry-After"""
+    logger.warning(f"上游过载，拒绝请求: {e}")
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)}
+    )
 
 
 class ChatRequest(BaseModel):
     """聊天请求模型"""
     message: str
     image_url: Optional[str] = None
+    session_id: Optional[str] = None  # 会话ID，提供时携带多轮对话历史
+    segment: Optional[bool] = None  # 流式接口按句子下发（未指定时取服务端默认配置）
 
 
-@router.post("/chat")
+@router.post("/chat", response_class=FastJSONResponse)
 async def chat(request: ChatRequest):
     """
     聊天对话接口（带向量检索）
@@ -42,7 +61,12 @@ async def chat(request: ChatRequest):
         聊天响应
     """
     try:
-        logger.info(f"收到聊天请求: message='{request.message}', image_url={request.image_url}")
+        logger.info(
+            "收到聊天请求: message='%s', image_url=%s",
+            Truncated(request.message),
+            Truncated(request.image_url, 80),
+            extra={'sample_key': 'request'}
+        )
 
         if not request.message or not request.message.strip():
             logger.warning("消息内容为空")
@@ -52,7 +76,8 @@ async def chat(request: ChatRequest):
         result = await dialogue_manager.process_user_input(
             user_input=request.message,
             image_url=request.image_url,
-            knowledge_base=knowledge_base
+            knowledge_base=knowledge_service.knowledge,
+            session_id=request.session_id
         )
 
         logger.info(f"对话处理完成, intent={result.get('intent')}")
@@ -66,10 +91,12 @@ async def chat(request: ChatRequest):
         }
 
         logger.info(f"返回响应给前端, response长度={len(response_data['response'])}")
-        return response_data
+        return FastJSONResponse(response_data)
 
     except HTTPException:
         raise
+    except UpstreamOverloadedError as e:
+        raise _overloaded_exception(e)
     except Exception as e:
         logger.error(f"聊天处理失败: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -96,7 +123,7 @@ async def analyze_food(file: UploadFile = File(...)):
         result = await dialogue_manager.process_user_input(
             user_input="请分析这张图片中的食物，提供营养成分分析和健康建议",
             image_url=image_url,
-            knowledge_base=knowledge_base
+            knowledge_base=knowledge_service.knowledge
         )
         
         return {
@@ -105,65 +132,107 @@ async def analyze_food(file: UploadFile = File(...)):
             "vector_search": result.get('vector_search')
         }
         
+    except UpstreamOverloadedError as e:
+        raise _overloaded_exception(e)
     except Exception as e:
         logger.error(f"图片分析失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @router.get("/knowledge/stats")
-async def get_knowledge_stats():
+async def get_knowledge_stats(request: Request):
     """
     获取知识库统计信息
+    统计在知识库加载/重载时预先计算，支持 If-None-Match 条件请求
 
     Returns:
         知识库统计
     """
     try:
-        stats = {
-            "total": len(knowledge_base),
-            "categories": {}
-        }
+        catalog = knowledge_service.catalog
+        etag = catalog.etag
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
 
-        for item in knowledge_base:
-            category = item.get('category', 'unknown')
-            if category not in stats['categories']:
-                stats['categories'][category] = 0
-            stats['categories'][category] += 1
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
 
-        return stats
+        return Response(content=catalog.render(), media_type="application/json", headers=headers)
 
     except Exception as e:
         logger.error(f"获取知识库统计失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def stream_generator(user_input: str, image_url: Optional[str] = None):
+@router.post("/knowledge/reload", dependencies=[Depends(require_admin)])
+async def reload_knowledge():
+    """
+    重新加载知识库（修改知识库文件或重新生成快照后调用，需管理令牌）
+
+    Returns:
+        新的知识库统计
+    """
+    try:
+        return await service_lifecycle.reload()
+    except Exception as e:
+        logger.error(f"重新加载知识库失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.delete("/chat/session/{session_id}")
+async def clear_session(session_id: str):
+    """
+    清除会话历史
+
+    Args:
+        session_id: 会话ID
+    """
+    conversation_store.clear(session_id)
+    return {"session_id": session_id, "cleared": True}
+
+
+async def stream_generator(
+    user_input: str,
+    image_url: Optional[str] = None,
+    session_id: Optional[str] = None,
+    segment: bool = False
+):
     """
     流式响应生成器
 
     Args:
         user_input: 用户输入
         image_url: 图片URL（可选）
+        session_id: 会话ID（可选）
+        segment: 是否按句子下发
 
     Yields:
         SSE格式的流式数据
     """
+    # 流式请求优先于普通请求和批量任务获得上游槽位
+    current_priority.set(RequestPriority.STREAMING)
     try:
         async for data in dialogue_manager.process_user_input_stream(
             user_input=user_input,
             image_url=image_url,
-            knowledge_base=knowledge_base
+            knowledge_base=knowledge_service.knowledge,
+            session_id=session_id,
+            segment=segment
         ):
             # 使用SSE格式发送数据
-            yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            yield sse_frame(data)
 
         # 发送结束标记
-        yield "data: [DONE]\n\n"
+        yield SSE_DONE
 
+    except UpstreamOverloadedError as e:
+        logger.warning(f"流式生成被拒绝，上游过载: {e}")
+        yield sse_frame({'error': str(e), 'retry_after': e.retry_after})
+        yield SSE_DONE
     except Exception as e:
         logger.error(f"流式生成失败: {e}")
-        yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield sse_frame({'error': str(e)})
+        yield SSE_DONE
 
 
 @router.post("/chat/stream")
@@ -178,14 +247,27 @@ async def chat_stream(request: ChatRequest):
         流式响应
     """
     try:
-        logger.info(f"收到流式聊天请求: message='{request.message}', image_url={request.image_url}")
+        logger.info(
+            "收到流式聊天请求: message='%s', image_url=%s",
+            Truncated(request.message),
+            Truncated(request.image_url, 80),
+            extra={'sample_key': 'request'}
+        )
 
         if not request.message or not request.message.strip():
             logger.warning("消息内容为空")
             raise HTTPException(status_code=400, detail="消息内容不能为空")
 
+        # 生成通道已饱和时在发送响应头之前直接返回503
+        upstream_scheduler.ensure_capacity(Lane.GENERATION)
+
         return StreamingResponse(
-            stream_generator(request.message, request.image_url),
+            stream_generator(
+                request.message,
+                request.image_url,
+                request.session_id,
+                settings.stream_segment_sentences if request.segment is None else request.segment
+            ),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -196,6 +278,232 @@ async def chat_stream(request: ChatRequest):
 
     except HTTPException:
         raise
+    except UpstreamOverloadedError as e:
+        raise _overloaded_exception(e)
     except Exception as e:
         logger.error(f"流式聊天处理失败: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+
+
+class ChatConnection:
+    """
+    一个WebSocket连接上的多轮对话
+    每轮对话以客户端给定的 id 区分，可并行进行、单独取消；服务端定时发送心跳
+    """
+
+    def __init__(self, websocket: WebSocket, session_id: Optional[str]):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.turns: Dict[str, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, frame: Dict):
+        """发送一帧（多轮对话并发发送时串行化）"""
+        async with self._send_lock:
+            await self.websocket.send_text(dumps(frame).decode('utf-8'))
+
+    async def send_quietly(self, frame: Dict):
+        """发送一帧，连接已断开时忽略"""
+        try:
+            await self.send(frame)
+        except Exception:
+            pass
+
+    async def heartbeat(self):
+        """定时心跳，让代理保持连接并及时发现断开的客户端"""
+        while True:
+            await asyncio.sleep(settings.ws_heartbeat_interval)
+            await self.send({'type': 'heartbeat'})
+
+    async def handle(self, message: Dict):
+        """处理一条客户端消息"""
+        message_type = message.get('type')
+        turn_id = message.get('id', '')
+        if not isinstance(turn_id, (str, int)) or isinstance(turn_id, bool):
+            await self.send({'type': 'error', 'error': "对话id必须是字符串或整数"})
+            return
+        turn_id = str(turn_id)
+
+        if message_type == 'ping':
+            await self.send({'type': 'pong'})
+        elif message_type == 'cancel':
+            task = self.turns.get(turn_id)
+            if task is not None:
+                task.cancel()
+        elif message_type == 'chat':
+            await self.start_turn(turn_id, message)
+        else:
+            await self.send({'type': 'error', 'id': turn_id, 'error': f"未知的消息类型: {message_type}"})
+
+    async def start_turn(self, turn_id: str, message: Dict):
+        """开始一轮对话"""
+        text = message.get('message')
+        if not turn_id or turn_id in self.turns:
+            await self.send({'type': 'error', 'id': turn_id, 'error': "对话id为空或正在进行中"})
+            return
+        if not isinstance(text, str) or not text.strip():
+            await self.send({'type': 'error', 'id': turn_id, 'error': "消息内容不能为空"})
+            return
+        for field in ('image_url', 'session_id'):
+            if not isinstance(message.get(field), (str, type(None))):
+                await self.send({'type': 'error', 'id': turn_id, 'error': f"{field}必须是字符串"})
+                return
+        if len(self.turns) >= settings.ws_max_active_turns:
+            await self.send({'type': 'error', 'id': turn_id, 'error': "同时进行的对话过多，请稍后重试"})
+            return
+        try:
+            upstream_scheduler.ensure_capacity(Lane.GENERATION)
+        except UpstreamOverloadedError as e:
+            await self.send({'type': 'error', 'id': turn_id, 'error': str(e), 'retry_after': e.retry_after})
+            return
+
+        segment = message.get('segment')
+        task = asyncio.create_task(self.run_turn(
+            turn_id,
+            text,
+            message.get('image_url'),
+            message.get('session_id', self.session_id),
+            settings.stream_segment_sentences if segment is None else bool(segment)
+        ))
+        self.turns[turn_id] = task
+        task.add_done_callback(lambda _: self.turns.pop(turn_id, None))
+
+    async def run_turn(
+        self,
+        turn_id: str,
+        user_input: str,
+        image_url: Optional[str],
+        session_id: Optional[str],
+        segment: bool
+    ):
+        """执行一轮对话，将流式结果转换为带类型的帧"""
+        current_priority.set(RequestPriority.STREAMING)
+        try:
+            async for data in dialogue_manager.process_user_input_stream(
+                user_input=user_input,
+                image_url=image_url,
+                knowledge_base=knowledge_service.knowledge,
+                session_id=session_id,
+                segment=segment
+            ):
+                if 'vector_search' in data:
+                    await self.send({'type': 'vector_search', 'id': turn_id, 'data': data['vector_search']})
+                if 'content' in data:
+                    await self.send({'type': 'content', 'id': turn_id, 'content': data['content']})
+                if 'widget' in data:
+                    await self.send({'type': 'widget', 'id': turn_id, 'data': data['widget']})
+                if 'widget_update' in data:
+                    await self.send({'type': 'widget_update', 'id': turn_id, 'data': data['widget_update']})
+            await self.send({'type': 'done', 'id': turn_id})
+
+        except asyncio.CancelledError:
+            # 客户端取消本轮，或连接已断开
+            await self.send_quietly({'type': 'done', 'id': turn_id, 'cancelled': True})
+        except UpstreamOverloadedError as e:
+            logger.warning(f"WebSocket对话被拒绝，上游过载: {e}")
+            await self.send_quietly({'type': 'error', 'id': turn_id, 'error': str(e), 'retry_after': e.retry_after})
+            await self.send_quietly({'type': 'done', 'id': turn_id})
+        except Exception as e:
+            logger.error(f"WebSocket对话失败: {e}")
+            await self.send_quietly({'type': 'error', 'id': turn_id, 'error': str(e)})
+            await self.send_quietly({'type': 'done', 'id': turn_id})
+
+    def close(self):
+        """连接断开，取消所有进行中的对话"""
+        for task in list(self.turns.values()):
+            task.cancel()
+
+
+@router.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket, session_id: Optional[str] = None):
+    """
+    聊天对话接口（WebSocket，一个连接承载多轮对话）
+
+    客户端消息：
+        {"type": "chat", "id": "1", "message": "...", "image_url": null, "segment": false}
+        {"type": "cancel", "id": "1"}
+        {"type": "ping"}
+    服务端消息：
+        content / vector_search / widget / widget_update / done / error（均带对话id）、heartbeat、pong
+    """
+    await websocket.accept()
+    connection = ChatConnection(websocket, session_id)
+    heartbeat = asyncio.create_task(connection.heartbeat())
+    try:
+        while True:
+            received = await websocket.receive()
+            if received['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(received.get('code', 1000))
+            if received.get('text') is None:
+                await connection.send({'type': 'error', 'error': "只支持文本帧"})
+                continue
+            try:
+                message = json.loads(received['text'])
+            except json.JSONDecodeError:
+                await connection.send({'type': 'error', 'error': "消息不是合法的JSON"})
+                continue
+            if not isinstance(message, dict):
+                await connection.send({'type': 'error', 'error': "消息必须是JSON对象"})
+                continue
+            try:
+                await connection.handle(message)
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # 单条消息处理出错不影响连接上的其他对话
+                logger.error(f"处理WebSocket消息失败: {e!r}")
+                await connection.send({'type': 'error', 'id': str(message.get('id', '')), 'error': "消息处理失败"})
+    except WebSocketDisconnect:
+        logger.info("WebSocket连接已断开")
+    finally:
+        heartbeat.cancel()
+        # 取回心跳任务的异常（连接断开时发送心跳会失败），避免“Task exception was never retrieved”
+        await asyncio.gather(heartbeat, return_exceptions=True)
+        connection.close()
+
+
+async def batch_generator(questions: List[Dict]):
+    """
+    批量对话结果生成器
+
+    Args:
+        questions: 问题列表
+
+    Yields:
+        JSONL格式的结果，每行一个问题
+    """
+    try:
+        async for result in batch_processor.process(questions, knowledge_service.knowledge):
+            yield dumps(result) + b"\n"
+    except Exception as e:
+        logger.error(f"批量对话处理失败: {e}", exc_info=True)
+        yield dumps({'error': str(e)}) + b"\n"
+
+
+@router.post("/chat/batch")
+async def chat_batch(request: Request):
+    """
+    批量对话接口
+    请求体为JSONL，每行 {"id": ..., "message": ...}；响应为JSONL，按完成顺序逐行返回
+
+    Args:
+        request: 原始请求
+
+    Returns:
+        JSONL流式响应
+    """
+    try:
+        body = (await request.body()).decode('utf-8')
+        questions = parse_jsonl_questions(body)
+    except (UnicodeDecodeError, BatchInputError) as e:
+        raise HTTPException(status_code=400, detail=f"批量请求格式错误: {e}")
+
+    if not questions:
+        raise HTTPException(status_code=400, detail="批量请求中没有问题")
+
+    logger.info(f"收到批量对话请求，共{len(questions)}个问题")
+    return StreamingResponse(
+        batch_generator(questions),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"}
+    )
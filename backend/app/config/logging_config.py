@@ -0,0 +1,222 @@
+"""
+日志配置模块
+请求路径只把日志记录放入内存队列，由后台线程格式化为JSON并写出，日志I/O不再阻塞请求
+
+- 超长字段（如base64图片）在写出前截断
+- 标记了 sample_key 的高频日志（逐chunk、逐请求）按采样率和每秒上限丢弃，并统计被丢弃的条数
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from app.config.settings import settings
+
+# 日志记录的标准属性，其余属性视为 extra 字段写入JSON
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_BASE64_PATTERN = re.compile(r'(data:[\w/+.-]+;base64,)[A-Za-z0-9+/=]{32,}')
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def truncate(value, limit: int = 200) -> str:
+    """截断用于日志的值，base64数据只保留长度（先截断再匹配，耗时与原值长度无关）"""
+    if value is None:
+        return 'None'
+    text = str(value)
+    if text.startswith('data:'):
+        # 图片等data URL：只保留头部和数据长度
+        comma = text.find(',', 0, 100)
+        if comma != -1 and text[:comma].endswith(';base64'):
+            return f"{text[:comma + 1]}<{len(text) - comma - 1}字节>"
+    if len(text) > limit:
+        return f"{_mask_base64(text[:limit])}...<共{len(text)}字符>"
+    return _mask_base64(text)
+
+
+def _mask_base64(text: str) -> str:
+    return _BASE64_PATTERN.sub(lambda m: f"{m.group(1)}<{len(m.group(0)) - len(m.group(1))}字节>", text)
+
+
+class Truncated:
+    """
+    延迟截断：作为日志的 %s 参数传入，记录被级别或采样过滤掉时不做任何处理
+
+    用法：logger.info("收到请求: %s", Truncated(message), extra={'sample_key': 'request'})
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit: int = 200):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        return truncate(self.value, self.limit)
+
+
+class JsonFormatter(logging.Formatter):
+    """将日志记录格式化为单行JSON，超长字段截断"""
+
+    def __init__(self, max_field_chars: int = 1000):
+        super().__init__()
+        self.max_field_chars = max_field_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': truncate(record.getMessage(), self.max_field_chars),
+        }
+        for key, value in record.__dict__.items():
+            if key in _RESERVED_ATTRS or key.startswith('_'):
+                continue
+            if not isinstance(value, (int, float, bool)) and value is not None:
+                value = truncate(value, self.max_field_chars)
+            entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """沿用原来的文本格式，超长消息截断"""
+
+    def __init__(self, max_field_chars: int = 1000):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.max_field_chars = max_field_chars
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = truncate(record.message, self.max_field_chars)
+        return super().formatMessage(record)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    高频日志的采样和限流
+    只处理带 sample_key 属性的记录：先按采样率随机保留，再按每秒上限限流；
+    被丢弃的条数记在同一 sample_key 下一条保留的记录的 suppressed 字段中
+    """
+
+    def __init__(self, sample_rates: Dict[str, float], rate_limit: float):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.rate_limit = rate_limit
+        self._buckets: Dict[str, list] = {}  # sample_key -> [令牌数, 上次补充时间]
+        self._suppressed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample_key', None)
+        if key is None:
+            return True
+        with self._lock:
+            if self._admit(key):
+                suppressed = self._suppressed.pop(key, 0)
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return False
+
+    def _admit(self, key: str) -> bool:
+        if random.random() >= self.sample_rates.get(key, 1.0):
+            return False
+        if self.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(key, [self.rate_limit, now])
+        bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            return False
+        bucket[0] -= 1.0
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列已满时丢弃日志而不是阻塞请求"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """只合并消息参数，异常堆栈单独保存（不与消息一起被截断），格式化留给后台线程"""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """配置根日志：队列处理器 + 后台写出线程（重复调用时复用已启动的监听器）"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if settings.log_format == 'text':
+        formatter = TextFormatter(settings.log_max_field_chars)
+    else:
+        formatter = JsonFormatter(settings.log_max_field_chars)
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=settings.log_queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(
+        {'chunk': settings.log_chunk_sample_rate, 'request': settings.log_request_sample_rate},
+        settings.log_sampled_rate_limit
+    ))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(settings.log_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    # 进程退出前写出队列中剩余的日志
+    atexit.register(stop_logging)
+    return _listener
+
+
+def _restart_after_fork():
+    """fork出的子进程中没有写出线程，重新创建队列和监听器"""
+    global _listener
+    if _listener is not None:
+        _listener = None
+        setup_logging()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def stop_logging():
+    """停止后台写出线程（会先写完队列中的日志）"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,179 @@
+"""
+运行参数配置模块
+性能相关参数统一通过环境变量配置，未设置时使用默认值
+"""
+import os
+from pathlib import Path
+
+# backend 目录
+BACKEND_DIR = Path(__file__).resolve().parent.parent.parent
+
+
+def _get_int(name: str, default: int) -> int:
+    """读取整型环境变量"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _get_float(name: str, default: float) -> float:
+    """读取浮点型环境变量"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+def _get_bool(name: str, default: bool) -> bool:
+    """读取布尔型环境变量"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _get_set(name: str, default: str) -> frozenset:
+    """读取逗号分隔的集合型环境变量"""
+    value = os.getenv(name, default)
+    return frozenset(item.strip() for item in value.split(',') if item.strip())
+
+
+class Settings:
+    """运行参数"""
+
+    def __init__(self):
+        # 上游调度：向量化通道（调用便宜，并发可以更高）
+        self.embedding_initial_concurrency = _get_int('UPSTREAM_EMBEDDING_CONCURRENCY', 8)
+        self.embedding_min_concurrency = _get_int('UPSTREAM_EMBEDDING_MIN_CONCURRENCY', 1)
+        self.embedding_max_concurrency = _get_int('UPSTREAM_EMBEDDING_MAX_CONCURRENCY', 32)
+        self.embedding_max_queue = _get_int('UPSTREAM_EMBEDDING_MAX_QUEUE', 128)
+        self.embedding_max_wait = _get_float('UPSTREAM_EMBEDDING_MAX_WAIT', 5.0)
+
+        # 上游调度：生成通道（Qwen3-VL调用昂贵，并发保守）
+        self.generation_initial_concurrency = _get_int('UPSTREAM_GENERATION_CONCURRENCY', 4)
+        self.generation_min_concurrency = _get_int('UPSTREAM_GENERATION_MIN_CONCURRENCY', 1)
+        self.generation_max_concurrency = _get_int('UPSTREAM_GENERATION_MAX_CONCURRENCY', 16)
+        self.generation_max_queue = _get_int('UPSTREAM_GENERATION_MAX_QUEUE', 32)
+        self.generation_max_wait = _get_float('UPSTREAM_GENERATION_MAX_WAIT', 15.0)
+
+        # AIMD参数：成功时每个窗口加1，触发限流时乘以该系数
+        self.upstream_backoff_factor = _get_float('UPSTREAM_BACKOFF_FACTOR', 0.5)
+
+        # 大模型生成：单次请求总超时、首字超时（秒），需小于前端60秒超时
+        self.llm_request_timeout = _get_float('LLM_REQUEST_TIMEOUT', 50.0)
+        self.llm_first_token_timeout = _get_float('LLM_FIRST_TOKEN_TIMEOUT', 20.0)
+        # 主模型熔断或失败时改用的备用模型（留空不启用）
+        self.llm_fallback_model = os.getenv('LLM_FALLBACK_MODEL', '').strip() or None
+        # 对冲请求：首字等待超过近期P95（不低于最小延迟）时再发一个相同请求，取先返回的
+        self.llm_hedge_enabled = _get_bool('LLM_HEDGE_ENABLED', True)
+        self.llm_hedge_min_delay = _get_float('LLM_HEDGE_MIN_DELAY', 1.0)
+        self.llm_hedge_initial_delay = _get_float('LLM_HEDGE_INITIAL_DELAY', 4.0)
+        # 生成服务熔断：首字慢于该值按失败计，熔断后冷却时间
+        self.llm_slow_first_token_seconds = _get_float('LLM_SLOW_FIRST_TOKEN_SECONDS', 10.0)
+        self.llm_breaker_open_seconds = _get_float('LLM_BREAKER_OPEN_SECONDS', 30.0)
+
+        # 知识库向量索引持久化路径
+        self.knowledge_index_path = Path(os.getenv(
+            'KNOWLEDGE_INDEX_PATH',
+            str(BACKEND_DIR / "knowledge_base" / ".index" / "embeddings.npz")
+        ))
+        # 知识库编译快照路径（存在且与源文件一致时优先加载）
+        self.knowledge_snapshot_path = Path(os.getenv(
+            'KNOWLEDGE_SNAPSHOT_PATH',
+            str(BACKEND_DIR / "knowledge_base" / ".index" / "knowledge.snapshot")
+        ))
+        # 启动时后台预计算知识库向量，完成后才报告就绪
+        self.knowledge_warmup = _get_bool('KNOWLEDGE_WARMUP', True)
+
+        # 向量化服务熔断：单次调用超时、慢调用阈值、熔断冷却时间（秒）
+        self.embedding_timeout = _get_float('EMBEDDING_TIMEOUT', 5.0)
+        # 批量向量化（预热、建索引、批量任务）单次调用的超时
+        self.embedding_bulk_timeout = _get_float('EMBEDDING_BULK_TIMEOUT', 60.0)
+        self.embedding_slow_call_seconds = _get_float('EMBEDDING_SLOW_CALL_SECONDS', 2.0)
+        self.embedding_breaker_open_seconds = _get_float('EMBEDDING_BREAKER_OPEN_SECONDS', 30.0)
+        # 兜底TF-IDF检索的相似度阈值（分数分布与向量检索不同，单独配置）
+        self.fallback_similarity_threshold = _get_float('FALLBACK_SIMILARITY_THRESHOLD', 0.12)
+
+        # 查询归一化时是否应用同义词映射（会把不同说法视为同一个问题）
+        self.query_synonyms = _get_bool('QUERY_SYNONYMS', False)
+
+        # 知识向量量化存储（none/float16/int8/pq），量化后先近似打分再对候选精确重排，
+        # 精确向量改为磁盘映射以节省内存；单次检索通常比完整矩阵更慢，默认关闭，启用前先用基准工具评估
+        self.vector_quantization = os.getenv('VECTOR_QUANTIZATION', 'none').strip().lower()
+        self.vector_rescore_candidates = _get_int('VECTOR_RESCORE_CANDIDATES', 50)
+        self.vector_pq_subspaces = _get_int('VECTOR_PQ_SUBSPACES', 64)
+        # 粗排只用向量前若干维（如256/512，先用 scripts.benchmark_retrieval 评估召回率），0表示关闭
+        self.vector_prefix_dims = _get_int('VECTOR_PREFIX_DIMS', 0)
+
+        # 向量化批量调用时每次请求的文本条数
+        self.embedding_batch_size = _get_int('EMBEDDING_BATCH_SIZE', 16)
+        # 批量向量化时同时发出的批数上限（应低于向量化通道的并发数，给用户查询留出余量）
+        self.embedding_bulk_concurrency = _get_int('EMBEDDING_BULK_CONCURRENCY', 4)
+
+        # 文档入库：片段最大字符数、相邻片段重叠字符数、近似重复判定阈值（估计的Jaccard相似度）、
+        # 每组向量化的片段数（每组完成后保存一次向量缓存，中断后从最后一组继续）
+        self.ingest_chunk_chars = _get_int('INGEST_CHUNK_CHARS', 300)
+        self.ingest_overlap_chars = _get_int('INGEST_OVERLAP_CHARS', 60)
+        self.ingest_dedup_threshold = _get_float('INGEST_DEDUP_THRESHOLD', 0.85)
+        self.ingest_embed_group_size = _get_int('INGEST_EMBED_GROUP_SIZE', 128)
+
+        # 检索结果缓存条数（按归一化查询缓存最终检索结果，知识库重载后失效），0表示关闭
+        self.retrieval_memo_size = _get_int('RETRIEVAL_MEMO_SIZE', 1024)
+
+        # Prompt中检索知识的token预算（估算值）
+        self.prompt_context_token_budget = _get_int('PROMPT_CONTEXT_TOKEN_BUDGET', 1200)
+
+        # 流水线检索：这些意图不等待检索直接开始生成（逗号分隔，默认关闭；可设为 chitchat）
+        self.speculative_intents = _get_set('SPECULATIVE_INTENTS', '')
+        # 意图置信度低于该值时同样不等待检索（0表示关闭）
+        self.speculative_min_confidence = _get_float('SPECULATIVE_MIN_CONFIDENCE', 0.0)
+
+        # 流式分句：按中文标点整句下发（请求未指定 segment 时的默认值）、最长等待时间（秒）和单句最大长度
+        self.stream_segment_sentences = _get_bool('STREAM_SEGMENT_SENTENCES', False)
+        self.stream_segment_max_latency = _get_float('STREAM_SEGMENT_MAX_LATENCY', 0.8)
+        self.stream_segment_max_chars = _get_int('STREAM_SEGMENT_MAX_CHARS', 60)
+
+        # WebSocket对话：心跳间隔（秒）、单个连接同时进行的对话数上限
+        self.ws_heartbeat_interval = _get_float('WS_HEARTBEAT_INTERVAL', 20.0)
+        self.ws_max_active_turns = _get_int('WS_MAX_ACTIVE_TURNS', 4)
+
+        # 多轮对话历史：原文保留的最近轮数、历史部分的token上限、会话数上限和过期时间
+        self.history_window_turns = _get_int('HISTORY_WINDOW_TURNS', 6)
+        self.history_token_ceiling = _get_int('HISTORY_TOKEN_CEILING', 2000)
+        self.history_max_sessions = _get_int('HISTORY_MAX_SESSIONS', 1000)
+        self.history_session_ttl = _get_float('HISTORY_SESSION_TTL', 3600.0)
+
+        # 日志：级别、格式（json/text）、单字段最大字符数、内存队列容量（满时丢弃）
+        self.log_level = os.getenv('LOG_LEVEL', 'INFO').strip().upper()
+        self.log_format = os.getenv('LOG_FORMAT', 'json').strip().lower()
+        self.log_max_field_chars = _get_int('LOG_MAX_FIELD_CHARS', 1000)
+        self.log_queue_size = _get_int('LOG_QUEUE_SIZE', 10000)
+        # 高频日志采样率（逐chunk、逐请求）和每类每秒写出上限（0表示不限）
+        self.log_chunk_sample_rate = _get_float('LOG_CHUNK_SAMPLE_RATE', 0.01)
+        self.log_request_sample_rate = _get_float('LOG_REQUEST_SAMPLE_RATE', 1.0)
+        self.log_sampled_rate_limit = _get_float('LOG_SAMPLED_RATE_LIMIT', 50.0)
+
+        # 管理接口（在线剖析等）的访问令牌，未设置时管理接口不可用
+        self.admin_token = os.getenv('ADMIN_TOKEN', '').strip() or None
+        # CPU剖析的最长时间（秒）、事件循环延迟的检测间隔（秒）
+        self.profile_max_seconds = _get_float('PROFILE_MAX_SECONDS', 60.0)
+        self.loop_lag_interval = _get_float('LOOP_LAG_INTERVAL', 0.1)
+
+        # 生产部署（scripts.serve）：工作进程数（0表示CPU核数）、停止时等待进行中请求完成的最长时间（秒）
+        self.web_concurrency = _get_int('WEB_CONCURRENCY', 0)
+        self.shutdown_drain_seconds = _get_float('SHUTDOWN_DRAIN_SECONDS', 30.0)
+
+        # 批量对话：单次任务的问题数上限和生成并发数
+        self.batch_max_questions = _get_int('BATCH_MAX_QUESTIONS', 2000)
+        self.batch_generation_concurrency = _get_int('BATCH_GENERATION_CONCURRENCY', 4)
+
+
+# 全局配置实例
+settings = Settings()
@@ -2,26 +2,52 @@
 健康咨询助手后端主应用
 FastAPI应用入口
 """
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+import asyncio
 import logging
 
 from app.api import chat
+from app.api.auth import require_admin
 from app.config.credentials import credentials_config
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+from app.config.logging_config import setup_logging
+from app.config.settings import settings
+from app.services.scheduler_service import upstream_scheduler
+from app.services.lifecycle_service import service_lifecycle
+from app.services.vector_service import vector_retriever
+from app.services.llm_service import qwen_client
+from app.services.history_service import conversation_store
+from app.services.retrieval_memo import retrieval_memo
+from app.services.profiling_service import (
+    cpu_profiler,
+    memory_profiler,
+    loop_lag_monitor,
+    ProfilerBusyError,
 )
+
+# 配置日志（队列异步写出，不阻塞请求）
+setup_logging()
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时加载知识库和向量索引，关闭时持久化"""
+    loop_lag_monitor.start()
+    await service_lifecycle.startup()
+    yield
+    await service_lifecycle.shutdown()
+    await loop_lag_monitor.stop()
+
+
 # 创建FastAPI应用
 app = FastAPI(
     title="健康咨询助手API",
     description="企业级AI健康咨询数字员工后端服务",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置CORS
@@ -50,15 +76,36 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """健康检查接口"""
+    """健康检查接口（预热完成前 status 为 warming）"""
     return {
-        "status": "healthy",
+        "status": "healthy" if service_lifecycle.is_ready else service_lifecycle.status,
+        "ready": service_lifecycle.is_ready,
         "services": {
             "llm": credentials_config.get_modelscope_api_key() is not None,
-        }
+        },
+        "upstream": upstream_scheduler.stats(),
+        "embedding_cache": vector_retriever.cache_stats(),
+        "retrieval_memo": retrieval_memo.stats(),
+        "embedding_breaker": vector_retriever.breaker.stats(),
+        "generation": qwen_client.stats()
     }
 
 
+@app.get("/health/live")
+async def liveness_check():
+    """存活检查：进程能响应即视为存活"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness_check():
+    """就绪检查：知识库加载和向量预热完成前返回503"""
+    readiness = service_lifecycle.readiness()
+    if not readiness["ready"]:
+        return JSONResponse(status_code=503, content=readiness)
+    return readiness
+
+
 @app.get("/test/api-key")
 async def test_api_key():
     """测试API密钥加载"""
@@ -70,6 +117,94 @@ async def test_api_key():
     }
 
 
+def _folded_response(result: dict) -> PlainTextResponse:
+    """折叠栈文本（可直接用于 flamegraph.pl / speedscope）"""
+    return PlainTextResponse(
+        result['folded'],
+        headers={
+            "X-Profile-Samples": str(result['samples']),
+            "X-Profile-Duration": str(result['duration'])
+        }
+    )
+
+
+@app.get("/admin/profile/cpu", dependencies=[Depends(require_admin)])
+async def profile_cpu(
+    seconds: float = Query(10.0, gt=0),
+    interval_ms: float = Query(5.0, ge=1.0),
+    all_threads: bool = False
+):
+    """采样CPU若干秒，返回折叠栈"""
+    try:
+        cpu_profiler.start(min(seconds, settings.profile_max_seconds), interval_ms / 1000, all_threads)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        await asyncio.sleep(min(seconds, settings.profile_max_seconds))
+    finally:
+        result = cpu_profiler.stop()
+    return _folded_response(result)
+
+
+@app.post("/admin/profile/cpu/start", dependencies=[Depends(require_admin)])
+async def start_cpu_profile(
+    seconds: float = Query(60.0, gt=0),
+    interval_ms: float = Query(5.0, ge=1.0),
+    all_threads: bool = False
+):
+    """开始CPU采样（最长 seconds 秒后自动停止），用 /admin/profile/cpu/stop 取结果"""
+    seconds = min(seconds, settings.profile_max_seconds)
+    try:
+        cpu_profiler.start(seconds, interval_ms / 1000, all_threads)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"started": True, "seconds": seconds}
+
+
+@app.post("/admin/profile/cpu/stop", dependencies=[Depends(require_admin)])
+async def stop_cpu_profile():
+    """停止CPU采样，返回折叠栈"""
+    return _folded_response(cpu_profiler.stop())
+
+
+@app.post("/admin/profile/memory/start", dependencies=[Depends(require_admin)])
+async def start_memory_profile(frames: int = Query(1, ge=1, le=50)):
+    """开启tracemalloc内存跟踪"""
+    memory_profiler.start(frames)
+    return {"tracing": True, "frames": frames}
+
+
+@app.get("/admin/profile/memory/snapshot", dependencies=[Depends(require_admin)])
+async def memory_snapshot(
+    limit: int = Query(20, ge=1, le=200),
+    group_by: str = Query('lineno', pattern='^(lineno|filename|traceback)$')
+):
+    """拍摄内存快照：占用最多的分配位置、与上一次快照的差异，以及主要数据结构的大小"""
+    try:
+        result = await asyncio.to_thread(memory_profiler.snapshot, limit, group_by)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    result['components'] = {
+        **vector_retriever.memory_stats(),
+        'conversation_sessions': len(conversation_store),
+        'retrieval_memo_entries': len(retrieval_memo),
+    }
+    return result
+
+
+@app.post("/admin/profile/memory/stop", dependencies=[Depends(require_admin)])
+async def stop_memory_profile():
+    """关闭tracemalloc"""
+    memory_profiler.stop()
+    return {"tracing": False}
+
+
+@app.get("/admin/loop-lag", dependencies=[Depends(require_admin)])
+async def loop_lag():
+    """事件循环延迟统计"""
+    return loop_lag_monitor.stats()
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """全局异常处理"""
@@ -0,0 +1,148 @@
+"""
+批量对话服务模块
+离线批量回答问题：所有问题一次批量向量化和检索，生成阶段限制并发
+"""
+import asyncio
+import json
+import logging
+from typing import AsyncGenerator, Dict, List
+
+from app.config.settings import settings
+from app.services.dialogue_service import dialogue_manager
+from app.services.scheduler_service import current_priority, RequestPriority, UpstreamOverloadedError
+
+logger = logging.getLogger(__name__)
+
+# 单个问题遇到上游过载时的最大重试次数
+MAX_OVERLOAD_RETRIES = 3
+
+
+class BatchInputError(ValueError):
+    """批量输入格式错误"""
+
+
+def parse_jsonl_questions(text: str) -> List[Dict]:
+    """
+    解析JSONL格式的问题列表
+    每行为 {"id": ..., "message": ...}，或直接为一个JSON字符串
+
+    Args:
+        text: JSONL文本
+
+    Returns:
+        问题列表 [{id, message}]
+
+    Raises:
+        BatchInputError: 行格式错误或问题数超过上限
+    """
+    questions = []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise BatchInputError(f"第{line_no}行不是合法的JSON: {e}")
+
+        if isinstance(record, str):
+            record = {'message': record}
+        if not isinstance(record, dict) or not str(record.get('message', '')).strip():
+            raise BatchInputError(f"第{line_no}行缺少message字段")
+
+        questions.append({
+            'id': record.get('id', line_no),
+            'message': str(record['message'])
+        })
+
+    if len(questions) > settings.batch_max_questions:
+        raise BatchInputError(f"问题数{len(questions)}超过上限{settings.batch_max_questions}")
+    return questions
+
+
+class BatchChatProcessor:
+    """批量对话处理器"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self.dialogue = dialogue_manager
+
+    async def process(
+        self,
+        questions: List[Dict],
+        knowledge_base: List[Dict]
+    ) -> AsyncGenerator[Dict, None]:
+        """
+        批量处理问题，按完成顺序产出结果
+
+        Args:
+            questions: 问题列表 [{id, message}]
+            knowledge_base: 知识库
+
+        Yields:
+            {id, message, response, intent, vector_search} 或 {id, message, error}
+        """
+        # 批量任务让位于实时对话
+        current_priority.set(RequestPriority.BATCH)
+        if not questions:
+            return
+
+        # 1. 所有问题一次批量向量化，与知识矩阵做一次矩阵乘法
+        messages = [question['message'] for question in questions]
+        if knowledge_base:
+            all_matches = await self.dialogue.retriever.get_top_k_matches_batch(
+                messages, knowledge_base, top_k=3
+            )
+        else:
+            all_matches = [None] * len(questions)
+        logger.info(f"批量检索完成，共{len(questions)}个问题")
+
+        # 2. 有界并发生成
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def answer(question: Dict, matches) -> Dict:
+            async with semaphore:
+                try:
+                    result = await self._answer_with_retry(question['message'], knowledge_base, matches)
+                    return {
+                        'id': question['id'],
+                        'message': question['message'],
+                        'response': result['text_response'],
+                        'intent': result.get('intent', 'unknown'),
+                        'vector_search': result.get('vector_search')
+                    }
+                except Exception as e:
+                    logger.error(f"批量问题{question['id']}处理失败: {e}")
+                    return {'id': question['id'], 'message': question['message'], 'error': str(e)}
+
+        tasks = [
+            asyncio.create_task(answer(question, matches))
+            for question, matches in zip(questions, all_matches)
+        ]
+        try:
+            for completed, task in enumerate(asyncio.as_completed(tasks), start=1):
+                yield await task
+                if completed % 50 == 0:
+                    logger.info(f"批量生成进度: {completed}/{len(tasks)}")
+        finally:
+            # 客户端断开时取消未完成的生成
+            for task in tasks:
+                task.cancel()
+
+    async def _answer_with_retry(self, message: str, knowledge_base: List[Dict], matches) -> Dict:
+        """生成回答，上游过载时按Retry-After等待后重试"""
+        for attempt in range(MAX_OVERLOAD_RETRIES + 1):
+            try:
+                return await self.dialogue.process_user_input(
+                    user_input=message,
+                    knowledge_base=knowledge_base,
+                    matches=matches
+                )
+            except UpstreamOverloadedError as e:
+                if attempt == MAX_OVERLOAD_RETRIES:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+
+# 创建全局实例
+batch_processor = BatchChatProcessor(settings.batch_generation_concurrency)
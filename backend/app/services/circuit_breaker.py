@@ -0,0 +1,113 @@
+"""
+熔断器模块
+按滑动窗口统计上游调用的失败和慢调用比例，超过阈值时熔断，冷却后放行探测请求
+"""
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    熔断器
+    closed：正常放行；open：直接拒绝，等待冷却；half_open：只放行一个探测请求
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        window_size: int = 20,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 5.0,
+        open_seconds: float = 30.0
+    ):
+        """
+        Args:
+            name: 熔断器名称（用于日志）
+            window_size: 滑动窗口内统计的调用数
+            min_calls: 窗口内至少有这么多调用才判断是否熔断
+            failure_rate: 失败（含慢调用）比例达到该值时熔断
+            slow_call_seconds: 耗时超过该值的调用视为失败
+            open_seconds: 熔断后的冷却时间
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window_size)  # True 表示失败或慢调用
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """是否放行本次调用"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            logger.info(f"熔断器[{self.name}]冷却结束，放行探测请求")
+        # half_open：同一时间只放行一个探测请求
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self, latency: float):
+        """记录一次成功调用（耗时过长按失败计）"""
+        if latency > self.slow_call_seconds:
+            logger.warning(f"熔断器[{self.name}]慢调用: {latency:.2f}秒")
+            self.record_failure()
+            return
+        if self.state == self.HALF_OPEN:
+            self.state = self.CLOSED
+            self._outcomes.clear()
+            self._probe_in_flight = False
+            logger.info(f"熔断器[{self.name}]探测成功，恢复正常")
+        self._outcomes.append(False)
+
+    def record_failure(self):
+        """记录一次失败调用"""
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+        self._outcomes.append(True)
+        failures = sum(self._outcomes)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+            self._open()
+
+    def release_probe(self):
+        """探测请求被取消（没有结果），允许下一次调用重新探测"""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def retry_after(self) -> int:
+        """熔断状态下距离放行探测还需等待的秒数"""
+        if self.state != self.OPEN:
+            return 1
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self._opened_at)))
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self._outcomes.clear()
+        logger.warning(f"熔断器[{self.name}]已熔断，{self.open_seconds:.0f}秒后重试")
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'window_calls': len(self._outcomes),
+            'window_failures': sum(self._outcomes),
+        }
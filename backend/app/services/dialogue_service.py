@@ -2,15 +2,39 @@
 对话管理服务模块
 负责对话流程控制和响应生成
 """
+import asyncio
 import logging
-from typing import Dict, List, Optional, AsyncGenerator
+import re
+from typing import Dict, List, Optional, AsyncGenerator, Tuple
 from enum import Enum
 
 from app.services.llm_service import qwen_client
 from app.services.vector_service import vector_retriever
+from app.services.knowledge_base_service import knowledge_service
+from app.services.retrieval_memo import retrieval_memo
+from app.services.scheduler_service import UpstreamOverloadedError
+from app.services.prompt_service import prompt_template
+from app.services.history_service import conversation_store
+from app.services.widget_service import WidgetExtractor, extract_widget
+from app.services.segmenter_service import segment_stream
+from app.config.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# 相似度阈值：最高相似度低于该值时不使用检索结果
+SIMILARITY_THRESHOLD = 0.40
+# 每次检索的知识条数
+RETRIEVAL_TOP_K = 3
+
+# 闲聊关键词：整条消息（去掉标点和语气词后）只由这些词组成，或消息很短且不含健康相关字词时才判定为闲聊
+CHITCHAT_KEYWORDS = ['你好', '您好', '谢谢', '感谢', '再见', '拜拜', '你是谁', '早上好', '晚上好', '晚安', 'hello']
+# 判定为闲聊的短消息最大长度（去掉标点后的字符数）
+CHITCHAT_MAX_CHARS = 6
+# 去掉这些标点、空白和语气词后再判断闲聊
+_CHITCHAT_FILLERS = re.compile(r'[\s\W_]|[啊呀呢吧哈嗯哦啦嘛哇你您们]')
+# 出现即视为健康问题的字词（意图关键词之外）
+HEALTH_TERMS = ['病', '血', '药', '医', '疼', '痛', '体检', '健康', '症', '炎', '喝', '体重', '血压', '血糖']
+
 
 class ConversationIntent(Enum):
     """对话意图类型"""
@@ -40,7 +64,9 @@ class DialogueManager:
         self,
         user_input: str,
         image_url: Optional[str] = None,
-        knowledge_base: Optional[List[Dict]] = None
+        knowledge_base: Optional[List[Dict]] = None,
+        session_id: Optional[str] = None,
+        matches: Optional[List[Dict]] = None
     ) -> Dict:
         """
         处理用户输入
@@ -49,66 +75,32 @@ class DialogueManager:
             user_input: 用户输入文本
             image_url: 图片URL（可选）
             knowledge_base: 知识库（可选）
+            session_id: 会话ID（可选，提供时携带多轮对话历史）
+            matches: 预先完成的检索结果（可选，批量处理时传入以跳过检索）
 
         Returns:
             响应结果 {text_response, widget_data, intent, vector_search}
         """
         try:
-            # 1. 意图识别
-            intent = await self._classify_intent(user_input)
-            logger.info(f"识别意图: {intent.value}")
-
-            # 2. 知识检索
-            relevant_docs = []
-            vector_search_info = None
-            if knowledge_base:
-                matches = self.retriever.get_top_k_matches(
-                    user_input,
-                    knowledge_base,
-                    top_k=3
-                )
-
-                # 相似度阈值：只有当最高相似度达到40%以上时才启用向量检索
-                # 这样可以避免完全不相关的问题也返回低质量的匹配结果
-                SIMILARITY_THRESHOLD = 0.40
-                max_score = max([m.get('score', 0) for m in matches]) if matches else 0
-
-                if max_score >= SIMILARITY_THRESHOLD:
-                    # 相似度足够高，使用向量检索结果
-                    relevant_docs = [m['content'] for m in matches]
-
-                    # 构建向量检索信息，用于前端展示
-                    vector_search_info = {
-                        'enabled': True,
-                        'total_knowledge': len(knowledge_base),
-                        'retrieved_count': len(matches),
-                        'top_matches': [
-                            {
-                                'content': m['content'][:100] + '...' if len(m['content']) > 100 else m['content'],
-                                'category': m.get('category', 'unknown'),
-                                'score': round(m.get('score', 0), 4)
-                            }
-                            for m in matches
-                        ]
-                    }
-                    logger.info(f"向量检索启用：检索到{len(relevant_docs)}条相关知识，最高相似度: {max_score:.2%}")
-                else:
-                    # 相似度太低，不启用向量检索
-                    logger.info(f"向量检索未启用：最高相似度{max_score:.2%}低于阈值{SIMILARITY_THRESHOLD:.2%}，判定为不相关问题")
+            # 1-2. 意图识别与知识检索（并行）
+            intent, relevant_docs, vector_search_info = await self._classify_and_retrieve(
+                user_input, knowledge_base, matches
+            )
 
             # 3. 构建prompt
-            prompt = self._build_prompt(user_input, relevant_docs, intent, image_url is not None)
-
-            # 4. 生成回复
-            if image_url:
-                # 多模态对话
-                response_text = ""
-                async for chunk in self.llm.chat_stream_async(prompt, image_url):
-                    response_text += chunk
-            else:
-                # 纯文本对话
-                response = self.llm.chat_with_image(prompt, None, stream=False)
-                response_text = response
+            history = conversation_store.get(session_id) if session_id else None
+            system_prompt, user_message = self._build_prompt(
+                user_input, relevant_docs, intent, image_url is not None,
+                summary=history.summary if history else ""
+            )
+
+            # 4. 生成回复（异步调用，不阻塞事件循环）
+            response_text = await self.llm.chat_async(
+                user_message,
+                image_url,
+                system_prompt=system_prompt,
+                history=history.build_messages(settings.history_token_ceiling) if history else None
+            )
 
             # 5. 提取widget指令
             widget_data = self._extract_widget_commands(response_text)
@@ -116,6 +108,8 @@ class DialogueManager:
             # 6. 更新状态
             self.state['intent'] = intent
             self.state['turn_count'] += 1
+            if history:
+                history.append_turn(user_input, response_text, settings.history_window_turns, self.llm)
 
             return {
                 'text_response': response_text,
@@ -124,6 +118,9 @@ class DialogueManager:
                 'vector_search': vector_search_info
             }
 
+        except UpstreamOverloadedError:
+            # 上游过载交给API层返回503和Retry-After
+            raise
         except Exception as e:
             logger.error(f"处理用户输入失败: {e}")
             return {
@@ -133,8 +130,132 @@ class DialogueManager:
                 'vector_search': None
             }
 
+    async def _classify_and_retrieve(
+        self,
+        user_input: str,
+        knowledge_base: Optional[List[Dict]],
+        matches: Optional[List[Dict]] = None
+    ) -> Tuple[ConversationIntent, List[str], Optional[Dict]]:
+        """
+        意图识别与知识检索流水线
+        检索任务先启动，意图识别在线程中执行，两者并行；闲聊或低置信度意图可配置为不等待检索直接生成
+
+        Args:
+            user_input: 用户输入文本
+            knowledge_base: 知识库（可选）
+            matches: 预先完成的检索结果（可选）
+
+        Returns:
+            (意图, 相关知识文本, 向量检索信息)
+        """
+        # 当前生效的知识库才使用检索结果缓存（缓存按其版本失效）
+        memo_version = None
+        memoized = None
+        if knowledge_base and matches is None and knowledge_base is knowledge_service.knowledge:
+            memo_version = knowledge_service.catalog.version
+            memoized = retrieval_memo.get(user_input, RETRIEVAL_TOP_K, memo_version)
+
+        retrieval = None
+        if knowledge_base and matches is None and memoized is None:
+            retrieval = asyncio.create_task(
+                self.retriever.get_top_k_matches(user_input, knowledge_base, top_k=RETRIEVAL_TOP_K)
+            )
+
+        try:
+            intent, confidence = await self._classify_intent_with_confidence(user_input)
+            logger.info(f"识别意图: {intent.value}，置信度{confidence:.2f}")
+
+            if retrieval is not None or memoized is not None:
+                if self._should_skip_retrieval(intent, confidence):
+                    logger.info(f"意图{intent.value}跳过知识检索，直接开始生成")
+                    return intent, [], None
+            if memoized is not None:
+                logger.debug(f"检索结果命中缓存：{len(memoized.ids)}条知识")
+                return intent, list(memoized.relevant_docs), memoized.vector_search
+            if retrieval is not None:
+                matches = await retrieval
+        finally:
+            if retrieval is not None and not retrieval.done():
+                retrieval.cancel()
+
+        if not knowledge_base:
+            return intent, [], None
+        relevant_docs, vector_search_info = self._apply_similarity_threshold(matches, knowledge_base)
+        # 只缓存向量检索的结果；兜底检索是降级结果，向量化服务恢复后应重新检索
+        if memo_version is not None and matches and all(m.get('retriever', 'embedding') == 'embedding' for m in matches):
+            retrieval_memo.put(user_input, RETRIEVAL_TOP_K, memo_version, matches, relevant_docs, vector_search_info)
+        return intent, relevant_docs, vector_search_info
+
+    @staticmethod
+    def _should_skip_retrieval(intent: ConversationIntent, confidence: float) -> bool:
+        """是否不等待检索直接生成"""
+        return (
+            intent.value in settings.speculative_intents
+            or confidence < settings.speculative_min_confidence
+        )
+
+    def _apply_similarity_threshold(
+        self,
+        matches: List[Dict],
+        knowledge_base: List[Dict]
+    ) -> Tuple[List[str], Optional[Dict]]:
+        """
+        按相似度阈值决定是否使用检索结果
+
+        Returns:
+            (相关知识文本, 向量检索信息)，未达到阈值时为 ([], None)
+        """
+        # 相似度阈值：只有当最高相似度达到40%以上时才启用向量检索
+        # 这样可以避免完全不相关的问题也返回低质量的匹配结果
+        max_score = max([m.get('score', 0) for m in matches]) if matches else 0
+        # 兜底TF-IDF检索的分数分布与向量检索不同，使用单独的阈值
+        retriever = matches[0].get('retriever', 'embedding') if matches else 'embedding'
+        threshold = settings.fallback_similarity_threshold if retriever == 'tfidf' else SIMILARITY_THRESHOLD
+
+        if max_score < threshold:
+            # 相似度太低，不启用向量检索
+            logger.info(f"向量检索未启用：最高相似度{max_score:.2%}低于阈值{threshold:.2%}，判定为不相关问题")
+            return [], None
+
+        # 相似度足够高，使用向量检索结果
+        relevant_docs = [m['content'] for m in matches]
+
+        # 构建向量检索信息，用于前端展示
+        vector_search_info = {
+            'enabled': True,
+            'retriever': retriever,
+            'total_knowledge': len(knowledge_base),
+            'retrieved_count': len(matches),
+            'top_matches': [
+                {
+                    'content': m['content'][:100] + '...' if len(m['content']) > 100 else m['content'],
+                    'category': m.get('category', 'unknown'),
+                    'score': round(m.get('score', 0), 4)
+                }
+                for m in matches
+            ]
+        }
+        logger.info(f"向量检索启用：检索到{len(relevant_docs)}条相关知识，最高相似度: {max_score:.2%}")
+        return relevant_docs, vector_search_info
+
     async def _classify_intent(self, user_input: str) -> ConversationIntent:
         """识别用户意图"""
+        intent, _ = await self._classify_intent_with_confidence(user_input)
+        return intent
+
+    async def _classify_intent_with_confidence(self, user_input: str) -> Tuple[ConversationIntent, float]:
+        """
+        识别用户意图及置信度
+        关键词匹配是同步计算，放到线程中执行，事件循环同时推进已启动的检索任务
+        （直接在协程中调用不会让出事件循环，检索要等识别结束才开始）
+        """
+        return await asyncio.to_thread(self._match_intent, user_input)
+
+    def _match_intent(self, user_input: str) -> Tuple[ConversationIntent, float]:
+        """
+        关键词匹配识别意图
+        置信度按命中的关键词数计算，未命中任何关键词的兜底意图置信度为0
+        """
         # 简单的关键词匹配意图识别
         keywords = {
             ConversationIntent.NUTRITION: ['吃', '食物', '营养', '饮食', '餐', '膳食', '健康食谱'],
@@ -144,59 +265,54 @@ class DialogueManager:
 
         user_input_lower = user_input.lower()
         for intent, words in keywords.items():
-            if any(word in user_input_lower for word in words):
-                return intent
+            hits = sum(1 for word in words if word in user_input_lower)
+            if hits:
+                return intent, hits / (hits + 1)
+
+        if self._is_chitchat(user_input_lower):
+            return ConversationIntent.CHITCHAT, 0.5
 
-        return ConversationIntent.HEALTH_KNOWLEDGE
+        return ConversationIntent.HEALTH_KNOWLEDGE, 0.0
+
+    @staticmethod
+    def _is_chitchat(text: str) -> bool:
+        """
+        是否为闲聊：去掉标点后整条消息都是问候/致谢，或消息很短、含问候且没有健康相关字词
+        （"你好，高血压要注意什么"这类带问候的健康问题不算闲聊）
+        """
+        stripped = re.sub(r'[\s\W_]', '', text)
+        if not stripped or not any(word in stripped for word in CHITCHAT_KEYWORDS):
+            return False
+        rest = stripped
+        for word in CHITCHAT_KEYWORDS:
+            rest = rest.replace(word, '')
+        if not _CHITCHAT_FILLERS.sub('', rest):
+            return True
+        return len(stripped) <= CHITCHAT_MAX_CHARS and not any(term in stripped for term in HEALTH_TERMS)
 
     def _build_prompt(
         self,
         user_input: str,
         relevant_docs: List[str],
         intent: ConversationIntent,
-        has_image: bool
-    ) -> str:
-        """构建系统prompt"""
-        system_prompt = f"""你是企业健康咨询助手"小星"，负责为员工提供专业的健康咨询服务。
-
-你的服务范围：
-1. 营养膳食建议 - 分析食物营养成分，推荐健康饮食方案
-2. 健身计划指导 - 根据身体状况制定运动计划
-3. 亚健康调理咨询 - 提供专业的亚健康状态调理建议
-4. 健康知识普及 - 解答各种健康相关问题
-
-回答要求：
-- 专业、友善、实用
-- 基于科学依据，避免提供不实信息
-- 如果不确定，建议咨询专业医生
-- 回答简洁明了，避免过于冗长
-"""
-
-        # 添加相关知识库内容
-        if relevant_docs:
-            system_prompt += f"\n相关知识库内容：\n{chr(10).join(relevant_docs)}\n"
-
-        # 添加提示
-        if has_image:
-            system_prompt += "\n注意：用户上传了一张图片，请结合图片内容回答。"
-
-        system_prompt += f"\n用户问题：{user_input}\n\n请提供专业建议："
+        has_image: bool,
+        summary: str = ""
+    ) -> Tuple[str, str]:
+        """
+        构建系统消息和本轮用户消息
+        系统消息的静态前缀预编译，检索知识按token预算打包
 
-        return system_prompt
+        Returns:
+            (system_prompt, user_message)
+        """
+        return (
+            prompt_template.render_system(relevant_docs, has_image, summary),
+            prompt_template.render_user(user_input)
+        )
 
     def _extract_widget_commands(self, response: str) -> Optional[Dict]:
-        """从响应中提取widget指令"""
-        # 简单实现：检查是否包含特定标记
-        # 实际可以更复杂，解析JSON格式的指令
-        if '[卡片]' in response or '[展示]' in response:
-            return {
-                'type': 'widget_pic',
-                'content': {
-                    'title': '健康建议',
-                    'content': response
-                }
-            }
-        return None
+        """从响应中提取widget指令（以偏移引用回复文本，不复制内容）"""
+        return extract_widget(response)
 
     def reset_state(self):
         """重置对话状态"""
@@ -212,7 +328,9 @@ class DialogueManager:
         self,
         user_input: str,
         image_url: Optional[str] = None,
-        knowledge_base: Optional[List[Dict]] = None
+        knowledge_base: Optional[List[Dict]] = None,
+        session_id: Optional[str] = None,
+        segment: bool = False
     ) -> AsyncGenerator[Dict, None]:
         """
         处理用户输入（流式输出版本）
@@ -221,64 +339,64 @@ class DialogueManager:
             user_input: 用户输入文本
             image_url: 图片URL（可选）
             knowledge_base: 知识库（可选）
+            session_id: 会话ID（可选，提供时携带多轮对话历史）
+            segment: 是否按句子/分句下发 content（便于数字人逐句播报）
 
         Yields:
-            包含 content 和/或 vector_search 的字典
+            包含 content、vector_search、widget 或 widget_update 的字典
+            （widget 在标记出现后立即发送，text_ref 引用回复文本的字符偏移、end 为None；
+            回复结束后 widget_update 按出现顺序给出全部widget，text_ref.end 已补全）
         """
         try:
-            # 1. 意图识别
-            intent = await self._classify_intent(user_input)
-            logger.info(f"识别意图: {intent.value}")
-
-            # 2. 知识检索
-            relevant_docs = []
-            vector_search_info = None
-            if knowledge_base:
-                matches = self.retriever.get_top_k_matches(
-                    user_input,
-                    knowledge_base,
-                    top_k=3
-                )
-
-                SIMILARITY_THRESHOLD = 0.40
-                max_score = max([m.get('score', 0) for m in matches]) if matches else 0
-
-                if max_score >= SIMILARITY_THRESHOLD:
-                    relevant_docs = [m['content'] for m in matches]
-                    logger.info(f"向量检索启用：检索到{len(relevant_docs)}条相关知识，最高相似度: {max_score:.2%}")
-
-                    # 构建向量检索信息
-                    vector_search_info = {
-                        'enabled': True,
-                        'total_knowledge': len(knowledge_base),
-                        'retrieved_count': len(matches),
-                        'top_matches': [
-                            {
-                                'score': m.get('score', 0),
-                                'category': m.get('category', ''),
-                                'content': m.get('content', '')[:100] + '...'
-                            }
-                            for m in matches
-                        ]
-                    }
-                else:
-                    logger.info(f"向量检索未启用：最高相似度{max_score:.2%}低于阈值{SIMILARITY_THRESHOLD:.2%}，判定为不相关问题")
+            # 1-2. 意图识别与知识检索（并行）
+            intent, relevant_docs, vector_search_info = await self._classify_and_retrieve(
+                user_input, knowledge_base
+            )
 
             # 3. 先发送向量检索信息（如果有）
             if vector_search_info:
                 yield {'vector_search': vector_search_info}
 
             # 4. 构建prompt
-            prompt = self._build_prompt(user_input, relevant_docs, intent, image_url is not None)
-
-            # 5. 流式生成回复
-            async for chunk in self.llm.chat_stream_async(prompt, image_url):
+            history = conversation_store.get(session_id) if session_id else None
+            system_prompt, user_message = self._build_prompt(
+                user_input, relevant_docs, intent, image_url is not None,
+                summary=history.summary if history else ""
+            )
+
+            # 5. 流式生成回复，同时增量识别widget标记
+            response_parts = []
+            widgets = WidgetExtractor()
+            chunks = self.llm.chat_stream_async(
+                user_message,
+                image_url,
+                system_prompt=system_prompt,
+                history=history.build_messages(settings.history_token_ceiling) if history else None
+            )
+            if segment:
+                chunks = segment_stream(
+                    chunks,
+                    settings.stream_segment_max_latency,
+                    settings.stream_segment_max_chars
+                )
+            async for chunk in chunks:
+                response_parts.append(chunk)
                 yield {'content': chunk}
+                for widget in widgets.feed(chunk):
+                    yield {'widget': widget}
+
+            # 回复结束后补全各widget的引用范围（流式发送时 text_ref.end 尚未确定）
+            if widgets.widgets:
+                yield {'widget_update': widgets.finish()}
 
             # 6. 更新状态
             self.state['intent'] = intent
             self.state['turn_count'] += 1
+            if history:
+                history.append_turn(user_input, "".join(response_parts), settings.history_window_turns, self.llm)
 
+        except UpstreamOverloadedError:
+            raise
         except Exception as e:
             logger.error(f"流式处理用户输入失败: {e}")
             yield {'content': "抱歉，处理您的请求时出现了错误。请稍后再试。"}
@@ -0,0 +1,180 @@
+"""
+本地兜底检索模块
+字符n-gram TF-IDF检索，纯CPU、无需上游服务，在向量化服务变慢或不可用时接管检索
+
+倒排表以numpy数组存储（按n-gram排序的编码、每个n-gram的文档下标和权重区间），
+建索引和查询都是向量化运算，建索引在加载/重载知识库时于后台线程完成，不在请求中进行；
+编译快照中已包含倒排表时直接内存映射使用，启动时不再解码和切分知识内容
+"""
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config.settings import settings
+from app.services.query_normalizer import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# 使用1~2字的字符n-gram：中文不分词也能覆盖“失眠”“血压”这类双字词
+# n-gram编码：单字为码点，双字为 (码点1 + 1) × 码点上限 + 码点2，两者不会重叠
+_CODEPOINTS = 0x110000
+
+
+def _codepoints(text: str) -> np.ndarray:
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+
+
+def _ngram_codes(codes: np.ndarray, same_doc: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    码点序列的全部单字、双字编码
+
+    Args:
+        codes: 码点序列（多篇文档首尾相接）
+        same_doc: 相邻两个码点是否属于同一篇文档（跨文档的双字不计），None表示单篇文档
+
+    Returns:
+        (n-gram编码, 起始位置)
+    """
+    positions = [np.arange(len(codes))]
+    grams = [codes]
+    if len(codes) > 1:
+        starts = np.arange(len(codes) - 1)
+        if same_doc is not None:
+            starts = starts[same_doc]
+        positions.append(starts)
+        grams.append((codes[starts] + 1) * _CODEPOINTS + codes[starts + 1])
+    return np.concatenate(grams), np.concatenate(positions)
+
+
+# 倒排表的各个数组（快照中以 tfidf_<名称> 的数据段保存）
+POSTINGS_FIELDS = ('vocabulary', 'idf', 'offsets', 'doc_ids', 'weights')
+
+
+def build_postings(contents: List[str]) -> Dict[str, np.ndarray]:
+    """
+    为知识内容建立倒排表
+
+    Returns:
+        {n-gram编码（升序）, idf, 倒排区间起点, 文档下标, 归一化权重}
+    """
+    texts = [normalize_query(content) for content in contents]
+    total = len(texts)
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=total)
+    codes = _codepoints(''.join(texts))
+    doc_of = np.repeat(np.arange(total, dtype=np.int64), lengths)
+    grams, positions = _ngram_codes(codes, doc_of[:-1] == doc_of[1:] if len(codes) > 1 else None)
+    docs = doc_of[positions]
+
+    vocabulary, gram_ids = np.unique(grams, return_inverse=True)
+    size = len(vocabulary)
+    pairs, tf = np.unique(docs * size + gram_ids, return_counts=True)
+    doc_ids, gram_ids = pairs // size, pairs % size
+
+    doc_freq = np.bincount(gram_ids, minlength=size)
+    idf = np.log((1 + total) / (1 + doc_freq)) + 1
+    weights = (1 + np.log(tf)) * idf[gram_ids]
+    norms = np.sqrt(np.bincount(doc_ids, weights * weights, minlength=total))
+    norms[norms == 0] = 1.0
+    weights /= norms[doc_ids]
+
+    # 按n-gram排列（pairs 已按文档排序，稳定排序保持每个n-gram内文档有序）
+    order = np.argsort(gram_ids, kind='stable')
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(doc_freq, out=offsets[1:])
+
+    return {
+        'vocabulary': vocabulary,
+        'idf': idf,
+        'offsets': offsets,
+        'doc_ids': doc_ids[order].astype(np.int32),
+        'weights': weights[order].astype(np.float32),
+    }
+
+
+class TfidfFallbackRetriever:
+    """字符n-gram TF-IDF检索器"""
+
+    def __init__(self):
+        self.items: Optional[List[Dict]] = None
+        # (n-gram编码（升序）, idf, 倒排区间起点, 文档下标, 归一化权重)，整体替换，查询不会看到建了一半的索引
+        self._index: Optional[Tuple[np.ndarray, ...]] = None
+
+    def fit(self, knowledge_base: List[Dict]):
+        """
+        为知识库建立倒排索引，知识库未变化时跳过；
+        快照自带倒排表时直接使用，否则现场建立（耗时随知识库增长，应在后台线程中调用）
+
+        Args:
+            knowledge_base: 知识库列表
+        """
+        if self.items is knowledge_base:
+            return
+
+        postings = self._snapshot_postings(knowledge_base)
+        source = "从快照加载"
+        if postings is None:
+            postings = build_postings([item['content'] for item in knowledge_base])
+            source = "建立完成"
+        self._index = tuple(postings[field] for field in POSTINGS_FIELDS)
+        self.items = knowledge_base
+        logger.info(f"兜底检索索引{source}：{len(knowledge_base)}条知识，{len(postings['vocabulary'])}个n-gram")
+
+    @staticmethod
+    def _snapshot_postings(knowledge_base: List[Dict]) -> Optional[Dict[str, np.ndarray]]:
+        """快照中的倒排表（编译时的同义词设置与当前不同则不可用）"""
+        postings = getattr(knowledge_base, 'tfidf_postings', None)
+        if postings is None or getattr(knowledge_base, 'tfidf_synonyms', None) != settings.query_synonyms:
+            return None
+        return postings
+
+    def get_top_k_matches(self, query: str, knowledge_base: List[Dict], top_k: int = 3) -> List[Dict]:
+        """
+        获取最匹配的K条知识（余弦相似度）
+        使用加载时建立的索引；知识库刚重载、新索引尚未建好时暂用上一版知识库的索引
+
+        Args:
+            query: 用户查询
+            knowledge_base: 知识库列表
+            top_k: 返回前K个结果
+
+        Returns:
+            匹配的知识列表，每项带 score 和 retriever 字段
+        """
+        items, index = self.items, self._index
+        if not knowledge_base or index is None or not items:
+            return []
+        vocabulary, idf, offsets, doc_ids, doc_weights = index
+
+        text = normalize_query(query)
+        if not text:
+            return []
+        grams, _ = _ngram_codes(_codepoints(text))
+        grams, tf = np.unique(grams, return_counts=True)
+        columns = np.searchsorted(vocabulary, grams)
+        known = columns < len(vocabulary)
+        known[known] = vocabulary[columns[known]] == grams[known]
+        columns, tf = columns[known], tf[known]
+        if not len(columns):
+            return []
+
+        weights = (1 + np.log(tf)) * idf[columns]
+        weights /= np.sqrt(np.dot(weights, weights))
+
+        starts, ends = offsets[columns], offsets[columns + 1]
+        postings = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        scores = np.bincount(
+            doc_ids[postings],
+            np.repeat(weights, ends - starts) * doc_weights[postings],
+            minlength=len(items)
+        )
+
+        k = min(top_k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [
+            {**items[int(doc_index)], 'score': float(scores[doc_index]), 'retriever': 'tfidf'}
+            for doc_index in top
+        ]
@@ -0,0 +1,145 @@
+"""
+对话历史服务模块
+按会话保存多轮消息：最近若干轮原文保留，更早的轮次在后台滚动摘要，历史总长度受token上限约束
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from app.config.settings import settings
+from app.services.prompt_service import estimate_tokens
+from app.services.scheduler_service import current_priority, RequestPriority
+
+logger = logging.getLogger(__name__)
+
+
+SUMMARY_PROMPT = """请将以下健康咨询对话压缩为一段不超过200字的摘要，保留用户的身体状况、诉求和已给出的关键建议，不要添加新内容。
+
+已有摘要：
+{summary}
+
+新增对话：
+{dialogue}
+
+摘要："""
+
+ROLE_NAMES = {'user': '用户', 'assistant': '小星'}
+
+
+class ConversationHistory:
+    """单个会话的历史"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.summary = ""
+        self.messages: List[Dict] = []  # 原文保留的最近消息
+        self.last_active = time.monotonic()
+        self._pending: List[Dict] = []  # 移出窗口、尚未并入摘要的消息（并入前仍作为历史发送）
+        self._summary_task: Optional[asyncio.Task] = None
+
+    def build_messages(self, token_ceiling: int) -> List[Dict]:
+        """
+        构建发送给模型的历史消息，从最近一轮往前取，直到达到token上限
+        正在摘要的旧轮次在摘要完成前仍然参与，避免这段时间的并发请求丢失这部分上下文
+
+        Args:
+            token_ceiling: 历史部分（含摘要）的token上限
+
+        Returns:
+            user/assistant 交替的消息列表
+        """
+        remaining = token_ceiling - estimate_tokens(self.summary)
+        messages = self._pending + self.messages
+        selected = []
+        # 以完整的一问一答为单位，避免只带上半轮
+        for index in range(len(messages) - 2, -1, -2):
+            pair = messages[index:index + 2]
+            tokens = sum(estimate_tokens(message['content']) for message in pair)
+            if tokens > remaining:
+                break
+            selected[:0] = pair
+            remaining -= tokens
+        return selected
+
+    def append_turn(self, user_input: str, response: str, window_turns: int, llm):
+        """
+        追加一轮对话，超出窗口的旧轮次交给后台摘要
+
+        Args:
+            user_input: 用户输入
+            response: 助手回复
+            window_turns: 原文保留的轮数
+            llm: 用于生成摘要的大模型客户端
+        """
+        self.last_active = time.monotonic()
+        self.messages.append({'role': 'user', 'content': user_input})
+        self.messages.append({'role': 'assistant', 'content': response})
+
+        overflow = len(self.messages) - window_turns * 2
+        if overflow > 0:
+            self._pending.extend(self.messages[:overflow])
+            del self.messages[:overflow]
+            if self._summary_task is None or self._summary_task.done():
+                self._summary_task = asyncio.create_task(self._summarize(llm))
+
+    async def _summarize(self, llm):
+        """后台滚动摘要：把移出窗口的消息合并进已有摘要"""
+        # 摘要不在用户等待路径上，让位于实时请求
+        current_priority.set(RequestPriority.BATCH)
+        while self._pending:
+            # 摘要完成后才移出，期间追加的消息排在后面，下一轮再摘要
+            pending = list(self._pending)
+            dialogue = "\n".join(
+                f"{ROLE_NAMES.get(message['role'], message['role'])}：{message['content']}"
+                for message in pending
+            )
+            prompt = SUMMARY_PROMPT.format(summary=self.summary or "无", dialogue=dialogue)
+            try:
+                self.summary = (await llm.chat_async(prompt)).strip()
+                logger.info(f"会话{self.session_id}摘要已更新，长度{len(self.summary)}")
+            except Exception as e:
+                # 摘要失败时丢弃这部分旧消息，保证历史长度有界
+                logger.warning(f"会话{self.session_id}摘要失败，丢弃{len(pending)}条旧消息: {e}")
+            del self._pending[:len(pending)]
+
+
+class ConversationStore:
+    """会话历史存储（LRU + 过期淘汰）"""
+
+    def __init__(self, max_sessions: int, ttl: float):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, ConversationHistory]" = OrderedDict()
+
+    def get(self, session_id: str) -> ConversationHistory:
+        """获取会话历史，不存在时创建"""
+        self._evict()
+        history = self._sessions.get(session_id)
+        if history is None:
+            history = ConversationHistory(session_id)
+            self._sessions[session_id] = history
+        else:
+            self._sessions.move_to_end(session_id)
+        history.last_active = time.monotonic()
+        return history
+
+    def clear(self, session_id: str):
+        """删除会话历史"""
+        self._sessions.pop(session_id, None)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, history = next(iter(self._sessions.items()))
+            if len(self._sessions) < self.max_sessions and now - history.last_active < self.ttl:
+                break
+            del self._sessions[session_id]
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# 创建全局实例
+conversation_store = ConversationStore(settings.history_max_sessions, settings.history_session_ttl)
@@ -0,0 +1,421 @@
+"""
+文档入库模块
+将长篇文本/Markdown健康指南切分为带重叠的知识片段，提取关键词、去除近似重复，
+按批并发向量化（可断点续传）后写入知识库JSON
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.config.settings import settings
+from app.services.query_normalizer import normalize_query
+from app.services.segmenter_service import SENTENCE_ENDINGS, CLOSING_MARKS
+
+logger = logging.getLogger(__name__)
+
+# 关键词提取时忽略的常见虚词
+_STOPWORDS = {
+    '我们', '你们', '他们', '这些', '那些', '这个', '那个', '以及', '或者', '因为', '所以', '如果', '可以',
+    '应该', '需要', '进行', '通过', '对于', '其中', '一个', '一些', '没有', '不是', '就是', '还是', '已经',
+    '非常', '比较', '主要', '同时', '之后', '之前', '以上', '以下', '每天', '建议',
+}
+# 不能出现在关键词首尾的虚词、量词
+_EDGE_CHARS = set('的了和与及或在是为到把被等如也都就还而从对让使有很更最要会能可以应该不一个每些这那其之于以上下中时后前')
+_TERM_PATTERN = re.compile(r'[一-鿿]+|[A-Za-z][A-Za-z0-9+\-]*')
+
+_MARKDOWN_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_MARKDOWN_LIST = re.compile(r'^\s*(?:[-*+]|\d+[.)])\s+')
+_MARKDOWN_INLINE = [
+    (re.compile(r'!\[([^\]]*)\]\([^)]*\)'), r'\1'),  # 图片
+    (re.compile(r'\[([^\]]*)\]\([^)]*\)'), r'\1'),  # 链接
+    (re.compile(r'(\*\*|__|\*|_|`)'), ''),  # 强调和行内代码
+]
+
+
+class Chunk:
+    """一个待入库的知识片段"""
+
+    __slots__ = ('content', 'section', 'source', 'keywords')
+
+    def __init__(self, content: str, section: str = '', source: str = ''):
+        self.content = content
+        self.section = section  # 所在章节标题
+        self.source = source  # 来源文档
+        self.keywords: List[str] = []
+
+    @property
+    def id_hash(self) -> str:
+        """按归一化内容生成的稳定哈希，重复执行入库时同一片段得到同一个ID"""
+        return hashlib.sha1(normalize_query(self.content).encode('utf-8')).hexdigest()[:10]
+
+
+def parse_document(text: str) -> List[Tuple[str, str]]:
+    """
+    解析文本或Markdown文档为段落
+
+    Returns:
+        [(章节标题, 段落文本)]，代码块和表格分隔线被忽略
+    """
+    paragraphs = []
+    headings: List[str] = []
+    buffer: List[str] = []
+    in_code = False
+
+    def flush():
+        if buffer:
+            paragraphs.append((' / '.join(headings), ''.join(buffer)))
+            buffer.clear()
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if line.startswith('```'):
+            in_code = not in_code
+            continue
+        if in_code or re.fullmatch(r'[|:\-\s]+', line or '-'):
+            flush()
+            continue
+
+        heading = _MARKDOWN_HEADING.match(line)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            headings = headings[:level - 1] + [heading.group(2)]
+            continue
+
+        line = _MARKDOWN_LIST.sub('', line.lstrip('> '))
+        for pattern, replacement in _MARKDOWN_INLINE:
+            line = pattern.sub(replacement, line)
+        line = line.replace('|', ' ').strip()
+        if not line:
+            flush()
+            continue
+        # 列表项、独立成行的短句补上句号，避免和下一行粘成一句
+        if line[-1] not in SENTENCE_ENDINGS and line[-1] not in CLOSING_MARKS and line[-1] not in '，,、：:':
+            line += '。'
+        buffer.append(line)
+    flush()
+    return paragraphs
+
+
+def split_sentences(text: str) -> List[str]:
+    """按中文句末标点切分句子（标点和其后的闭合符号归入前一句）"""
+    sentences = []
+    start = 0
+    index = 0
+    while index < len(text):
+        if text[index] in SENTENCE_ENDINGS:
+            end = index + 1
+            while end < len(text) and (text[end] in SENTENCE_ENDINGS or text[end] in CLOSING_MARKS):
+                end += 1
+            sentence = text[start:end].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = index = end
+        else:
+            index += 1
+    rest = text[start:].strip()
+    if rest:
+        sentences.append(rest)
+    return sentences
+
+
+def chunk_sentences(sentences: List[str], max_chars: int, overlap_chars: int) -> List[str]:
+    """
+    将句子合并为不超过 max_chars 的片段，相邻片段重叠末尾不超过 overlap_chars 的完整句子
+    单句超长时按长度硬切
+    """
+    pieces = []
+    for sentence in sentences:
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if sentence:
+            pieces.append(sentence)
+
+    chunks = []
+    current: List[str] = []
+    length = 0
+    for sentence in pieces:
+        if current and length + len(sentence) > max_chars:
+            chunks.append(''.join(current))
+            # 从上一片段末尾取完整句子作为重叠
+            overlap: List[str] = []
+            overlap_length = 0
+            for previous in reversed(current):
+                if overlap_length + len(previous) > overlap_chars or overlap_length + len(previous) + len(sentence) > max_chars:
+                    break
+                overlap.insert(0, previous)
+                overlap_length += len(previous)
+            current, length = overlap, overlap_length
+        current.append(sentence)
+        length += len(sentence)
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def chunk_document(
+    text: str,
+    source: str = '',
+    max_chars: Optional[int] = None,
+    overlap_chars: Optional[int] = None,
+    min_chars: int = 20
+) -> List[Chunk]:
+    """
+    切分文档为知识片段（同一章节内的段落连续切分，不跨章节）
+
+    Args:
+        text: 文档内容（纯文本或Markdown）
+        source: 来源名称
+        max_chars: 片段最大字符数，默认取配置
+        overlap_chars: 相邻片段的重叠字符数上限，默认取配置
+        min_chars: 短于该长度的片段丢弃
+    """
+    max_chars = max_chars or settings.ingest_chunk_chars
+    overlap_chars = settings.ingest_overlap_chars if overlap_chars is None else overlap_chars
+    sections: Dict[str, List[str]] = {}
+    for section, paragraph in parse_document(text):
+        sections.setdefault(section, []).extend(split_sentences(paragraph))
+
+    chunks = []
+    for section, sentences in sections.items():
+        for content in chunk_sentences(sentences, max_chars, overlap_chars):
+            if len(content) >= min_chars:
+                chunks.append(Chunk(content=content, section=section, source=source))
+    return chunks
+
+
+def _terms(text: str) -> Iterable[Tuple[str, str, str]]:
+    """候选关键词：中文连续片段的2-4字子串、英文单词，附带左右相邻字符（片段边界为空串）"""
+    for match in _TERM_PATTERN.finditer(text):
+        run = match.group(0)
+        if run[0].isascii():
+            if len(run) > 1:
+                yield run.lower(), '', ''
+            continue
+        for size in (2, 3, 4):
+            for start in range(len(run) - size + 1):
+                end = start + size
+                yield run[start:end], run[start - 1:start], run[end:end + 1]
+
+
+def extract_keywords(
+    chunks: List[Chunk],
+    top_n: int = 5,
+    corpus: Iterable[str] = (),
+    vocabulary: Iterable[str] = ()
+):
+    """
+    为每个片段提取关键词（不依赖分词库）
+    候选词为不以虚词开头或结尾、且左右相邻字符都有变化的2-4字片段（相邻字符固定的多为更长词语的碎片），
+    已有知识的关键词（vocabulary）直接作为候选；按 TF-IDF 打分，已选词的子串或包含已选词的片段不再选
+
+    Args:
+        chunks: 知识片段，结果写入 chunk.keywords
+        top_n: 每个片段的关键词数
+        corpus: 已有知识文本（参与文档频率和相邻字符统计）
+        vocabulary: 已有知识的关键词
+    """
+    vocabulary = set(vocabulary)
+    neighbors: Dict[str, Tuple[set, set]] = {}
+    document_frequency = Counter()
+    documents = 0
+    for text in [chunk.content for chunk in chunks] + list(corpus):
+        seen = set()
+        for term, left, right in _terms(text):
+            sides = neighbors.setdefault(term, (set(), set()))
+            sides[0].add(left)
+            sides[1].add(right)
+            seen.add(term)
+        document_frequency.update(seen)
+        documents += 1
+
+    def word_like(term: str) -> bool:
+        if term in vocabulary or term.isascii():
+            return True
+        if term in _STOPWORDS or term[0] in _EDGE_CHARS or term[-1] in _EDGE_CHARS:
+            return False
+        left, right = neighbors[term]
+        return len(left) > 1 and len(right) > 1
+
+    for chunk in chunks:
+        scored = []
+        for term, count in Counter(term for term, _, _ in _terms(chunk.content)).items():
+            if not word_like(term):
+                continue
+            idf = math.log((1 + documents) / (1 + document_frequency[term])) + 1
+            # 已有关键词和较长的词优先
+            weight = 2.0 if term in vocabulary else 1.0
+            scored.append((count * idf * weight * math.sqrt(len(term)), term))
+        scored.sort(reverse=True)
+
+        keywords: List[str] = []
+        for _, term in scored:
+            if any(term in chosen or chosen in term for chosen in keywords):
+                continue
+            keywords.append(term)
+            if len(keywords) >= top_n:
+                break
+        chunk.keywords = keywords
+
+
+class NearDuplicateFilter:
+    """
+    近似重复检测：字符3-gram的MinHash + LSH分桶
+    候选对再按估计的Jaccard相似度判断，整体复杂度接近线性
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = 0.85, num_hashes: int = 64, bands: int = 16, seed: int = 1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_hashes // bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, self._PRIME, size=num_hashes, dtype=np.uint64)
+        self._b = rng.integers(0, self._PRIME, size=num_hashes, dtype=np.uint64)
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._signatures: List[np.ndarray] = []
+
+    def _signature(self, text: str) -> np.ndarray:
+        text = normalize_query(text, use_synonyms=False)
+        shingles = {text[i:i + 3] for i in range(max(1, len(text) - 2))}
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64)
+        # 随机线性哈希 a*h + b，用uint64溢出回绕代替取模
+        permuted = hashes[:, None] * self._a[None, :] + self._b[None, :]
+        return permuted.min(axis=0)
+
+    def add(self, text: str) -> bool:
+        """
+        加入一段文本
+
+        Returns:
+            False 表示与已加入的文本近似重复（未加入）
+        """
+        signature = self._signature(text)
+        keys = [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+        candidates = {index for key in keys for index in self._buckets.get(key, ())}
+        for index in candidates:
+            if np.mean(self._signatures[index] == signature) >= self.threshold:
+                return False
+
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(index)
+        return True
+
+
+def deduplicate(chunks: List[Chunk], existing: Iterable[str] = (), threshold: Optional[float] = None) -> List[Chunk]:
+    """去除与已有知识或本批前面片段近似重复的片段"""
+    dedup = NearDuplicateFilter(settings.ingest_dedup_threshold if threshold is None else threshold)
+    for text in existing:
+        dedup.add(text)
+    return [chunk for chunk in chunks if dedup.add(chunk.content)]
+
+
+async def embed_chunks(
+    chunks: List[Chunk],
+    retriever,
+    index_path: Optional[Path] = None,
+    group_size: Optional[int] = None,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> List[Chunk]:
+    """
+    分组并发向量化（每组内按批合并为上游调用，批之间并发，并发度由上游调度器控制）
+    每组完成后保存向量缓存；中断后重新执行时已完成的片段直接命中缓存，实现断点续传。
+    失败的片段不应写入知识库，否则重新执行时会被当作已有知识去重而不再向量化
+
+    Args:
+        chunks: 知识片段
+        retriever: 向量检索服务（提供 get_embeddings/has_embeddings/save_index）
+        index_path: 向量缓存保存路径
+        group_size: 每组片段数，默认为批大小的8倍
+        progress: 进度回调 (已完成数, 总数)
+
+    Returns:
+        向量化失败的片段
+    """
+    group_size = max(1, group_size or settings.ingest_embed_group_size)
+    failed = []
+    for start in range(0, len(chunks), group_size):
+        group = chunks[start:start + group_size]
+        await retriever.get_embeddings([chunk.content for chunk in group])
+        failed.extend(chunk for chunk in group if not retriever.has_embeddings([chunk.content]))
+        if index_path is not None:
+            await asyncio.to_thread(retriever.save_index, index_path)
+        if progress is not None:
+            progress(min(start + group_size, len(chunks)), len(chunks))
+    return failed
+
+
+def write_knowledge(file_path: Path, chunks: List[Chunk], id_prefix: str) -> int:
+    """
+    追加写入知识库JSON（按内容哈希生成ID，已存在的ID跳过），先写临时文件再替换
+
+    Returns:
+        新增条数
+    """
+    file_path = Path(file_path)
+    items = []
+    if file_path.exists():
+        with open(file_path, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+    existing_ids = {item.get('id') for item in items}
+
+    added = 0
+    for chunk in chunks:
+        item_id = f"{id_prefix}_{chunk.id_hash}"
+        if item_id in existing_ids:
+            continue
+        existing_ids.add(item_id)
+        items.append({
+            'id': item_id,
+            'content': chunk.content,
+            'category': chunk.section or chunk.source,
+            'keywords': chunk.keywords,
+            'source': chunk.source,
+        })
+        added += 1
+
+    if added:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = file_path.with_name(file_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        os.replace(tmp_path, file_path)
+    return added
+
+
+class ProgressReporter:
+    """按时间间隔输出进度日志"""
+
+    def __init__(self, label: str, interval: float = 2.0):
+        self.label = label
+        self.interval = interval
+        self._started = time.monotonic()
+        self._last = 0.0
+
+    def __call__(self, done: int, total: int):
+        now = time.monotonic()
+        if done < total and now - self._last < self.interval:
+            return
+        self._last = now
+        elapsed = now - self._started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        logger.info(f"{self.label}: {done}/{total}（{rate:.1f}条/秒）")
@@ -5,7 +5,11 @@
 import json
 import logging
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
+
+from app.config.settings import settings
+from app.services.knowledge_snapshot import KnowledgeSnapshot, source_signature
+from app.services.knowledge_catalog import KnowledgeCatalog
 
 logger = logging.getLogger(__name__)
 
@@ -13,12 +17,13 @@ logger = logging.getLogger(__name__)
 class KnowledgeBaseService:
     """知识库服务"""
 
-    def __init__(self, base_path: str = None):
+    def __init__(self, base_path: str = None, snapshot_path: Optional[Path] = None):
         """
         初始化知识库服务
         
         Args:
             base_path: 知识库基础路径
+            snapshot_path: 编译快照路径，默认取配置
         """
         if base_path is None:
             # 默认使用 backend/knowledge_base 目录
@@ -26,9 +31,23 @@ class KnowledgeBaseService:
             base_path = current_file.parent.parent.parent / "knowledge_base"
         
         self.base_path = Path(base_path)
+        self.snapshot_path = Path(snapshot_path or settings.knowledge_snapshot_path)
+        self.snapshot: Optional[KnowledgeSnapshot] = None
         self.knowledge_cache = {}
+        self.knowledge: List[Dict] = []  # 当前生效的知识库，由 load() 在启动时填充
+        self.catalog = KnowledgeCatalog().finalize()  # 当前知识库的统计信息
+        self._version = 0
         logger.info(f"知识库服务初始化，基础路径: {self.base_path}")
 
+    def knowledge_files(self) -> Dict[str, Path]:
+        """知识库类别和对应文件"""
+        return {
+            'nutrition': self.base_path / "nutrition" / "knowledge.json",
+            'fitness': self.base_path / "fitness" / "knowledge.json",
+            'sub_health': self.base_path / "sub_health" / "knowledge.json",
+            'general': self.base_path / "general" / "knowledge.json"
+        }
+
     def load_all_knowledge(self) -> List[Dict]:
         """
         加载所有知识库
@@ -39,21 +58,16 @@ class KnowledgeBaseService:
         all_knowledge = []
 
         try:
-            # 定义知识库类别和对应文件
-            knowledge_files = {
-                'nutrition': self.base_path / "nutrition" / "knowledge.json",
-                'fitness': self.base_path / "fitness" / "knowledge.json",
-                'sub_health': self.base_path / "sub_health" / "knowledge.json",
-                'general': self.base_path / "general" / "knowledge.json"
-            }
+            knowledge_files = self.knowledge_files()
 
             for category, file_path in knowledge_files.items():
                 if file_path.exists():
                     try:
                         with open(file_path, 'r', encoding='utf-8') as f:
                             data = json.load(f)
-                            # 为每条知识添加类别标记
+                            # 为每条知识添加类别标记，文件中原有的细分类别保留为 sub_category
                             for item in data:
+                                item['sub_category'] = item.get('category')
                                 item['category'] = category
                             all_knowledge.extend(data)
                             logger.info(f"加载{category}知识库: {len(data)}条")
@@ -69,6 +83,54 @@ class KnowledgeBaseService:
             logger.error(f"加载知识库失败: {e}")
             return []
 
+    def load(self) -> List[Dict]:
+        """
+        加载知识库并作为当前生效的知识库
+        编译快照存在且与源文件一致时直接内存映射快照，否则解析JSON
+
+        Returns:
+            知识库列表
+        """
+        self._version += 1
+        snapshot = self._open_snapshot()
+        if snapshot is not None:
+            knowledge = snapshot.items()
+            embedded = len(knowledge) if snapshot.embeddings is not None else 0
+            catalog = KnowledgeCatalog.from_aggregates(snapshot.catalog_aggregates, self._version, embedded)
+            logger.info(f"从快照加载知识库: {self.snapshot_path}，共{len(knowledge)}条")
+        else:
+            knowledge = self.load_all_knowledge()
+            catalog = KnowledgeCatalog(self._version)
+            for item in knowledge:
+                catalog.add(item)
+            catalog.finalize()
+
+        # 知识库和统计信息一起切换，统计接口不会看到不一致的中间状态
+        self.snapshot = snapshot
+        self.knowledge = knowledge
+        self.catalog = catalog
+        return self.knowledge
+
+    def _open_snapshot(self) -> Optional[KnowledgeSnapshot]:
+        """打开编译快照，不存在、损坏或已过期时返回None"""
+        if not self.snapshot_path.exists():
+            return None
+
+        try:
+            snapshot = KnowledgeSnapshot(self.snapshot_path)
+        except Exception as e:
+            logger.warning(f"知识库快照无法读取，改为解析JSON: {e}")
+            return None
+
+        if snapshot.catalog_aggregates is None:
+            logger.warning("知识库快照缺少统计信息，改为解析JSON（可执行 python -m scripts.build_snapshot 重新生成）")
+            return None
+
+        if snapshot.sources != source_signature(list(self.knowledge_files().values())):
+            logger.warning("知识库快照与源文件不一致，改为解析JSON（可执行 python -m scripts.build_snapshot 重新生成）")
+            return None
+        return snapshot
+
     def get_knowledge_by_category(self, category: str) -> List[Dict]:
         """
         获取特定类别的知识
@@ -0,0 +1,98 @@
+"""
+知识库目录模块
+在知识库加载/重载时增量累计统计信息，统计接口直接返回预先序列化的结果
+"""
+import hashlib
+import json
+from typing import Dict, Optional
+
+
+class KnowledgeCatalog:
+    """知识库目录（统计信息）"""
+
+    def __init__(self, version: int = 0):
+        """
+        Args:
+            version: 知识库索引版本，每次加载/重载递增
+        """
+        self.version = version
+        self.total = 0
+        self.categories: Dict[str, int] = {}
+        self.sub_categories: Dict[str, Dict[str, int]] = {}
+        self.total_chars = 0
+        self.embedded = 0
+        self.content_hash: Optional[str] = None
+        self._hasher = hashlib.sha256()
+        self._body: Optional[bytes] = None
+
+    def add(self, item: Dict):
+        """累计一条知识"""
+        category = item.get('category', 'unknown')
+        sub_category = item.get('sub_category') or ''
+        content = item.get('content', '')
+
+        self.total += 1
+        self.categories[category] = self.categories.get(category, 0) + 1
+        subs = self.sub_categories.setdefault(category, {})
+        subs[sub_category] = subs.get(sub_category, 0) + 1
+        self.total_chars += len(content)
+        self._hasher.update(f"{item.get('id', '')}\0{content}\0".encode('utf-8'))
+        self._body = None
+
+    def finalize(self) -> "KnowledgeCatalog":
+        """所有条目累计完成后计算内容哈希"""
+        self.content_hash = self._hasher.hexdigest()
+        self._body = None
+        return self
+
+    def set_embedded(self, count: int):
+        """更新已有向量的条目数"""
+        if count != self.embedded:
+            self.embedded = count
+            self._body = None
+
+    def aggregates(self) -> Dict:
+        """可持久化的聚合结果（写入快照头部）"""
+        return {
+            'total': self.total,
+            'categories': self.categories,
+            'sub_categories': self.sub_categories,
+            'total_chars': self.total_chars,
+            'content_hash': self.content_hash,
+        }
+
+    @classmethod
+    def from_aggregates(cls, aggregates: Dict, version: int, embedded: int = 0) -> "KnowledgeCatalog":
+        """从快照头部中预先计算的聚合结果恢复，无需遍历条目"""
+        catalog = cls(version)
+        catalog.total = aggregates['total']
+        catalog.categories = dict(aggregates['categories'])
+        catalog.sub_categories = {k: dict(v) for k, v in aggregates['sub_categories'].items()}
+        catalog.total_chars = aggregates['total_chars']
+        catalog.content_hash = aggregates['content_hash']
+        catalog.embedded = embedded
+        return catalog
+
+    @property
+    def etag(self) -> str:
+        return f'W/"v{self.version}-{(self.content_hash or "")[:16]}-{self.embedded}"'
+
+    def to_dict(self) -> Dict:
+        return {
+            'total': self.total,
+            'categories': self.categories,
+            'sub_categories': self.sub_categories,
+            'total_chars': self.total_chars,
+            'embedding_coverage': {
+                'embedded': self.embedded,
+                'ratio': round(self.embedded / self.total, 4) if self.total else 0.0,
+            },
+            'index_version': self.version,
+            'content_hash': self.content_hash,
+        }
+
+    def render(self) -> bytes:
+        """序列化后的统计结果，内容变化前一直复用"""
+        if self._body is None:
+            self._body = json.dumps(self.to_dict(), ensure_ascii=False).encode('utf-8')
+        return self._body
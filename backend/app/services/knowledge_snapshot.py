@@ -0,0 +1,275 @@
+"""
+知识库编译快照模块
+将知识条目按列存储在单个文件中（id、内容、类别、关键词偏移、归一化向量、兜底检索倒排表），
+加载时内存映射，字段按需解码，启动耗时和常驻内存不随条目数增长
+"""
+import json
+import mmap
+import struct
+import logging
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config.settings import settings
+from app.services.fallback_retriever import build_postings, POSTINGS_FIELDS
+from app.services.knowledge_catalog import KnowledgeCatalog
+from app.services.vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HAKSNAP1"
+FORMAT_VERSION = 1
+ALIGNMENT = 64  # 每个数据段按64字节对齐，便于直接映射为numpy数组
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _encode_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """将字符串列表编码为 UTF-8 字节块 + 偏移数组（n+1）"""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _encode_codes(values: List[str]) -> Tuple[np.ndarray, List[str]]:
+    """将类别列编码为 uint16 代码 + 名称表"""
+    names = sorted(set(values))
+    lookup = {name: code for code, name in enumerate(names)}
+    return np.asarray([lookup[v] for v in values], dtype=np.uint16), names
+
+
+def source_signature(paths: List[Path]) -> Dict[str, List[int]]:
+    """源文件签名（大小和修改时间），用于判断快照是否过期"""
+    signature = {}
+    for path in paths:
+        if path.exists():
+            stat = path.stat()
+            signature[f"{path.parent.name}/{path.name}"] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def write_snapshot(
+    path: Path,
+    items: List[Dict],
+    embeddings: Optional[np.ndarray] = None,
+    model: Optional[str] = None,
+    sources: Optional[Dict] = None
+) -> int:
+    """
+    写入知识库快照
+
+    Args:
+        path: 快照文件路径
+        items: 知识条目（已带 category / sub_category）
+        embeddings: 与条目一一对应的向量（可选）
+        model: 向量模型名称
+        sources: 源文件签名
+
+    Returns:
+        写入的字节数
+    """
+    ids_blob, ids_offsets = _encode_strings([str(item.get('id', '')) for item in items])
+    content_blob, content_offsets = _encode_strings([item.get('content', '') for item in items])
+    category_codes, categories = _encode_codes([item.get('category', 'unknown') for item in items])
+    sub_category_codes, sub_categories = _encode_codes([item.get('sub_category') or '' for item in items])
+
+    # 关键词：所有关键词拼成一个字符串表，每个条目记录其关键词在表中的区间
+    keyword_lists = [list(item.get('keywords', [])) for item in items]
+    keyword_blob, keyword_offsets = _encode_strings([kw for kws in keyword_lists for kw in kws])
+    item_keyword_offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    if items:
+        item_keyword_offsets[1:] = np.cumsum([len(kws) for kws in keyword_lists])
+
+    sections = {
+        'ids_blob': ids_blob,
+        'ids_offsets': ids_offsets,
+        'content_blob': content_blob,
+        'content_offsets': content_offsets,
+        'category_codes': category_codes,
+        'sub_category_codes': sub_category_codes,
+        'keyword_blob': keyword_blob,
+        'keyword_offsets': keyword_offsets,
+        'item_keyword_offsets': item_keyword_offsets,
+    }
+    if embeddings is not None:
+        sections['embeddings'] = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    # 兜底TF-IDF检索的倒排表在编译时建好，服务启动时直接映射
+    for name, array in build_postings([item.get('content', '') for item in items]).items():
+        sections[f'tfidf_{name}'] = array
+
+    layout = {}
+    offset = 0
+    for name, array in sections.items():
+        layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset = _align(offset + array.nbytes)
+
+    # 统计信息在构建时算好，加载快照时无需遍历条目
+    catalog = KnowledgeCatalog()
+    for item in items:
+        catalog.add(item)
+    catalog.finalize()
+
+    header = json.dumps({
+        'format_version': FORMAT_VERSION,
+        'count': len(items),
+        'model': model,
+        'categories': categories,
+        'sub_categories': sub_categories,
+        'sources': sources or {},
+        'tfidf_synonyms': settings.query_synonyms,
+        'catalog': catalog.aggregates(),
+        'sections': layout,
+    }, ensure_ascii=False).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in sections.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        size = f.tell()
+    tmp_path.replace(path)
+    logger.info(f"知识库快照已写入: {path}，{len(items)}条，{size}字节")
+    return size
+
+
+class KnowledgeSnapshot:
+    """内存映射的知识库快照（只读）"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"不是知识库快照文件: {self.path}")
+        header_start = len(MAGIC) + 8
+        (header_len,) = struct.unpack('<Q', self._mmap[len(MAGIC):header_start])
+        self.header = json.loads(self._mmap[header_start:header_start + header_len].decode('utf-8'))
+        if self.header.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"快照格式版本不支持: {self.header.get('format_version')}")
+
+        self._data_start = _align(header_start + header_len)
+        self._arrays = {}
+        self.count = self.header['count']
+        self.model = self.header.get('model')
+        self.categories = self.header['categories']
+        self.sub_categories = self.header['sub_categories']
+        self.sources = self.header.get('sources', {})
+        self.catalog_aggregates = self.header.get('catalog')
+        self.tfidf_synonyms = self.header.get('tfidf_synonyms')
+
+    def _array(self, name: str) -> Optional[np.ndarray]:
+        """按需映射一个数据段为numpy数组（零拷贝）"""
+        if name not in self._arrays:
+            section = self.header['sections'].get(name)
+            if section is None:
+                return None
+            shape = tuple(section['shape'])
+            self._arrays[name] = np.frombuffer(
+                self._mmap,
+                dtype=np.dtype(section['dtype']),
+                count=int(np.prod(shape)),
+                offset=self._data_start + section['offset']
+            ).reshape(shape)
+        return self._arrays[name]
+
+    def _string(self, blob: str, offsets: str, index: int) -> str:
+        offsets_array = self._array(offsets)
+        base = self._data_start + self.header['sections'][blob]['offset']
+        start, end = int(offsets_array[index]), int(offsets_array[index + 1])
+        return self._mmap[base + start:base + end].decode('utf-8')
+
+    def item_id(self, index: int) -> str:
+        return self._string('ids_blob', 'ids_offsets', index)
+
+    def content(self, index: int) -> str:
+        return self._string('content_blob', 'content_offsets', index)
+
+    def category(self, index: int) -> str:
+        return self.categories[int(self._array('category_codes')[index])]
+
+    def sub_category(self, index: int) -> str:
+        return self.sub_categories[int(self._array('sub_category_codes')[index])]
+
+    def keywords(self, index: int) -> List[str]:
+        item_offsets = self._array('item_keyword_offsets')
+        return [
+            self._string('keyword_blob', 'keyword_offsets', k)
+            for k in range(int(item_offsets[index]), int(item_offsets[index + 1]))
+        ]
+
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        """归一化后的知识向量（n × d，内存映射）"""
+        return self._array('embeddings')
+
+    @property
+    def tfidf_postings(self) -> Optional[Dict[str, np.ndarray]]:
+        """兜底检索的倒排表（内存映射；旧版本快照没有时为None）"""
+        if 'tfidf_vocabulary' not in self.header['sections']:
+            return None
+        return {field: self._array(f'tfidf_{field}') for field in POSTINGS_FIELDS}
+
+    def item(self, index: int) -> Dict:
+        """解码单条知识为字典"""
+        return {
+            'id': self.item_id(index),
+            'content': self.content(index),
+            'category': self.category(index),
+            'sub_category': self.sub_category(index),
+            'keywords': self.keywords(index),
+        }
+
+    def items(self) -> "SnapshotItems":
+        return SnapshotItems(self)
+
+
+class SnapshotItems(Sequence):
+    """
+    快照条目的只读序列视图
+    可以像知识库列表一样遍历和下标访问，条目在访问时才解码
+    """
+
+    def __init__(self, snapshot: KnowledgeSnapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.snapshot.item(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.snapshot.item(index)
+
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        return self.snapshot.embeddings
+
+    @property
+    def model(self) -> Optional[str]:
+        return self.snapshot.model
+
+    @property
+    def tfidf_postings(self) -> Optional[Dict[str, np.ndarray]]:
+        return self.snapshot.tfidf_postings
+
+    @property
+    def tfidf_synonyms(self) -> Optional[bool]:
+        return self.snapshot.tfidf_synonyms
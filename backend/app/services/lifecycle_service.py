@@ -0,0 +1,181 @@
+"""
+服务生命周期管理模块
+负责启动时加载知识库和向量索引、后台预热，以及关闭时持久化
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Optional
+
+from app.config.settings import settings
+from app.services.knowledge_base_service import knowledge_service
+from app.services.scheduler_service import current_priority, RequestPriority
+from app.services.vector_service import vector_retriever
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceLifecycle:
+    """服务生命周期"""
+
+    STARTING = "starting"
+    WARMING = "warming"
+    READY = "ready"
+    DRAINING = "draining"
+
+    def __init__(self):
+        self.status = self.STARTING
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.warmup_error: Optional[str] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+        self._preloaded = False
+        # 预fork部署时工作进程记录主进程ID：知识库重载交给主进程统一执行，关闭时不各自保存向量缓存
+        self.supervisor_pid: Optional[int] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == self.READY
+
+    def preload(self):
+        """
+        多进程部署时在fork之前由主进程调用（主进程重载知识库时再次调用）：
+        加载知识库和持久化向量，缺少的向量在主进程中一次补算，构建检索索引和兜底检索；
+        工作进程以写时复制方式共享这些只读数据，启动时不再重复加载，也不各自预热
+        """
+        self.started_at = time.time()
+        knowledge = knowledge_service.load()
+        vector_retriever.load_index(settings.knowledge_index_path)
+        vector_retriever.fallback.fit(knowledge)
+        indexed = vector_retriever.preload_index(knowledge)
+        if not indexed and settings.knowledge_warmup and knowledge:
+            asyncio.run(self._warm_up_before_fork())
+            indexed = vector_retriever.preload_index(knowledge)
+        self._update_coverage()
+        self._preloaded = True
+        logger.info(f"知识库预加载完成，共{len(knowledge)}条知识，向量索引{'已构建' if indexed else '不完整，检索时按需补算'}")
+
+    async def _warm_up_before_fork(self):
+        """主进程中预计算知识库向量并保存，结束后关闭上游连接（连接不能跨fork共用）"""
+        current_priority.set(RequestPriority.BATCH)
+        try:
+            computed = await vector_retriever.warm_up(knowledge_service.knowledge)
+            if computed:
+                vector_retriever.save_index(settings.knowledge_index_path)
+        except Exception as e:
+            self.warmup_error = str(e)
+            logger.error(f"知识库向量预热失败: {e}")
+        finally:
+            await vector_retriever.close()
+
+    async def startup(self):
+        """应用启动：加载知识库和持久化索引，按配置启动后台预热"""
+        if self._preloaded:
+            knowledge = knowledge_service.knowledge
+        else:
+            self.started_at = time.time()
+            knowledge = knowledge_service.load()
+            logger.info(f"知识库加载成功，共{len(knowledge)}条知识")
+
+            vector_retriever.load_index(settings.knowledge_index_path)
+            await asyncio.to_thread(vector_retriever.fallback.fit, knowledge)
+            self._update_coverage()
+
+        # 预加载时主进程已完成预热，工作进程不再各自向量化整个知识库
+        if settings.knowledge_warmup and knowledge and not self._preloaded:
+            self.status = self.WARMING
+            self._warmup_task = asyncio.create_task(self._warm_up())
+        else:
+            self._mark_ready()
+
+    async def _warm_up(self):
+        """后台预计算知识库向量，避免首个用户承担全部向量化开销"""
+        # 预热让位于真实用户请求
+        current_priority.set(RequestPriority.BATCH)
+        try:
+            computed = await vector_retriever.warm_up(knowledge_service.knowledge)
+            self._update_coverage()
+            if computed:
+                await asyncio.to_thread(vector_retriever.save_index, settings.knowledge_index_path)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 预热失败不影响服务，检索会在请求时按需计算向量
+            self.warmup_error = str(e)
+            logger.error(f"知识库向量预热失败: {e}")
+        if self.status == self.WARMING:
+            self._mark_ready()
+
+    def _update_coverage(self):
+        """刷新知识库目录中的向量覆盖数"""
+        knowledge_service.catalog.set_embedded(vector_retriever.embedded_count(knowledge_service.knowledge))
+
+    async def reload(self) -> dict:
+        """
+        重新加载知识库（服务保持就绪，新知识的向量在后台补算）
+        预fork部署的工作进程中改为通知主进程：主进程重新预加载后逐个替换所有工作进程，
+        避免各工作进程的知识库版本不一致
+
+        Returns:
+            新的知识库目录（通知主进程时为重载状态）
+        """
+        if self.supervisor_pid is not None:
+            os.kill(self.supervisor_pid, signal.SIGHUP)
+            logger.info(f"已通知主进程{self.supervisor_pid}重新加载知识库")
+            return {'status': 'reloading', 'version': knowledge_service.catalog.version}
+
+        await self._cancel_warmup()
+        knowledge = knowledge_service.load()
+        # 兜底检索索引在后台线程中重建，建好前查询沿用上一版索引
+        await asyncio.to_thread(vector_retriever.fallback.fit, knowledge)
+        self._update_coverage()
+        logger.info(f"知识库重新加载完成，共{len(knowledge)}条，版本{knowledge_service.catalog.version}")
+
+        if settings.knowledge_warmup and knowledge:
+            self._warmup_task = asyncio.create_task(self._warm_up())
+        return knowledge_service.catalog.to_dict()
+
+    async def _cancel_warmup(self):
+        if self._warmup_task and not self._warmup_task.done():
+            self._warmup_task.cancel()
+            try:
+                await self._warmup_task
+            except asyncio.CancelledError:
+                pass
+
+    def _mark_ready(self):
+        self.status = self.READY
+        self.ready_at = time.time()
+        logger.info(f"服务就绪，启动耗时{self.ready_at - self.started_at:.2f}秒")
+
+    def begin_drain(self):
+        """收到停止信号：就绪检查改为503，让负载均衡不再分配新请求，进行中的请求继续完成"""
+        if self.status != self.DRAINING:
+            self.status = self.DRAINING
+            logger.info("服务开始停止，等待进行中的请求完成")
+
+    async def shutdown(self):
+        """应用关闭：取消预热并持久化向量索引（预fork部署的工作进程不保存，避免多个进程写同一文件）"""
+        await self._cancel_warmup()
+        if self.supervisor_pid is not None:
+            return
+
+        try:
+            vector_retriever.save_index(settings.knowledge_index_path)
+        except Exception as e:
+            logger.error(f"保存向量索引失败: {e}")
+
+    def readiness(self) -> dict:
+        """就绪状态详情"""
+        return {
+            "ready": self.is_ready,
+            "status": self.status,
+            "knowledge_count": len(knowledge_service.knowledge),
+            "warmup_error": self.warmup_error,
+        }
+
+
+# 创建全局实例
+service_lifecycle = ServiceLifecycle()
@@ -2,43 +2,139 @@
 大模型服务模块
 集成通义千问3-VL多模态大模型
 """
-from openai import OpenAI
-from typing import Optional, AsyncGenerator
+from collections import deque
+from typing import Optional, AsyncGenerator, List, Dict
+import asyncio
 import logging
+import time
 
 from app.config.credentials import credentials_config
+from app.config.settings import settings
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.scheduler_service import (
+    upstream_scheduler,
+    Lane,
+    RequestPriority,
+    UpstreamOverloadedError,
+    current_priority,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class FirstTokenTimeoutError(Exception):
+    """首字等待超时"""
+
+
+class LatencyTracker:
+    """记录最近的首字耗时，用于计算对冲延迟"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """样本不足时返回None"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class _StreamAttempt:
+    """
+    一次流式生成尝试
+    在独立任务中读取上游流并写入队列，多个尝试可以并行竞争首字
+    """
+
+    def __init__(self, client, model: str, messages: List[Dict], hedge: bool = False):
+        self.model = model
+        self.hedge = hedge
+        self.started = time.monotonic()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run(client, messages))
+        self._getter: Optional[asyncio.Task] = None
+
+    async def _run(self, client, messages: List[Dict]):
+        try:
+            # 每个尝试各占一个生成通道槽位
+            async with upstream_scheduler.slot(Lane.GENERATION):
+                response = await client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    stream=True
+                )
+                async for chunk in response:
+                    if chunk.choices:
+                        delta_content = chunk.choices[0].delta.content
+                        if delta_content:
+                            self.queue.put_nowait(('chunk', delta_content))
+            self.queue.put_nowait(('done', None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.queue.put_nowait(('error', e))
+
+    def getter(self) -> asyncio.Task:
+        """等待下一个事件的任务（未完成时复用）"""
+        if self._getter is None or self._getter.done():
+            self._getter = asyncio.ensure_future(self.queue.get())
+        return self._getter
+
+    def take(self):
+        """取出已完成的事件"""
+        event = self._getter.result()
+        self._getter = None
+        return event
+
+    def cancel(self):
+        self.task.cancel()
+        if self._getter is not None and not self._getter.done():
+            self._getter.cancel()
+
+
 class QwenVLClient:
     """通义千问3-VL多模态大模型客户端"""
 
     def __init__(self):
-        """初始化客户端"""
-        self.client = OpenAI(
-            base_url='https://api-inference.modelscope.cn/v1',
-            api_key=credentials_config.get_modelscope_api_key()
-        )
+        """初始化客户端（OpenAI SDK客户端在首次调用时才创建）"""
+        self._async_client = None
         self.model = 'Qwen/Qwen3-VL-235B-A22B-Instruct'
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latency: Dict[str, LatencyTracker] = {}
+        self.hedged_requests = 0
+        self.hedge_wins = 0
         logger.info("QwenVL客户端初始化完成")
 
-    def chat_with_image(
-        self,
+    @property
+    def async_client(self):
+        """
+        异步客户端（延迟创建）
+        请求期间不阻塞事件循环，调度器的并发控制才有意义
+        """
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(
+                base_url='https://api-inference.modelscope.cn/v1',
+                api_key=credentials_config.get_modelscope_api_key(),
+                timeout=settings.llm_request_timeout,
+                # 不使用SDK内部重试：429/5xx立即交给调度器（自适应并发）和熔断器处理
+                max_retries=0
+            )
+        return self._async_client
+
+    @staticmethod
+    def _build_messages(
         text: str,
         image_url: Optional[str] = None,
-        stream: bool = True
-    ):
+        system_prompt: Optional[str] = None,
+        history: Optional[List[Dict]] = None
+    ) -> List[Dict]:
         """
-        多模态对话
-
-        Args:
-            text: 输入文本
-            image_url: 图片URL（可选）
-            stream: 是否使用流式输出
-
-        Returns:
-            响应结果
+        构建消息数组：system + 历史轮次 + 本轮用户消息（可带图片）
         """
         content = [{'type': 'text', 'text': text}]
 
@@ -48,16 +144,39 @@ class QwenVLClient:
                 'image_url': {'url': image_url}
             })
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{'role': 'user', 'content': content}],
-                stream=stream
-            )
+        messages = []
+        if system_prompt:
+            messages.append({'role': 'system', 'content': system_prompt})
+        if history:
+            messages.extend(history)
+        messages.append({'role': 'user', 'content': content})
+        return messages
+
+    async def chat_async(
+        self,
+        text: str,
+        image_url: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        history: Optional[List[Dict]] = None
+    ) -> str:
+        """
+        异步非流式对话（受上游调度器控制）
+        内部同样走流式调用，以便应用首字超时、对冲请求和熔断降级
+
+        Args:
+            text: 本轮用户输入
+            image_url: 图片URL（可选）
+            system_prompt: 系统消息（可选）
+            history: 此前的 user/assistant 消息（可选）
 
-            if stream:
-                return response
-            return response.choices[0].message.content
+        Returns:
+            完整响应文本
+        """
+        messages = self._build_messages(text, image_url, system_prompt, history)
+
+        try:
+            parts = [piece async for piece in self._resilient_stream(messages)]
+            return "".join(parts)
 
         except Exception as e:
             logger.error(f"LLM调用失败: {e}")
@@ -66,42 +185,35 @@ class QwenVLClient:
     async def chat_stream_async(
         self,
         text: str,
-        image_url: Optional[str] = None
+        image_url: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        history: Optional[List[Dict]] = None
     ) -> AsyncGenerator[str, None]:
         """
         异步流式对话
 
         Args:
-            text: 输入文本
+            text: 本轮用户输入
             image_url: 图片URL（可选）
+            system_prompt: 系统消息（可选）
+            history: 此前的 user/assistant 消息（可选）
 
         Yields:
             响应文本片段
         """
-        content = [{'type': 'text', 'text': text}]
-
-        if image_url:
-            content.append({
-                'type': 'image_url',
-                'image_url': {'url': image_url}
-            })
+        messages = self._build_messages(text, image_url, system_prompt, history)
 
         try:
             logger.info(f"[LLM] 开始流式调用: {text[:50]}...")
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{'role': 'user', 'content': content}],
-                stream=True
-            )
-
             chunk_count = 0
-            for chunk in response:
-                if chunk.choices:
-                    delta_content = chunk.choices[0].delta.content
-                    if delta_content:
-                        chunk_count += 1
-                        logger.debug(f"[LLM] 发送chunk #{chunk_count}: '{delta_content}'")
-                        yield delta_content
+            async for delta_content in self._resilient_stream(messages):
+                chunk_count += 1
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "[LLM] 发送chunk #%d: '%s'", chunk_count, delta_content,
+                        extra={'sample_key': 'chunk'}
+                    )
+                yield delta_content
 
             logger.info(f"[LLM] 流式调用完成，共发送{chunk_count}个chunk")
 
@@ -109,6 +221,175 @@ class QwenVLClient:
             logger.error(f"LLM流式调用失败: {e}")
             raise
 
+    def _endpoints(self) -> List[str]:
+        """按优先顺序排列的可用模型：主模型 + 备用模型"""
+        models = [self.model]
+        if settings.llm_fallback_model and settings.llm_fallback_model != self.model:
+            models.append(settings.llm_fallback_model)
+        return models
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        """每个模型端点一个熔断器"""
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(
+                f'llm:{model}',
+                slow_call_seconds=settings.llm_slow_first_token_seconds,
+                open_seconds=settings.llm_breaker_open_seconds
+            )
+            self.latency[model] = LatencyTracker()
+        return self.breakers[model]
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        """首字等待超过该时间时发出对冲请求；不对冲时返回None"""
+        if not settings.llm_hedge_enabled or current_priority.get() >= RequestPriority.BATCH:
+            return None
+        p95 = self.latency[model].percentile(0.95)
+        if p95 is None:
+            p95 = settings.llm_hedge_initial_delay
+        return max(settings.llm_hedge_min_delay, p95)
+
+    async def _resilient_stream(self, messages: List[Dict]) -> AsyncGenerator[str, None]:
+        """
+        带熔断、对冲和降级的流式生成
+        首字返回之前的失败或超时会依次尝试下一个模型端点；首字返回之后的错误直接抛出
+
+        Raises:
+            UpstreamOverloadedError: 所有端点均已熔断，或调度器拒绝
+        """
+        last_error: Optional[Exception] = None
+        for model in self._endpoints():
+            breaker = self._breaker(model)
+            if not breaker.allow():
+                logger.warning(f"[LLM] 模型{model}已熔断，跳过")
+                continue
+
+            emitted = False
+            try:
+                async for piece in self._stream_from(model, messages, breaker):
+                    emitted = True
+                    yield piece
+                return
+            except UpstreamOverloadedError:
+                # 调度器排队超时或上游429：换模型也要排同一个通道，直接交给上层
+                breaker.release_probe()
+                raise
+            except (asyncio.CancelledError, GeneratorExit):
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                if emitted:
+                    raise
+                breaker.record_failure()
+                last_error = e
+                logger.warning(f"[LLM] 模型{model}首字前失败，尝试下一个端点: {e!r}")
+
+        if last_error is not None:
+            raise last_error
+        retry_after = min(self._breaker(model).retry_after() for model in self._endpoints())
+        raise UpstreamOverloadedError("大模型服务暂不可用，请稍后重试", retry_after=retry_after)
+
+    async def _stream_from(
+        self,
+        model: str,
+        messages: List[Dict],
+        breaker: CircuitBreaker
+    ) -> AsyncGenerator[str, None]:
+        """
+        向单个模型端点发起流式调用
+        首字超过对冲延迟仍未返回时（通道有空闲）再发一个相同请求，先返回首字的胜出，另一个取消；
+        超过首字超时则放弃
+
+        Raises:
+            FirstTokenTimeoutError: 首字超时
+        """
+        attempts = [_StreamAttempt(self.async_client, model, messages)]
+        start = time.monotonic()
+        deadline = start + settings.llm_first_token_timeout
+        hedge_delay = self._hedge_delay(model)
+        hedge_at = start + hedge_delay if hedge_delay is not None else None
+        winner = None
+        first = None
+        last_error: Optional[Exception] = None
+
+        try:
+            # 1. 等待首字（必要时发出对冲请求）
+            while winner is None:
+                wake = deadline if hedge_at is None else min(deadline, hedge_at)
+                getters = {attempt.getter(): attempt for attempt in attempts}
+                done, _ = await asyncio.wait(
+                    getters,
+                    timeout=max(0.0, wake - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+
+                for getter in done:
+                    attempt = getters[getter]
+                    kind, value = attempt.take()
+                    if kind == 'error':
+                        attempts.remove(attempt)
+                        last_error = value
+                        continue
+                    winner, first = attempt, value
+                    break
+
+                if winner is not None:
+                    break
+                if not attempts:
+                    raise last_error
+                now = time.monotonic()
+                if now >= deadline:
+                    raise FirstTokenTimeoutError(
+                        f"模型{model}首字超时（{settings.llm_first_token_timeout:g}秒）"
+                    )
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if upstream_scheduler.has_spare_capacity(Lane.GENERATION):
+                        logger.info(f"[LLM] 首字等待超过{hedge_delay:.1f}秒，发出对冲请求")
+                        self.hedged_requests += 1
+                        attempts.append(_StreamAttempt(self.async_client, model, messages, hedge=True))
+
+            # 2. 胜出者确定，取消其余请求
+            ttft = time.monotonic() - winner.started
+            self.latency[model].record(ttft)
+            breaker.record_success(ttft)
+            if winner.hedge:
+                self.hedge_wins += 1
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+
+            # 3. 继续输出胜出者的后续内容
+            if first is None:
+                return
+            yield first
+            while True:
+                kind, value = await winner.queue.get()
+                if kind == 'chunk':
+                    yield value
+                elif kind == 'done':
+                    return
+                else:
+                    raise value
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def stats(self) -> dict:
+        """生成服务状态：各端点熔断器、首字耗时P95、对冲次数"""
+        endpoints = {}
+        for model in self._endpoints():
+            breaker = self._breaker(model)
+            p95 = self.latency[model].percentile(0.95)
+            endpoints[model] = {
+                **breaker.stats(),
+                'first_token_p95': round(p95, 3) if p95 is not None else None
+            }
+        return {
+            'endpoints': endpoints,
+            'hedged_requests': self.hedged_requests,
+            'hedge_wins': self.hedge_wins
+        }
+
 
 # 创建全局实例
 qwen_client = QwenVLClient()
@@ -0,0 +1,230 @@
+"""
+在线诊断模块
+运行中的服务按需开启采样式CPU剖析、tracemalloc内存快照对比，并持续监测事件循环延迟
+"""
+import asyncio
+import linecache
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+from app.config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusyError(Exception):
+    """已有剖析任务在运行"""
+
+
+class SamplingProfiler:
+    """
+    采样式CPU剖析器
+    后台线程定时读取目标线程（默认为事件循环所在线程）的调用栈，
+    输出折叠栈格式（每行 "帧1;帧2;... 次数"），可直接用 flamegraph.pl / speedscope 生成火焰图
+    """
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._started_at = 0.0
+        self._target_threads: Optional[set] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, interval: float = 0.005, all_threads: bool = False):
+        """
+        开始采样，seconds 秒后自动停止
+
+        Args:
+            seconds: 最长采样时间
+            interval: 采样间隔（秒）
+            all_threads: 是否采样所有线程（默认只采样调用方所在线程，即事件循环线程）
+
+        Raises:
+            ProfilerBusyError: 已在采样中
+        """
+        if self.running:
+            raise ProfilerBusyError("CPU剖析正在进行中")
+        self._stop.clear()
+        self._stacks = Counter()
+        self._samples = 0
+        self._started_at = time.monotonic()
+        self._target_threads = None if all_threads else {threading.get_ident()}
+        self._thread = threading.Thread(
+            target=self._run, args=(seconds, interval), name='cpu-profiler', daemon=True
+        )
+        self._thread.start()
+        logger.info(f"CPU剖析开始：最长{seconds}秒，采样间隔{interval * 1000:.1f}毫秒")
+
+    def stop(self) -> Dict:
+        """停止采样并返回结果"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.result()
+
+    def result(self) -> Dict:
+        folded = "\n".join(f"{stack} {count}" for stack, count in self._stacks.most_common())
+        return {
+            'samples': self._samples,
+            'duration': round(time.monotonic() - self._started_at, 3) if self._started_at else 0.0,
+            'folded': folded,
+        }
+
+    def _run(self, seconds: float, interval: float):
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if self._target_threads is not None and thread_id not in self._target_threads:
+                    continue
+                self._stacks[self._fold(frame)] += 1
+            self._samples += 1
+            self._stop.wait(interval)
+
+    @staticmethod
+    def _fold(frame) -> str:
+        """调用栈转换为 根;...;叶 格式"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+
+class MemoryProfiler:
+    """tracemalloc内存快照，每次快照与上一次对比"""
+
+    def __init__(self):
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        """开始跟踪内存分配（有额外开销，诊断完成后应停止）"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._previous = None
+            logger.info(f"tracemalloc已开启（保留{frames}层调用栈）")
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("tracemalloc已关闭")
+        self._previous = None
+
+    def snapshot(self, limit: int = 20, group_by: str = 'lineno') -> Dict:
+        """
+        拍摄快照，返回占用最多的分配位置，以及与上一次快照相比增长最多的位置
+
+        Raises:
+            RuntimeError: 尚未开启跟踪
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc未开启")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'top': [self._stat(stat) for stat in snapshot.statistics(group_by)[:limit]],
+            'diff': None,
+        }
+        if self._previous is not None:
+            result['diff'] = [
+                self._stat(stat) for stat in snapshot.compare_to(self._previous, group_by)[:limit]
+            ]
+        self._previous = snapshot
+        return result
+
+    @staticmethod
+    def _stat(stat) -> Dict:
+        frame = stat.traceback[0]
+        entry = {
+            'location': f"{frame.filename}:{frame.lineno}",
+            'size': stat.size,
+            'count': stat.count,
+        }
+        if hasattr(stat, 'size_diff'):
+            entry['size_diff'] = stat.size_diff
+            entry['count_diff'] = stat.count_diff
+        return entry
+
+
+class LoopLagMonitor:
+    """
+    事件循环延迟监测
+    定时休眠一个固定间隔，实际唤醒时间超出的部分即为事件循环被阻塞的时间
+    """
+
+    def __init__(self, interval: float = 0.1, window: int = 600):
+        self.interval = interval
+        self._lags = deque(maxlen=window)
+        self._max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self._lags.append(lag)
+            self._max_lag = max(self._max_lag, lag)
+
+    def stats(self) -> Dict:
+        """最近一个窗口内的延迟统计（毫秒）"""
+        lags: List[float] = sorted(self._lags)
+        if not lags:
+            return {'samples': 0}
+
+        def percentile(p: float) -> float:
+            return round(lags[min(len(lags) - 1, int(len(lags) * p))] * 1000, 2)
+
+        return {
+            'samples': len(lags),
+            'interval_ms': self.interval * 1000,
+            'avg_ms': round(sum(lags) / len(lags) * 1000, 2),
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+            'window_max_ms': round(lags[-1] * 1000, 2),
+            'max_ms': round(self._max_lag * 1000, 2),
+        }
+
+
+# 创建全局实例
+cpu_profiler = SamplingProfiler()
+memory_profiler = MemoryProfiler()
+loop_lag_monitor = LoopLagMonitor(settings.loop_lag_interval)
@@ -0,0 +1,157 @@
+"""
+Prompt构建服务模块
+系统提示词模板预编译，检索知识按token预算去重和裁剪
+"""
+import logging
+from typing import List
+
+from app.config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+# 系统提示词的静态前缀，模块加载时构建一次
+SYSTEM_PROMPT = """你是企业健康咨询助手"小星"，负责为员工提供专业的健康咨询服务。
+
+你的服务范围：
+1. 营养膳食建议 - 分析食物营养成分，推荐健康饮食方案
+2. 健身计划指导 - 根据身体状况制定运动计划
+3. 亚健康调理咨询 - 提供专业的亚健康状态调理建议
+4. 健康知识普及 - 解答各种健康相关问题
+
+回答要求：
+- 专业、友善、实用
+- 基于科学依据，避免提供不实信息
+- 如果不确定，建议咨询专业医生
+- 回答简洁明了，避免过于冗长
+"""
+
+CONTEXT_HEADER = "\n相关知识库内容：\n"
+SUMMARY_HEADER = "\n此前对话摘要：\n"
+IMAGE_HINT = "\n注意：用户上传了一张图片，请结合图片内容回答。"
+QUESTION_TEMPLATE = "用户问题：{user_input}\n\n请提供专业建议："
+
+# 剩余预算不足该值时不再截断放入文档，避免塞入无意义的片段
+MIN_TRUNCATED_TOKENS = 32
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的token数
+    中文等非ASCII字符按每字1个token计，ASCII按每4个字符1个token计
+    """
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    ascii_count = len(text) - non_ascii
+    return non_ascii + (ascii_count + 3) // 4
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """按估算token数截断文本"""
+    used = 0
+    for index, ch in enumerate(text):
+        used += 1 if ord(ch) > 127 else 0.25
+        if used > max_tokens:
+            return text[:index] + "…"
+    return text
+
+
+def _dedupe_key(text: str) -> str:
+    """去重用的归一化文本：去掉空白"""
+    return "".join(text.split())
+
+
+class ContextPacker:
+    """按token预算打包检索到的知识"""
+
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+
+    def pack(self, docs: List[str]) -> List[str]:
+        """
+        按检索排序依次放入知识，去掉重复或被包含的条目，超出预算时截断或丢弃
+
+        Args:
+            docs: 按相关度排序的知识文本
+
+        Returns:
+            打包后的知识文本
+        """
+        packed = []
+        packed_keys = []
+        remaining = self.token_budget
+
+        for doc in docs:
+            key = _dedupe_key(doc)
+            if not key:
+                continue
+            # 完全重复或与已选条目互相包含的知识只保留排名靠前的一条
+            if any(key in existing or existing in key for existing in packed_keys):
+                continue
+
+            tokens = estimate_tokens(doc)
+            if tokens <= remaining:
+                packed.append(doc)
+                packed_keys.append(key)
+                remaining -= tokens
+            elif remaining >= MIN_TRUNCATED_TOKENS:
+                packed.append(_truncate_to_tokens(doc, remaining))
+                packed_keys.append(key)
+                remaining = 0
+
+            if remaining <= 0:
+                break
+
+        if len(packed) < len(docs):
+            logger.info(f"知识打包：{len(docs)}条中保留{len(packed)}条，预算{self.token_budget} token")
+        return packed
+
+
+class PromptTemplate:
+    """预编译的对话Prompt模板"""
+
+    def __init__(self, context_packer: ContextPacker):
+        self.system_prompt = SYSTEM_PROMPT
+        self.context_packer = context_packer
+
+    def render_system(
+        self,
+        relevant_docs: List[str],
+        has_image: bool,
+        summary: str = ""
+    ) -> str:
+        """
+        渲染系统消息
+
+        Args:
+            relevant_docs: 按相关度排序的检索知识
+            has_image: 用户是否上传了图片
+            summary: 此前对话的滚动摘要
+
+        Returns:
+            系统消息文本
+        """
+        parts = [self.system_prompt]
+
+        docs = self.context_packer.pack(relevant_docs) if relevant_docs else []
+        if docs:
+            parts.append(CONTEXT_HEADER)
+            parts.append("\n".join(docs))
+            parts.append("\n")
+
+        if summary:
+            parts.append(SUMMARY_HEADER)
+            parts.append(summary)
+            parts.append("\n")
+
+        if has_image:
+            parts.append(IMAGE_HINT)
+
+        return "".join(parts)
+
+    def render_user(self, user_input: str) -> str:
+        """渲染本轮用户消息"""
+        return QUESTION_TEMPLATE.format(user_input=user_input)
+
+
+# 创建全局实例
+prompt_template = PromptTemplate(ContextPacker(settings.prompt_context_token_budget))
@@ -0,0 +1,109 @@
+"""
+查询归一化模块
+将用户问题规整为缓存键：全角转半角、去除标点和空白、繁体转简体，可选同义词映射
+数值中的标点（小数点、分数线、时间冒号、负号、百分号）保留，“血糖6.1”与“血糖61”不会共用缓存
+向量缓存和回答缓存共用同一套规则，使“失眠怎么办？”“失眠怎么办”“ 失眠怎么办 ”命中同一条缓存
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+from app.config.settings import settings
+
+
+# 常见繁体字到简体字（覆盖健康咨询中的高频用字）
+_TRADITIONAL_TO_SIMPLIFIED = str.maketrans({
+    '體': '体', '營': '营', '養': '养', '飲': '饮', '運': '运', '動': '动', '頭': '头',
+    '壓': '压', '藥': '药', '醫': '医', '這': '这', '麼': '么', '辦': '办', '減': '减',
+    '經': '经', '頸': '颈', '勞': '劳', '憂': '忧', '鬱': '郁', '慮': '虑', '發': '发',
+    '髮': '发', '脫': '脱', '喫': '吃', '飯': '饭', '質': '质', '維': '维', '鈣': '钙',
+    '鐵': '铁', '鹽': '盐', '膽': '胆', '狀': '状', '調': '调', '檢': '检', '測': '测',
+    '嗎': '吗', '們': '们', '為': '为', '個': '个', '與': '与', '後': '后', '時': '时',
+    '長': '长', '間': '间', '會': '会', '應': '应', '該': '该', '對': '对', '還': '还',
+    '說': '说', '請': '请', '問': '问', '題': '题', '氣': '气', '熱': '热', '涼': '凉',
+    '飽': '饱', '餓': '饿', '鍛': '锻', '鍊': '炼', '練': '练', '訓': '训', '無': '无',
+    '沒': '没', '覺': '觉', '夢': '梦', '腦': '脑', '臟': '脏', '腸': '肠', '緊': '紧',
+    '張': '张', '靜': '静', '樂': '乐', '歲': '岁', '兒': '儿', '婦': '妇', '嬰': '婴',
+    '見': '见', '聽': '听', '視': '视', '齒': '齿', '膚': '肤', '癢': '痒', '過': '过',
+    '節': '节', '關': '关', '風': '风', '濕': '湿', '脈': '脉', '腫': '肿', '傷': '伤',
+    '療': '疗', '診': '诊', '斷': '断', '專': '专', '業': '业', '議': '议', '準': '准',
+    '確': '确', '實': '实', '難': '难', '變': '变', '輕': '轻', '帶': '带', '歡': '欢',
+    '愛': '爱', '隨': '随', '邊': '边', '陽': '阳', '陰': '阴', '魚': '鱼', '雞': '鸡',
+    '豬': '猪', '麵': '面', '湯': '汤', '燒': '烧', '糧': '粮', '穀': '谷', '麥': '麦',
+    '類': '类', '種': '种', '適': '适', '當': '当', '選': '选', '擇': '择', '從': '从',
+    '開': '开', '癥': '症', '蔔': '卜', '蘿': '萝', '脹': '胀', '嘔': '呕', '瘧': '疟',
+    '瘍': '疡', '燈': '灯', '電': '电', '話': '话', '讓': '让', '幫': '帮', '總': '总',
+    '膩': '腻', '鮮': '鲜', '蝦': '虾', '蔥': '葱', '薑': '姜', '蘋': '苹', '鳳': '凤',
+})
+
+# 同义词映射：把常见的口语说法规整为知识库中的标准说法（按键长度降序替换）
+_SYNONYMS = {
+    '睡不着觉': '失眠',
+    '睡不着': '失眠',
+    '睡不好': '失眠',
+    '失眠症': '失眠',
+    '瘦身': '减肥',
+    '减重': '减肥',
+    '降体重': '减肥',
+    '血压高': '高血压',
+    '血糖高': '高血糖',
+    '颈椎病': '颈椎疼',
+    '脖子疼': '颈椎疼',
+    '老是累': '疲劳',
+    '总是累': '疲劳',
+    '没精神': '疲劳',
+    '怎么办才好': '怎么办',
+    '如何是好': '怎么办',
+}
+_SYNONYM_ITEMS = sorted(_SYNONYMS.items(), key=lambda kv: len(kv[0]), reverse=True)
+
+
+# 属于数值的标点：数字之间的 . / : -，数字前的负号，数字后的百分号
+_NUMERIC_PUNCTUATION = re.compile(r'(?<=\d)[./:\-](?=\d)|-(?=\d)|(?<=\d)%')
+
+
+def _is_removable(ch: str) -> bool:
+    """标点和空白不影响语义，不参与缓存键"""
+    return ch.isspace() or unicodedata.category(ch)[0] in ('P', 'Z')
+
+
+def _strip_punctuation(text: str) -> str:
+    """去除标点和空白，保留数值中的标点"""
+    parts = []
+    last = 0
+    for match in _NUMERIC_PUNCTUATION.finditer(text):
+        parts.extend(ch for ch in text[last:match.start()] if not _is_removable(ch))
+        parts.append(match.group())
+        last = match.end()
+    parts.extend(ch for ch in text[last:] if not _is_removable(ch))
+    return "".join(parts)
+
+
+@lru_cache(maxsize=8192)
+def _normalize(text: str, use_synonyms: bool) -> str:
+    # NFKC：全角字母、数字、标点折叠为半角
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = text.translate(_TRADITIONAL_TO_SIMPLIFIED)
+    text = _strip_punctuation(text)
+    if use_synonyms:
+        for source, target in _SYNONYM_ITEMS:
+            if source in text:
+                text = text.replace(source, target)
+    return text
+
+
+def normalize_query(text: str, use_synonyms: bool = None) -> str:
+    """
+    生成文本的归一化缓存键
+
+    Args:
+        text: 原始文本
+        use_synonyms: 是否应用同义词映射，默认取配置 QUERY_SYNONYMS
+
+    Returns:
+        归一化后的文本；全部由标点空白组成时返回去除首尾空白的原文，避免不同输入撞到空键
+    """
+    if use_synonyms is None:
+        use_synonyms = settings.query_synonyms
+    normalized = _normalize(text, use_synonyms)
+    return normalized or text.strip()
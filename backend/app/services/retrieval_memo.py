@@ -0,0 +1,115 @@
+"""
+检索结果缓存模块
+按归一化查询缓存最终检索结果（知识ID、分数、相关知识文本和前端展示用的 vector_search），
+重复的热门问题不再打分、排序和构建展示信息；知识库版本变化时整体失效
+"""
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from app.config.settings import settings
+from app.services.query_normalizer import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class MemoEntry:
+    """一条缓存的检索结果（vector_search 在多个响应间共享，使用方不应修改）"""
+
+    __slots__ = ('ids', 'scores', 'relevant_docs', 'vector_search')
+
+    def __init__(
+        self,
+        ids: Tuple[str, ...],
+        scores: Tuple[float, ...],
+        relevant_docs: Tuple[str, ...],
+        vector_search: Optional[Dict]
+    ):
+        self.ids = ids
+        self.scores = scores
+        self.relevant_docs = relevant_docs
+        self.vector_search = vector_search
+
+
+class RetrievalMemo:
+    """检索结果缓存（LRU，键为 top_k + 归一化查询，按知识库版本失效）"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, MemoEntry]" = OrderedDict()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def _key(query: str, top_k: int) -> str:
+        return f"{top_k}:{normalize_query(query)}"
+
+    def _sync_version(self, version: int) -> bool:
+        """切换到新版本时清空缓存；version 早于当前版本（重载前开始的检索）时返回False"""
+        if version < self._version:
+            return False
+        if version > self._version:
+            if self._entries:
+                logger.info(f"知识库版本变为{version}，清空检索结果缓存{len(self._entries)}条")
+            self._entries.clear()
+            self._version = version
+        return True
+
+    def get(self, query: str, top_k: int, version: int) -> Optional[MemoEntry]:
+        """查询缓存，未命中时返回None"""
+        if not self.enabled or not self._sync_version(version):
+            return None
+        key = self._key(query, top_k)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(
+        self,
+        query: str,
+        top_k: int,
+        version: int,
+        matches: List[Dict],
+        relevant_docs: List[str],
+        vector_search: Optional[Dict]
+    ):
+        """写入一次检索的最终结果（未达到相似度阈值时 relevant_docs 为空、vector_search 为None）"""
+        if not self.enabled or not self._sync_version(version):
+            return
+        self._entries[self._key(query, top_k)] = MemoEntry(
+            tuple(m.get('id') for m in matches),
+            tuple(float(m.get('score', 0)) for m in matches),
+            tuple(relevant_docs),
+            vector_search
+        )
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'version': self._version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# 创建全局实例
+retrieval_memo = RetrievalMemo(settings.retrieval_memo_size)
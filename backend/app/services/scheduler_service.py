@@ -0,0 +1,290 @@
+"""
+上游调度服务模块
+对ModelScope上游调用（向量化、Qwen3-VL生成）做自适应并发控制、优先级排队和过载保护
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from enum import Enum, IntEnum
+from typing import AsyncIterator, Optional
+
+from app.config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Lane(Enum):
+    """上游调用通道"""
+    EMBEDDING = "embedding"  # 向量化调用（便宜、快）
+    GENERATION = "generation"  # 大模型生成调用（昂贵、慢）
+
+
+class RequestPriority(IntEnum):
+    """请求优先级，数值越小越优先"""
+    STREAMING = 0  # 流式对话，用户正在等待首字
+    INTERACTIVE = 1  # 普通对话
+    BATCH = 2  # 批量/离线任务
+
+
+# 当前请求的优先级，由API层在进入请求时设置
+current_priority: ContextVar[RequestPriority] = ContextVar(
+    'current_priority', default=RequestPriority.INTERACTIVE
+)
+
+
+class UpstreamOverloadedError(Exception):
+    """上游过载，请求被拒绝（对应HTTP 503）"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """判断异常是否为上游限流（HTTP 429）"""
+    return getattr(exc, 'status_code', None) == 429
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD自适应并发上限
+    成功时加性增长（每个完整窗口+1），遇到限流时乘性下降
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        backoff_factor: float = 0.5
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.backoff_factor = backoff_factor
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+
+    @property
+    def limit(self) -> int:
+        """当前允许的并发数"""
+        return int(self._limit)
+
+    def on_success(self):
+        """调用成功，加性增长"""
+        self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+
+    def on_overload(self):
+        """上游限流，乘性下降"""
+        previous = self.limit
+        self._limit = max(self.min_limit, self._limit * self.backoff_factor)
+        if self.limit != previous:
+            logger.warning(f"上游限流，并发上限 {previous} -> {self.limit}")
+
+
+class UpstreamLane:
+    """单个调用通道：并发上限 + 优先级等待队列"""
+
+    def __init__(
+        self,
+        name: str,
+        limiter: AdaptiveConcurrencyLimiter,
+        max_queue: int,
+        max_wait: float
+    ):
+        self.name = name
+        self.limiter = limiter
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.queued = 0
+        self.avg_latency = 1.0  # 调用耗时的指数移动平均（秒）
+        self.rejected = 0
+        self._waiters = []  # (priority, seq, future) 最小堆
+        self._seq = itertools.count()
+
+    def retry_after(self) -> int:
+        """按当前排队长度估算客户端应等待的秒数"""
+        backlog = self.queued + self.in_flight + 1
+        return max(1, math.ceil(self.avg_latency * backlog / max(1, self.limiter.limit)))
+
+    def has_capacity(self) -> bool:
+        """是否还能接纳新请求（有空闲并发或队列未满）"""
+        return self.in_flight < self.limiter.limit or self.queued < self.max_queue
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise UpstreamOverloadedError(
+            f"上游{self.name}通道繁忙（{reason}），请稍后重试",
+            retry_after=self.retry_after()
+        )
+
+    async def acquire(self, priority: RequestPriority):
+        """获取一个并发槽位，必要时按优先级排队"""
+        if self.in_flight < self.limiter.limit and self.queued == 0:
+            self.in_flight += 1
+            return
+
+        if self.queued >= self.max_queue and not self._evict_lower(priority):
+            self._reject("队列已满")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._seq), future))
+        self.queued += 1
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+
+        if not done:
+            self._abandon(future)
+            self._reject("排队超时")
+        # 排队期间被更高优先级的请求挤出时抛出 UpstreamOverloadedError
+        future.result()
+
+    def _evict_lower(self, priority: RequestPriority) -> bool:
+        """
+        队列已满时挤出优先级最低（同优先级中最晚入队）的等待者，为更高优先级的请求腾出位置
+
+        Returns:
+            是否挤出了等待者（没有比 priority 更低的等待者时返回False）
+        """
+        waiting = [waiter for waiter in self._waiters if not waiter[2].done()]
+        if not waiting:
+            return False
+        lowest, _, future = max(waiting, key=lambda waiter: (waiter[0], waiter[1]))
+        if lowest <= int(priority):
+            return False
+        self.queued -= 1
+        self.rejected += 1
+        future.set_exception(UpstreamOverloadedError(
+            f"上游{self.name}通道繁忙（让位于更高优先级请求），请稍后重试",
+            retry_after=self.retry_after()
+        ))
+        return True
+
+    def _abandon(self, future: asyncio.Future):
+        """放弃排队；如果槽位已分配则归还"""
+        if future.done() and not future.cancelled():
+            if future.exception() is None:
+                self.release()
+        elif not future.done():
+            future.cancel()
+            self.queued -= 1
+
+    def release(self):
+        """归还槽位并唤醒等待者"""
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limiter.limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.queued -= 1
+            self.in_flight += 1
+            future.set_result(True)
+
+    def record_latency(self, seconds: float):
+        self.avg_latency = 0.8 * self.avg_latency + 0.2 * seconds
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limiter.limit,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'avg_latency': round(self.avg_latency, 3)
+        }
+
+
+class UpstreamScheduler:
+    """上游调度器"""
+
+    def __init__(self):
+        self.lanes = {
+            Lane.EMBEDDING: UpstreamLane(
+                Lane.EMBEDDING.value,
+                AdaptiveConcurrencyLimiter(
+                    settings.embedding_initial_concurrency,
+                    settings.embedding_min_concurrency,
+                    settings.embedding_max_concurrency,
+                    settings.upstream_backoff_factor
+                ),
+                settings.embedding_max_queue,
+                settings.embedding_max_wait
+            ),
+            Lane.GENERATION: UpstreamLane(
+                Lane.GENERATION.value,
+                AdaptiveConcurrencyLimiter(
+                    settings.generation_initial_concurrency,
+                    settings.generation_min_concurrency,
+                    settings.generation_max_concurrency,
+                    settings.upstream_backoff_factor
+                ),
+                settings.generation_max_queue,
+                settings.generation_max_wait
+            ),
+        }
+
+    def has_spare_capacity(self, lane: Lane) -> bool:
+        """通道是否有空闲并发且无人排队（对冲请求只在空闲时发出）"""
+        upstream_lane = self.lanes[lane]
+        return upstream_lane.queued == 0 and upstream_lane.in_flight < upstream_lane.limiter.limit
+
+    def ensure_capacity(self, lane: Lane):
+        """
+        准入检查：通道已饱和时直接拒绝
+        用于流式接口在返回响应头之前提前失败
+        """
+        upstream_lane = self.lanes[lane]
+        if not upstream_lane.has_capacity():
+            upstream_lane._reject("队列已满")
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        lane: Lane,
+        priority: Optional[RequestPriority] = None
+    ) -> AsyncIterator[None]:
+        """
+        在调度器控制下执行一次上游调用
+
+        Args:
+            lane: 调用通道
+            priority: 优先级，默认取当前请求上下文的优先级
+
+        Raises:
+            UpstreamOverloadedError: 排队超时、队列已满或上游返回429
+        """
+        upstream_lane = self.lanes[lane]
+        if priority is None:
+            priority = current_priority.get()
+
+        await upstream_lane.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limited(e):
+                upstream_lane.limiter.on_overload()
+                raise UpstreamOverloadedError(
+                    f"上游{upstream_lane.name}通道限流，请稍后重试",
+                    retry_after=upstream_lane.retry_after()
+                ) from e
+            raise
+        else:
+            upstream_lane.limiter.on_success()
+        finally:
+            upstream_lane.record_latency(time.monotonic() - start)
+            upstream_lane.release()
+
+    def stats(self) -> dict:
+        """各通道运行状态"""
+        return {lane.value: upstream_lane.stats() for lane, upstream_lane in self.lanes.items()}
+
+
+# 创建全局实例
+upstream_scheduler = UpstreamScheduler()
@@ -0,0 +1,157 @@
+"""
+流式分句模块
+将大模型输出的零散片段整理为完整的句子或分句再下发，数字人收到第一句即可开始播报
+"""
+import asyncio
+import time
+from typing import AsyncIterator, List
+
+# 句末标点（连续出现时合并，如"……"、"？！"）
+SENTENCE_ENDINGS = set('。！？!?；;…\n')
+# 分句标点：缓冲过长或等待超时时优先在这里切分
+CLAUSE_BREAKS = set('，,、：:')
+# 紧跟在句末标点后的闭合符号，归入前一句
+CLOSING_MARKS = set('”’」』）)】》')
+# 不能单独成段的字符：只含这些字符的片段对数字人播报没有意义
+_PUNCTUATION = SENTENCE_ENDINGS | CLAUSE_BREAKS | CLOSING_MARKS | set(' \t\r')
+
+
+class SentenceSegmenter:
+    """按中文标点切分流式文本"""
+
+    def __init__(self, max_chars: int = 60):
+        """
+        Args:
+            max_chars: 缓冲超过该长度仍没有句末标点时，在最后一个分句标点处（没有则直接）切分
+        """
+        self.max_chars = max(1, max_chars)
+        self._buffer = ''
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._buffer)
+
+    def feed(self, chunk: str) -> List[str]:
+        """加入一段文本，返回已完整的句子"""
+        self._buffer += chunk
+        segments = []
+        while True:
+            end = self._sentence_end()
+            if end == 0:
+                text_start = self._text_start()
+                if len(self._buffer) <= self.max_chars or text_start == len(self._buffer):
+                    break
+                end = self._clause_end(self.max_chars + 1) or max(self.max_chars, text_start + 1)
+            segments.append(self._buffer[:end])
+            self._buffer = self._buffer[end:]
+        return segments
+
+    def flush_clause(self) -> str:
+        """
+        等待超时：切出到最后一个分句标点为止的内容，没有分句标点时全部切出；
+        缓冲中只有标点时不切出，留给后面的文字
+        """
+        if self._text_start() == len(self._buffer):
+            return ''
+        end = self._clause_end(len(self._buffer)) or len(self._buffer)
+        segment, self._buffer = self._buffer[:end], self._buffer[end:]
+        return segment
+
+    def flush(self) -> str:
+        """文本结束，返回剩余内容（只剩标点时丢弃，不下发只有标点的片段）"""
+        segment, self._buffer = self._buffer, ''
+        return segment if self._has_text(segment) else ''
+
+    @staticmethod
+    def _has_text(segment: str) -> bool:
+        return any(char not in _PUNCTUATION for char in segment)
+
+    def _text_start(self) -> int:
+        """缓冲中第一个非标点字符的位置（上一段之后紧跟的标点不能单独成段，切分点只能在它之后）"""
+        for index, char in enumerate(self._buffer):
+            if char not in _PUNCTUATION:
+                return index
+        return len(self._buffer)
+
+    def _sentence_end(self) -> int:
+        """第一个完整句子的结束位置（不含时返回0）"""
+        buffer = self._buffer
+        start = self._text_start()
+        for index in range(start, len(buffer)):
+            if buffer[index] not in SENTENCE_ENDINGS:
+                continue
+            end = index + 1
+            while end < len(buffer) and (buffer[end] in SENTENCE_ENDINGS or buffer[end] in CLOSING_MARKS):
+                end += 1
+            # 标点位于缓冲末尾时后面可能还有同一组标点，等下一段再决定
+            if end == len(buffer) and buffer[-1] != '\n':
+                return 0
+            return end
+        return 0
+
+    def _clause_end(self, limit: int) -> int:
+        """limit 之内、第一个非标点字符之后的最后一个分句标点之后的位置（没有时返回0）"""
+        for index in range(min(limit, len(self._buffer)) - 1, self._text_start(), -1):
+            if self._buffer[index] in CLAUSE_BREAKS:
+                return index + 1
+        return 0
+
+
+async def segment_stream(
+    source: AsyncIterator[str],
+    max_latency: float,
+    max_chars: int = 60
+) -> AsyncIterator[str]:
+    """
+    将文本片段流整理为句子流
+
+    Args:
+        source: 原始文本片段流
+        max_latency: 缓冲中最早的文字等待超过该时间（秒）时，不等句末标点直接下发
+        max_chars: 单个片段的最大长度
+
+    Yields:
+        句子或分句
+    """
+    segmenter = SentenceSegmenter(max_chars)
+    iterator = source.__aiter__()
+    pending = None
+    buffered_since = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if buffered_since is not None:
+                timeout = max(0.0, buffered_since + max_latency - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                # 等待超时：先下发已有内容，上游片段继续等待
+                segment = segmenter.flush_clause()
+                buffered_since = time.monotonic() if segmenter.pending else None
+                if segment:
+                    yield segment
+                continue
+
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            segments = segmenter.feed(chunk)
+            for segment in segments:
+                yield segment
+            if not segmenter.pending:
+                buffered_since = None
+            elif buffered_since is None or segments:
+                buffered_since = time.monotonic()
+
+        rest = segmenter.flush()
+        if rest:
+            yield rest
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,173 @@
+"""
+知识向量索引模块
+将知识库向量组织为归一化矩阵，一次矩阵乘法完成一批查询的相似度计算
+启用量化或前缀截断时分两阶段：先在压缩编码/截断前缀上粗排，候选再用完整原始向量精确重排
+"""
+import logging
+import numpy as np
+from typing import Dict, List, Tuple
+
+from app.services.vector_quantization import create_quantizer
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """按行L2归一化，零向量保持为零（相似度为0，而不是NaN）"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    每行取分数最高的k个
+
+    Returns:
+        (列下标, 分数)，形状均为 q × k，按分数从高到低排列
+    """
+    n = scores.shape[1]
+    k = min(k, n)
+    if k < n:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(n), (len(scores), 1))
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class KnowledgeVectorIndex:
+    """知识向量索引"""
+
+    def __init__(
+        self,
+        items: List[Dict],
+        vectors,
+        normalized: bool = False,
+        quantization: str = "none",
+        rescore_candidates: int = 50,
+        pq_subspaces: int = 64,
+        prefix_dims: int = 0
+    ):
+        """
+        Args:
+            items: 知识条目，与向量一一对应
+            vectors: 知识向量（n × d）
+            normalized: 向量是否已归一化（如快照中的内存映射矩阵，直接使用不再复制）
+            quantization: 量化方式（none/float16/int8/pq）
+            rescore_candidates: 两阶段检索时精确重排的候选数
+            pq_subspaces: 乘积量化的子空间数
+            prefix_dims: 粗排只使用向量前若干维（重新归一化，适用于Matryoshka训练的向量），0表示使用全部维度
+        """
+        self.items = items
+        self.rescore_candidates = rescore_candidates
+        self.quantizer = create_quantizer(quantization, pq_subspaces)
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        dim = matrix.shape[1] if matrix.ndim == 2 else 0
+        self.prefix_dims = prefix_dims if 0 < prefix_dims < dim else 0
+
+        # 知识条数不超过重排候选数时粗排没有意义，直接使用完整矩阵
+        if (self.quantizer is None and not self.prefix_dims) or len(matrix) <= rescore_candidates:
+            self.matrix = matrix if normalized else normalize_rows(matrix)
+            return
+
+        # 两阶段模式：索引只常驻粗排用的矩阵或编码；精确重排时从原始向量（快照映射或向量缓存）按行读取
+        self.matrix = None
+        self._exact = vectors
+        self._exact_normalized = normalized
+        if not normalized:
+            matrix = normalize_rows(matrix)
+        if self.prefix_dims:
+            matrix = normalize_rows(matrix[:, :self.prefix_dims])
+        self._stage_matrix = None
+
+        if self.quantizer is None:
+            self._stage_matrix = np.ascontiguousarray(matrix)
+        elif len(matrix):
+            self.quantizer.fit(matrix)
+            self.quantizer.encode(matrix)
+            logger.info(
+                f"向量索引量化完成（{self.quantizer.name}）：{len(matrix)}条，"
+                f"{matrix.nbytes / 1024 / 1024:.1f}MB -> {self.quantizer.nbytes() / 1024 / 1024:.1f}MB"
+            )
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def two_stage(self) -> bool:
+        """是否为两阶段模式（粗排 + 从原始向量精确重排）"""
+        return self.matrix is None
+
+    def replace_exact(self, vectors, normalized: bool = True):
+        """替换精确重排使用的原始向量来源（如改为磁盘映射矩阵，不再常驻内存）"""
+        self._exact = vectors
+        self._exact_normalized = normalized
+
+    def search(self, query_vectors, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量检索
+
+        Args:
+            query_vectors: 查询向量（q × d 或单个 d 维向量）
+            top_k: 每个查询返回的条数
+
+        Returns:
+            (indices, scores)，形状均为 q × k，按分数从高到低排列
+        """
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+
+        if self.matrix is not None:
+            # 余弦相似度：归一化后一次矩阵乘法得到 q × n 的分数矩阵
+            return top_k_rows(queries @ self.matrix.T, top_k)
+
+        candidates = max(top_k, self.rescore_candidates)
+        if candidates >= len(self.items):
+            return top_k_rows(queries @ self._exact_rows(np.arange(len(self.items))).T, top_k)
+
+        # 1. 截断前缀/压缩编码上粗排，每个查询取候选
+        candidate_indices, _ = top_k_rows(self._stage_scores(queries), candidates)
+
+        # 2. 候选（整批去重）用原始向量精确打分
+        unique, inverse = np.unique(candidate_indices, return_inverse=True)
+        exact = queries @ self._exact_rows(unique).T  # q × u
+        rows = np.arange(len(queries))[:, None]
+        candidate_scores = exact[rows, inverse.reshape(candidate_indices.shape)]
+
+        # 3. 候选中取前k
+        order, top_scores = top_k_rows(candidate_scores, top_k)
+        return np.take_along_axis(candidate_indices, order, axis=1), top_scores
+
+    def _stage_scores(self, queries: np.ndarray) -> np.ndarray:
+        """粗排分数（q × n）"""
+        if self.prefix_dims:
+            queries = normalize_rows(queries[:, :self.prefix_dims])
+        if self.quantizer is None:
+            return queries @ self._stage_matrix.T
+        return self.quantizer.scores(queries)
+
+    def _exact_rows(self, indices: np.ndarray) -> np.ndarray:
+        """按行读取归一化后的原始向量"""
+        if isinstance(self._exact, np.ndarray):
+            rows = np.asarray(self._exact[indices], dtype=np.float32)
+        else:
+            rows = np.asarray([self._exact[int(i)] for i in indices], dtype=np.float32)
+        return rows if self._exact_normalized else normalize_rows(rows)
+
+    def memory_bytes(self) -> int:
+        """索引自身常驻的向量内存（不含原始向量来源）"""
+        if self.matrix is not None:
+            return self.matrix.nbytes
+        if self.quantizer is None:
+            return self._stage_matrix.nbytes
+        return self.quantizer.nbytes() if len(self.items) else 0
+
+    def matches(self, indices, scores) -> List[Dict]:
+        """将一行检索结果转换为带分数的知识条目"""
+        return [
+            {**self.items[int(index)], 'score': float(score)}
+            for index, score in zip(indices, scores)
+        ]
@@ -0,0 +1,181 @@
+"""
+向量量化模块
+知识向量以压缩编码保存，在压缩编码上做近似打分筛选候选，再用原始向量精确重排
+
+支持的量化方式：
+- float16：每维2字节（压缩2倍，精度损失可忽略）
+- int8：按维度对称标量量化，每维1字节（压缩4倍）
+- pq：乘积量化，每个子空间1字节（4096维、64个子空间时压缩256倍）
+"""
+import logging
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 近似打分时每次处理的行数，控制临时float32矩阵的大小
+SCAN_BLOCK_ROWS = 256
+
+
+class Float16Quantizer:
+    """半精度存储"""
+
+    name = "float16"
+
+    def fit(self, matrix: np.ndarray):
+        return self
+
+    def encode(self, matrix: np.ndarray):
+        self.codes = matrix.astype(np.float16)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """近似相似度（q × n）"""
+        return _block_scan(queries, self.codes)
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+
+class Int8Quantizer:
+    """按维度对称的int8标量量化"""
+
+    name = "int8"
+
+    def fit(self, matrix: np.ndarray):
+        max_abs = np.abs(matrix).max(axis=0)
+        max_abs[max_abs == 0] = 1.0
+        self.scale = (max_abs / 127.0).astype(np.float32)
+        return self
+
+    def encode(self, matrix: np.ndarray):
+        self.codes = np.clip(np.rint(matrix / self.scale), -127, 127).astype(np.int8)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """近似相似度（q × n）：缩放系数并入查询向量，编码只做类型转换"""
+        return _block_scan(queries * self.scale, self.codes)
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes
+
+
+class ProductQuantizer:
+    """
+    乘积量化
+    向量切分为若干子空间，每个子空间用k-means码本的编号（1字节）表示；
+    查询时先算查询子向量与各码字的内积表，再查表累加
+    """
+
+    name = "pq"
+
+    def __init__(
+        self,
+        subspaces: int = 64,
+        centroids: int = 256,
+        iterations: int = 10,
+        max_train: int = 10000,
+        seed: int = 0
+    ):
+        self.subspaces = subspaces
+        self.centroids = centroids
+        self.iterations = iterations
+        self.max_train = max_train
+        self.seed = seed
+        self.codebooks: Optional[np.ndarray] = None  # m × k × (d/m)
+
+    def fit(self, matrix: np.ndarray):
+        n, dim = matrix.shape
+        # 子空间数必须整除维度
+        m = max(1, min(self.subspaces, dim))
+        while dim % m:
+            m -= 1
+        self.subspaces = m
+        k = max(1, min(self.centroids, n))
+
+        rng = np.random.default_rng(self.seed)
+        train = matrix
+        if n > self.max_train:
+            train = matrix[np.sort(rng.choice(n, self.max_train, replace=False))]
+        sub_dim = dim // m
+        self.codebooks = np.stack([
+            _kmeans(np.ascontiguousarray(train[:, s * sub_dim:(s + 1) * sub_dim]), k, self.iterations, rng)
+            for s in range(m)
+        ])
+        return self
+
+    def encode(self, matrix: np.ndarray):
+        n = matrix.shape[0]
+        m, _, sub_dim = self.codebooks.shape
+        self.codes = np.empty((n, m), dtype=np.uint8)
+        for s in range(m):
+            self.codes[:, s] = _assign(matrix[:, s * sub_dim:(s + 1) * sub_dim], self.codebooks[s])
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """近似相似度（q × n）"""
+        m, _, sub_dim = self.codebooks.shape
+        scores = np.zeros((len(queries), len(self.codes)), dtype=np.float32)
+        for s in range(m):
+            table = queries[:, s * sub_dim:(s + 1) * sub_dim] @ self.codebooks[s].T  # q × k
+            scores += table[:, self.codes[:, s]]
+        return scores
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.codebooks.nbytes
+
+
+def create_quantizer(method: str, pq_subspaces: int = 64):
+    """
+    按名称创建量化器
+
+    Returns:
+        量化器，method 为 none 时返回 None
+
+    Raises:
+        ValueError: 不支持的量化方式
+    """
+    method = (method or "none").strip().lower()
+    if method == "none":
+        return None
+    if method == "float16":
+        return Float16Quantizer()
+    if method == "int8":
+        return Int8Quantizer()
+    if method == "pq":
+        return ProductQuantizer(subspaces=pq_subspaces)
+    raise ValueError(f"不支持的向量量化方式: {method}")
+
+
+def _block_scan(queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """分块将编码转换为float32后与查询相乘"""
+    scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), SCAN_BLOCK_ROWS):
+        block = codes[start:start + SCAN_BLOCK_ROWS].astype(np.float32)
+        scores[:, start:start + len(block)] = queries @ block.T
+    return scores
+
+
+def _assign(vectors: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+    """每个向量分配到最近的码字（欧氏距离）"""
+    distances = (
+        (vectors ** 2).sum(axis=1, keepdims=True)
+        - 2 * vectors @ codebook.T
+        + (codebook ** 2).sum(axis=1)
+    )
+    return distances.argmin(axis=1)
+
+
+def _kmeans(vectors: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    """简单的k-means（Lloyd算法），空簇用随机样本重新初始化"""
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        # 用one-hot矩阵乘法一次求出各簇向量和，避免逐簇循环
+        onehot = np.zeros((len(vectors), k), dtype=np.float32)
+        onehot[np.arange(len(vectors)), labels] = 1.0
+        counts = onehot.sum(axis=0)
+        sums = onehot.T @ vectors
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = vectors[rng.integers(len(vectors), size=int(empty.sum()))]
+    return centroids.astype(np.float32)
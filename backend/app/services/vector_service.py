@@ -2,15 +2,28 @@
 向量检索服务模块
 使用Qwen3-Embedding-8B向量化模型
 """
+import asyncio
+import os
+import tempfile
+import time
 import numpy as np
-from typing import List, Dict
-from openai import OpenAI
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
 import logging
 
 from app.config.credentials import credentials_config
+from app.config.settings import settings
+from app.services.vector_index import KnowledgeVectorIndex, normalize_rows
+from app.services.query_normalizer import normalize_query
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.fallback_retriever import TfidfFallbackRetriever
+from app.services.scheduler_service import upstream_scheduler, Lane, UpstreamOverloadedError
 
 logger = logging.getLogger(__name__)
 
+# Qwen3-Embedding-8B 向量维度
+EMBEDDING_DIM = 4096
+
 
 def cosine_similarity(vec1, vec2):
     """计算余弦相似度"""
@@ -19,6 +32,9 @@ def cosine_similarity(vec1, vec2):
     dot_product = np.dot(vec1, vec2)
     norm1 = np.linalg.norm(vec1)
     norm2 = np.linalg.norm(vec2)
+    # 向量获取失败时为零向量，相似度按0处理，避免NaN
+    if norm1 == 0 or norm2 == 0:
+        return 0.0
     return dot_product / (norm1 * norm2)
 
 
@@ -26,16 +42,49 @@ class MedicalVectorRetriever:
     """医疗向量检索服务"""
 
     def __init__(self):
-        """初始化向量检索服务"""
-        self.client = OpenAI(
-            base_url='https://api-inference.modelscope.cn/v1',
-            api_key=credentials_config.get_modelscope_api_key()
-        )
+        """初始化向量检索服务（OpenAI SDK客户端在首次调用时才创建）"""
+        self._client = None
         self.model = 'Qwen/Qwen3-Embedding-8B'
-        self.embedding_cache = {}  # 缓存已计算的向量
+        self.embedding_cache = {}  # 缓存已计算的向量，键为归一化后的文本
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # 向量化服务熔断器：失败或慢调用过多时直接改用本地兜底检索
+        self.breaker = CircuitBreaker(
+            'embedding',
+            slow_call_seconds=settings.embedding_slow_call_seconds,
+            open_seconds=settings.embedding_breaker_open_seconds
+        )
+        self.fallback = TfidfFallbackRetriever()
+        self._index: Optional[KnowledgeVectorIndex] = None  # 当前知识库的向量索引
+        # 进行中的建索引任务 (知识库, 任务)，并发的冷启动请求共用同一次建索引
+        self._index_build: Optional[Tuple[List[Dict], asyncio.Future]] = None
+        self.warming_up = False  # 后台预热进行中（期间请求不另起全量向量化，改用兜底检索）
+        self._bulk_slots: Optional[asyncio.Semaphore] = None
         logger.info("医疗向量检索服务初始化完成 (Qwen3-Embedding-8B)")
 
-    def get_embedding(self, text: str) -> List[float]:
+    @property
+    def client(self):
+        """异步客户端（延迟创建）"""
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(
+                base_url='https://api-inference.modelscope.cn/v1',
+                api_key=credentials_config.get_modelscope_api_key(),
+                timeout=settings.embedding_bulk_timeout,
+                # 限流和失败由调度器与熔断器处理，SDK不再自行重试
+                max_retries=0
+            )
+        return self._client
+
+    async def close(self):
+        """关闭上游客户端（主进程fork之前调用，工作进程各自重新建立连接）"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        # 信号量绑定创建它的事件循环，由工作进程重新创建
+        self._bulk_slots = None
+
+    async def get_embedding(self, text: str) -> np.ndarray:
         """
         获取文本的向量表示
 
@@ -43,29 +92,85 @@ class MedicalVectorRetriever:
             text: 输入文本
 
         Returns:
-            向量表示（4096维）
+            向量表示（4096维，获取失败时为零向量）
         """
-        # 检查缓存
-        if text in self.embedding_cache:
-            return self.embedding_cache[text]
+        embeddings = await self.get_embeddings([text])
+        return embeddings[0]
 
-        try:
-            response = self.client.embeddings.create(
-                model=self.model,
-                input=text,
-                encoding_format='float'
-            )
-            embedding = response.data[0].embedding
+    async def get_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        批量获取文本向量，未缓存的文本按批合并为一次上游调用
+
+        Args:
+            texts: 输入文本列表
+
+        Returns:
+            与输入顺序一致的向量列表（获取失败的为零向量）
+        """
+        keys = [normalize_query(text) for text in texts]
+        # 每个缓存键只向上游发送一次（取第一次出现的原文）
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in self.embedding_cache:
+                self.cache_hits += 1
+            elif key not in missing:
+                self.cache_misses += 1
+                missing[key] = text
+
+        pending = list(missing.items())
+        batch_size = max(1, settings.embedding_batch_size)
+        batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        if len(batches) == 1:
+            await self._embed_batch(batches[0])
+        elif batches:
+            # 批量向量化（预热、建索引、批量任务）限制同时发出的批数，低于通道并发上限，
+            # 不会占满上游通道的排队队列而被拒绝
+            await asyncio.gather(*[self._embed_bulk(batch) for batch in batches])
+
+        zero = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+        return [self.embedding_cache.get(key, zero) for key in keys]
+
+    async def _embed_bulk(self, pending: List[Tuple[str, str]]):
+        """在批量并发上限内计算一批向量"""
+        if self._bulk_slots is None:
+            self._bulk_slots = asyncio.Semaphore(max(1, settings.embedding_bulk_concurrency))
+        async with self._bulk_slots:
+            await self._embed_batch(pending)
+
+    async def _embed_batch(self, pending: List[Tuple[str, str]]):
+        """一次上游调用计算一批文本的向量并写入缓存（pending 为 [(缓存键, 原文)]）"""
+        if not self.breaker.allow():
+            # 熔断期间不调用上游，调用方改用兜底检索
+            return
 
-            # 缓存结果
-            self.embedding_cache[text] = embedding
-            return embedding
+        keys = [key for key, _ in pending]
+        texts = [text for _, text in pending]
+        # 单条查询在用户等待路径上，严格限制耗时；批量调用文本多、耗时长，单独限制
+        timeout = settings.embedding_timeout if len(texts) == 1 else settings.embedding_bulk_timeout
+        try:
+            async with upstream_scheduler.slot(Lane.EMBEDDING):
+                start = time.monotonic()
+                response = await asyncio.wait_for(
+                    self.client.embeddings.create(
+                        model=self.model,
+                        input=texts,
+                        encoding_format='float'
+                    ),
+                    timeout=timeout
+                )
+                latency = time.monotonic() - start
+            for item in response.data:
+                # 以float32数组保存，约为Python浮点数列表内存的八分之一
+                self.embedding_cache[keys[item.index]] = np.asarray(item.embedding, dtype=np.float32)
+            self.breaker.record_success(latency if len(texts) == 1 else 0.0)
 
+        except UpstreamOverloadedError:
+            raise
         except Exception as e:
-            logger.error(f"获取向量失败: {e}")
-            return [0.0] * 4096
+            self.breaker.record_failure()
+            logger.error(f"批量获取向量失败（{len(texts)}条）: {e!r}")
 
-    def query(
+    async def query(
         self,
         source_sentence: str,
         sentences_to_compare: List[str]
@@ -82,13 +187,13 @@ class MedicalVectorRetriever:
         """
         try:
             # 获取查询向量
-            query_embedding = self.get_embedding(source_sentence)
+            query_embedding = await self.get_embedding(source_sentence)
 
-            # 批量获取对比句子的向量
-            compare_embeddings = [
+            # 并发获取对比句子的向量（并发度由上游调度器控制）
+            compare_embeddings = await asyncio.gather(*[
                 self.get_embedding(sent)
                 for sent in sentences_to_compare
-            ]
+            ])
 
             # 计算余弦相似度
             scores = [
@@ -99,11 +204,129 @@ class MedicalVectorRetriever:
             logger.info(f"向量检索完成，查询: {source_sentence[:30]}...")
             return {"scores": scores}
 
+        except UpstreamOverloadedError:
+            raise
         except Exception as e:
             logger.error(f"向量检索失败: {e}")
             return {"scores": [0.0] * len(sentences_to_compare)}
 
-    def get_top_k_matches(
+    async def build_index(self, knowledge_base: List[Dict]) -> Optional[KnowledgeVectorIndex]:
+        """
+        获取知识库的向量索引，知识库未变化时复用
+        同一知识库同时只进行一次建索引，并发的调用方等待同一个任务、得到同一个索引
+
+        Args:
+            knowledge_base: 知识库列表
+
+        Returns:
+            向量索引（有知识向量获取失败时为None，调用方改用兜底检索，下次调用重试）
+        """
+        index = self._ready_index(knowledge_base)
+        if index is not None:
+            return index
+
+        if self._use_snapshot_vectors(knowledge_base):
+            return self._index
+
+        build = self._index_build
+        if build is None or build[0] is not knowledge_base:
+            task = asyncio.ensure_future(self._embed_index(knowledge_base))
+            build = self._index_build = (knowledge_base, task)
+        # 某个调用方被取消（如客户端断开）不影响其他调用方共用的建索引任务
+        return await asyncio.shield(build[1])
+
+    def _ready_index(self, knowledge_base: List[Dict]) -> Optional[KnowledgeVectorIndex]:
+        """已为该知识库建好的索引"""
+        index = self._index
+        if index is not None and index.items is knowledge_base and len(index) == len(knowledge_base):
+            return index
+        return None
+
+    async def _embed_index(self, knowledge_base: List[Dict]) -> Optional[KnowledgeVectorIndex]:
+        """向量化全部知识并建索引（由 build_index 保证同一知识库只运行一个）"""
+        try:
+            contents = [item['content'] for item in knowledge_base]
+            vectors = await self.get_embeddings(contents)
+            # 有知识向量获取失败时不缓存索引，下次请求重试
+            if not self.has_embeddings(contents):
+                return None
+            self._index = self._create_cached_index(knowledge_base, vectors)
+            return self._index
+        finally:
+            if self._index_build is not None and self._index_build[0] is knowledge_base:
+                self._index_build = None
+
+    def preload_index(self, knowledge_base: List[Dict]) -> bool:
+        """
+        同步构建向量索引，只使用快照向量或已缓存的向量、不调用上游（用于多进程部署在fork之前预加载）
+
+        Returns:
+            是否构建成功（有知识缺少向量时返回False，由预热补算）
+        """
+        if self._use_snapshot_vectors(knowledge_base):
+            return True
+
+        keys = [normalize_query(item['content']) for item in knowledge_base]
+        if not keys or any(key not in self.embedding_cache for key in keys):
+            return False
+        self._index = self._create_cached_index(knowledge_base, [self.embedding_cache[key] for key in keys])
+        return True
+
+    def _use_snapshot_vectors(self, knowledge_base: List[Dict]) -> bool:
+        """编译快照自带归一化向量时直接映射使用，无需逐条向量化"""
+        snapshot_vectors = getattr(knowledge_base, 'embeddings', None)
+        if snapshot_vectors is None or getattr(knowledge_base, 'model', None) != self.model:
+            return False
+        self._index = self._create_index(knowledge_base, snapshot_vectors, normalized=True)
+        return True
+
+    def _create_cached_index(self, knowledge_base: List[Dict], vectors) -> KnowledgeVectorIndex:
+        """
+        用向量缓存中的知识向量创建索引
+        两阶段模式下精确重排用的原始向量移到磁盘映射文件，缓存中的知识向量也改为指向该映射，
+        常驻内存只剩量化编码（否则缓存中的float32副本仍然全部常驻，量化反而增加内存）
+        """
+        index = self._create_index(knowledge_base, vectors)
+        if not index.two_stage or not len(knowledge_base):
+            return index
+
+        mapped = self._map_to_disk(normalize_rows(np.asarray(vectors, dtype=np.float32)))
+        index.replace_exact(mapped, normalized=True)
+        for item, row in zip(knowledge_base, mapped):
+            key = normalize_query(item['content'])
+            if key in self.embedding_cache:
+                self.embedding_cache[key] = row
+        return index
+
+    @staticmethod
+    def _map_to_disk(matrix: np.ndarray) -> np.ndarray:
+        """将矩阵写入匿名临时文件（位于索引目录，关闭后自动删除）并内存映射，由操作系统按需换入换出"""
+        directory = Path(settings.knowledge_index_path).parent
+        directory.mkdir(parents=True, exist_ok=True)
+        mapped = np.memmap(
+            tempfile.TemporaryFile(dir=directory, prefix='rescore-'),
+            dtype=np.float32,
+            mode='w+',
+            shape=matrix.shape
+        )
+        mapped[:] = matrix
+        mapped.flush()
+        return mapped
+
+    @staticmethod
+    def _create_index(knowledge_base: List[Dict], vectors, normalized: bool = False) -> KnowledgeVectorIndex:
+        """按配置的量化方式和粗排维度创建索引"""
+        return KnowledgeVectorIndex(
+            knowledge_base,
+            vectors,
+            normalized=normalized,
+            quantization=settings.vector_quantization,
+            rescore_candidates=settings.vector_rescore_candidates,
+            pq_subspaces=settings.vector_pq_subspaces,
+            prefix_dims=settings.vector_prefix_dims
+        )
+
+    async def get_top_k_matches(
         self,
         query: str,
         knowledge_base: List[Dict],
@@ -123,24 +346,174 @@ class MedicalVectorRetriever:
         if not knowledge_base:
             return []
 
-        # 提取知识内容
-        sentences = [item['content'] for item in knowledge_base]
+        matches = await self.get_top_k_matches_batch([query], knowledge_base, top_k)
+        return matches[0]
 
-        # 执行向量查询
-        result = self.query(query, sentences)
+    async def get_top_k_matches_batch(
+        self,
+        queries: List[str],
+        knowledge_base: List[Dict],
+        top_k: int = 3
+    ) -> List[List[Dict]]:
+        """
+        批量检索：所有查询一次批量向量化，与知识矩阵做一次矩阵乘法
+
+        Args:
+            queries: 用户查询列表
+            knowledge_base: 知识库列表
+            top_k: 每个查询返回前K个结果
+
+        Returns:
+            与查询顺序一致的匹配知识列表
+        """
+        if not knowledge_base or not queries:
+            return [[] for _ in queries]
+
+        try:
+            if self.warming_up and self._ready_index(knowledge_base) is None:
+                return self._fallback_matches(queries, knowledge_base, top_k, "知识向量预热中")
+            index = await self.build_index(knowledge_base)
+            # 知识向量不完整时整体改用兜底检索；查询向量缺失的单条查询改用兜底检索
+            if index is None:
+                return self._fallback_matches(queries, knowledge_base, top_k, "知识向量不完整")
+            query_vectors = await self.get_embeddings(queries)
+
+            indices, scores = index.search(query_vectors, top_k)
+            results = []
+            for query, row_indices, row_scores in zip(queries, indices, scores):
+                if normalize_query(query) in self.embedding_cache:
+                    results.append(index.matches(row_indices, row_scores))
+                else:
+                    results.append(self.fallback.get_top_k_matches(query, knowledge_base, top_k))
+
+            logger.info(f"向量检索完成，查询{len(queries)}条: {queries[0][:30]}...")
+            return results
 
-        # 获取相似度分数
-        scores = result.get('scores', [0.0] * len(sentences))
+        except UpstreamOverloadedError:
+            raise
+        except Exception as e:
+            logger.error(f"向量检索失败: {e}")
+            return self._fallback_matches(queries, knowledge_base, top_k, "向量检索出错")
+
+    def _fallback_matches(
+        self,
+        queries: List[str],
+        knowledge_base: List[Dict],
+        top_k: int,
+        reason: str
+    ) -> List[List[Dict]]:
+        """向量检索不可用时使用本地TF-IDF检索"""
+        logger.warning(f"{reason}（熔断器: {self.breaker.state}），使用本地兜底检索")
+        return [self.fallback.get_top_k_matches(query, knowledge_base, top_k) for query in queries]
+
+    def embedded_count(self, knowledge_base: List[Dict]) -> int:
+        """知识库中已有向量的条目数"""
+        if getattr(knowledge_base, 'embeddings', None) is not None:
+            return len(knowledge_base)
+        return sum(1 for item in knowledge_base if normalize_query(item['content']) in self.embedding_cache)
+
+    def has_embeddings(self, texts: List[str]) -> bool:
+        """文本是否都已有缓存向量"""
+        return all(normalize_query(text) in self.embedding_cache for text in texts)
+
+    def cache_stats(self) -> Dict:
+        """向量缓存命中统计"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'size': len(self.embedding_cache),
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': round(self.cache_hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def memory_stats(self) -> Dict:
+        """向量缓存和索引占用的内存（字节）"""
+        # 映射到磁盘文件的向量不计入常驻内存
+        cache_bytes = sum(
+            vector.nbytes for vector in self.embedding_cache.values() if not isinstance(vector, np.memmap)
+        )
+        return {
+            'embedding_cache_bytes': cache_bytes,
+            'index_bytes': self._index.memory_bytes() if self._index is not None else 0,
+        }
+
+    async def warm_up(self, knowledge_base: List[Dict]) -> int:
+        """
+        预计算知识库向量并构建索引
 
-        # 组合结果
-        scored_items = [
-            {**item, 'score': score}
-            for item, score in zip(knowledge_base, scores)
-        ]
+        Args:
+            knowledge_base: 知识库列表
+
+        Returns:
+            新计算的向量数量
+        """
+        before = len(self.embedding_cache)
+        self.warming_up = True
+        try:
+            await self.build_index(knowledge_base)
+        finally:
+            self.warming_up = False
+        computed = len(self.embedding_cache) - before
+        logger.info(f"向量预热完成：新计算{computed}条，知识库共{len(knowledge_base)}条")
+        return computed
+
+    def save_index(self, path: Path) -> int:
+        """
+        将向量缓存持久化到磁盘
+
+        Args:
+            path: 索引文件路径（.npz）
+
+        Returns:
+            写入的向量数量
+        """
+        if not self.embedding_cache:
+            return 0
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        texts = list(self.embedding_cache.keys())
+        vectors = np.asarray([self.embedding_cache[text] for text in texts], dtype=np.float32)
+        # 先写临时文件再替换，避免进程中断留下损坏的索引（多个工作进程同时保存时各用各的临时文件）
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, texts=np.asarray(texts), vectors=vectors, model=np.asarray(self.model))
+        tmp_path.replace(path)
+        logger.info(f"向量索引已保存: {path}，共{len(texts)}条")
+        return len(texts)
+
+    def load_index(self, path: Path) -> int:
+        """
+        从磁盘加载持久化的向量缓存
+
+        Args:
+            path: 索引文件路径（.npz）
+
+        Returns:
+            加载的向量数量
+        """
+        path = Path(path)
+        if not path.exists():
+            logger.info(f"向量索引文件不存在，跳过加载: {path}")
+            return 0
+
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['model']) != self.model:
+                    logger.warning(f"向量索引模型不匹配（{data['model']}），跳过加载")
+                    return 0
+                texts = data['texts'].tolist()
+                vectors = data['vectors']
+        except Exception as e:
+            logger.error(f"加载向量索引失败: {e}")
+            return 0
 
-        # 按分数排序并返回前K个
-        scored_items.sort(key=lambda x: x['score'], reverse=True)
-        return scored_items[:top_k]
+        # 旧版本索引以原文为键，加载时统一转换为归一化键；
+        # 每行单独复制，知识向量改为磁盘映射后整个加载矩阵可以释放，而不是被其余行的视图一直引用
+        for text, vector in zip(texts, vectors):
+            self.embedding_cache.setdefault(normalize_query(text), vector.copy())
+        logger.info(f"向量索引加载完成: {path}，共{len(texts)}条")
+        return len(texts)
 
 
 # 创建全局实例
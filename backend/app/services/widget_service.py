@@ -0,0 +1,79 @@
+"""
+Widget指令提取模块
+在回复文本流经时增量识别 [卡片]/[展示] 标记，生成引用回复文本位置的widget事件（不复制文本）
+"""
+from typing import Dict, List, Optional
+
+# 标记 -> widget类型
+WIDGET_MARKERS = {
+    '[卡片]': 'widget_pic',
+    '[展示]': 'widget_pic',
+}
+WIDGET_TITLE = '健康建议'
+
+_MAX_MARKER_LEN = max(len(marker) for marker in WIDGET_MARKERS)
+
+
+class WidgetExtractor:
+    """
+    增量widget提取器
+    每收到一段文本调用一次 feed()，跨片段的标记也能识别；
+    widget的 text_ref 以字符（Unicode码点）偏移引用回复文本，
+    start 为标记之后的位置，end 为下一个标记或文本结尾（finish() 后补全）
+    """
+
+    def __init__(self):
+        self.widgets: List[Dict] = []
+        self._length = 0  # 已处理的文本长度
+        self._tail = ''  # 上一段末尾可能是标记前缀的部分
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """
+        处理一段新文本
+
+        Returns:
+            本段新识别出的widget事件
+        """
+        window_start = self._length - len(self._tail)
+        window = self._tail + chunk
+
+        found = []
+        for marker, widget_type in WIDGET_MARKERS.items():
+            index = window.find(marker)
+            while index != -1:
+                found.append((window_start + index, marker, widget_type))
+                index = window.find(marker, index + len(marker))
+        found.sort()
+
+        events = []
+        for position, marker, widget_type in found:
+            widget = {
+                'type': widget_type,
+                'marker': marker,
+                'title': WIDGET_TITLE,
+                'text_ref': {'start': position + len(marker), 'end': None}
+            }
+            self.widgets.append(widget)
+            events.append(widget)
+
+        self._length += len(chunk)
+        # 保留不足一个完整标记的尾部，完整标记不会在下一段被重复识别
+        self._tail = window[-(_MAX_MARKER_LEN - 1):] if _MAX_MARKER_LEN > 1 else ''
+        return events
+
+    def finish(self) -> List[Dict]:
+        """文本结束，补全每个widget引用范围的结尾"""
+        for widget, following in zip(self.widgets, self.widgets[1:] + [None]):
+            if following is None:
+                widget['text_ref']['end'] = self._length
+            else:
+                widget['text_ref']['end'] = following['text_ref']['start'] - len(following['marker'])
+        return self.widgets
+
+
+def extract_widget(response: str) -> Optional[Dict]:
+    """从完整回复中提取第一个widget（非流式接口使用）"""
+    extractor = WidgetExtractor()
+    extractor.feed(response)
+    widgets = extractor.finish()
+    return widgets[0] if widgets else None
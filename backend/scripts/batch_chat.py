@@ -0,0 +1,71 @@
+"""
+批量对话命令行工具
+
+用法（在 backend 目录下执行）：
+    python -m scripts.batch_chat questions.jsonl > answers.jsonl
+    cat questions.jsonl | python -m scripts.batch_chat > answers.jsonl
+
+输入每行 {"id": ..., "message": ...}，输出每行一个回答（按完成顺序）
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from app.config.settings import settings
+from app.services.batch_service import BatchChatProcessor, parse_jsonl_questions, BatchInputError
+from app.services.knowledge_base_service import knowledge_service
+from app.services.vector_service import vector_retriever
+
+
+async def run(input_text: str, concurrency: int) -> int:
+    questions = parse_jsonl_questions(input_text)
+    knowledge = knowledge_service.load()
+    vector_retriever.load_index(settings.knowledge_index_path)
+    # 向量化服务不可用时的兜底检索
+    vector_retriever.fallback.fit(knowledge)
+
+    processor = BatchChatProcessor(concurrency)
+    failed = 0
+    async for result in processor.process(questions, knowledge):
+        failed += 'error' in result
+        sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+    # 保存本次新计算的向量，下次运行直接复用
+    vector_retriever.save_index(settings.knowledge_index_path)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量回答JSONL中的健康咨询问题")
+    parser.add_argument('input', nargs='?', help="JSONL问题文件，缺省时从标准输入读取")
+    parser.add_argument(
+        '--concurrency', type=int, default=settings.batch_generation_concurrency,
+        help="生成阶段并发数"
+    )
+    args = parser.parse_args()
+
+    # 日志输出到标准错误，标准输出只写结果
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+
+    if args.input:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            input_text = f.read()
+    else:
+        input_text = sys.stdin.read()
+
+    try:
+        failed = asyncio.run(run(input_text, args.concurrency))
+    except BatchInputError as e:
+        sys.exit(f"输入格式错误: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
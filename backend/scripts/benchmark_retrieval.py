@@ -0,0 +1,148 @@
+"""
+向量检索基准测试工具
+对比不同粗排配置（前缀截断维度、量化方式）相对精确检索的召回率、检索耗时和索引内存
+
+用法（在 backend 目录下执行）：
+    python -m scripts.benchmark_retrieval                          # 使用持久化的向量缓存
+    python -m scripts.benchmark_retrieval --prefix 256 512 1024 --quantization none int8
+    python -m scripts.benchmark_retrieval --synthetic 20000        # 没有向量缓存时使用合成数据
+
+知识向量取自向量缓存中的知识库条目；缓存中其余条目（历史用户查询）作为查询集，
+没有历史查询时用加噪声的知识向量代替
+"""
+import argparse
+import logging
+import sys
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from app.config.settings import settings
+from app.services.knowledge_base_service import knowledge_service
+from app.services.query_normalizer import normalize_query
+from app.services.vector_index import KnowledgeVectorIndex
+from app.services.vector_service import vector_retriever
+
+
+def load_vectors(max_queries: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """从向量缓存加载 (知识向量, 查询向量)"""
+    items = knowledge_service.load()
+    vector_retriever.load_index(settings.knowledge_index_path)
+    cache = vector_retriever.embedding_cache
+
+    keys = [normalize_query(item['content']) for item in items]
+    corpus = np.asarray([cache[key] for key in keys if key in cache], dtype=np.float32)
+    if len(corpus) == 0:
+        return corpus, corpus
+
+    known = set(keys)
+    queries = [vector for key, vector in cache.items() if key not in known]
+    rng = np.random.default_rng(seed)
+    if queries:
+        queries = np.asarray(queries, dtype=np.float32)
+    else:
+        logging.info("向量缓存中没有历史查询，使用加噪声的知识向量作为查询")
+        queries = perturb(corpus[rng.integers(len(corpus), size=max_queries)], rng)
+    if len(queries) > max_queries:
+        queries = queries[rng.choice(len(queries), max_queries, replace=False)]
+    return corpus, queries
+
+
+def synthetic_vectors(count: int, dim: int, max_queries: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """生成带聚类结构的合成向量"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 100), dim)).astype(np.float32)
+    corpus = centers[rng.integers(len(centers), size=count)]
+    corpus = corpus + 0.5 * rng.standard_normal(corpus.shape).astype(np.float32)
+    queries = perturb(corpus[rng.integers(count, size=max_queries)], rng)
+    return corpus, queries
+
+
+def perturb(vectors: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """给向量加上与其范数成比例的噪声"""
+    scale = np.linalg.norm(vectors, axis=1, keepdims=True) / np.sqrt(vectors.shape[1])
+    return (vectors + 0.3 * scale * rng.standard_normal(vectors.shape)).astype(np.float32)
+
+
+def timed_search(index: KnowledgeVectorIndex, queries: np.ndarray, top_k: int, repeat: int):
+    """返回 (检索结果下标, 每次查询平均耗时毫秒)"""
+    indices, _ = index.search(queries, top_k)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            index.search(query, top_k)
+    elapsed = (time.perf_counter() - start) / (repeat * len(queries))
+    return indices, elapsed * 1000
+
+
+def recall(expected: np.ndarray, actual: np.ndarray) -> float:
+    """actual 中命中精确检索前k的比例"""
+    hits = sum(len(set(e.tolist()) & set(a.tolist())) for e, a in zip(expected, actual))
+    return hits / expected.size
+
+
+def run(args) -> int:
+    if args.synthetic:
+        corpus, queries = synthetic_vectors(args.synthetic, args.dim, args.queries, args.seed)
+    else:
+        corpus, queries = load_vectors(args.queries, args.seed)
+    if len(corpus) == 0:
+        logging.error("向量缓存中没有知识向量，请先启动服务完成预热，或使用 --synthetic")
+        return 1
+
+    items = [{'id': i} for i in range(len(corpus))]
+    vectors: List[np.ndarray] = list(corpus)
+    print(f"知识向量 {len(corpus)} 条 × {corpus.shape[1]} 维，查询 {len(queries)} 条，top_k={args.top_k}，"
+          f"重排候选 {args.candidates}")
+
+    exact = KnowledgeVectorIndex(items, vectors)
+    expected, exact_ms = timed_search(exact, queries, args.top_k, args.repeat)
+    print(f"{'prefix':>8} {'quant':>8} {'recall@k':>9} {'ms/query':>9} {'index MB':>9} {'build s':>8}")
+    print(f"{'full':>8} {'none':>8} {1.0:>9.4f} {exact_ms:>9.3f} {exact.memory_bytes() / 2 ** 20:>9.2f} {'-':>8}")
+
+    for prefix in args.prefix:
+        for quantization in args.quantization:
+            if prefix == 0 and quantization == 'none':
+                continue
+            start = time.perf_counter()
+            index = KnowledgeVectorIndex(
+                items,
+                vectors,
+                quantization=quantization,
+                rescore_candidates=args.candidates,
+                pq_subspaces=settings.vector_pq_subspaces,
+                prefix_dims=prefix
+            )
+            build_seconds = time.perf_counter() - start
+            actual, ms = timed_search(index, queries, args.top_k, args.repeat)
+            print(f"{prefix or 'full':>8} {quantization:>8} {recall(expected, actual):>9.4f} {ms:>9.3f} "
+                  f"{index.memory_bytes() / 2 ** 20:>9.2f} {build_seconds:>8.2f}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="评估两阶段向量检索配置的召回率和耗时")
+    parser.add_argument('--prefix', type=int, nargs='+', default=[0, 256, 512, 1024],
+                        help="粗排前缀维度（0表示完整维度）")
+    parser.add_argument('--quantization', nargs='+', default=['none', 'int8'],
+                        help="量化方式（none/float16/int8/pq）")
+    parser.add_argument('--candidates', type=int, default=settings.vector_rescore_candidates,
+                        help="精确重排的候选数")
+    parser.add_argument('--top-k', type=int, default=3, help="每个查询返回的条数")
+    parser.add_argument('--queries', type=int, default=200, help="查询数上限")
+    parser.add_argument('--repeat', type=int, default=3, help="计时重复次数")
+    parser.add_argument('--synthetic', type=int, default=0, help="使用指定条数的合成向量")
+    parser.add_argument('--dim', type=int, default=4096, help="合成向量维度")
+    parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
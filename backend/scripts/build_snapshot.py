@@ -0,0 +1,66 @@
+"""
+知识库快照构建工具
+
+用法（在 backend 目录下执行）：
+    python -m scripts.build_snapshot                 # 包含向量（缺失的向量会调用上游计算）
+    python -m scripts.build_snapshot --no-embeddings # 只编译文本字段
+
+知识库JSON修改后需要重新执行，否则服务启动时会检测到快照过期并回退到解析JSON
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+import numpy as np
+
+from app.config.settings import settings
+from app.services.knowledge_base_service import knowledge_service
+from app.services.knowledge_snapshot import write_snapshot, source_signature
+from app.services.scheduler_service import current_priority, RequestPriority
+from app.services.vector_service import vector_retriever
+
+
+async def build(output, with_embeddings: bool) -> int:
+    items = knowledge_service.load_all_knowledge()
+    if not items:
+        logging.error("知识库为空，未生成快照")
+        return 1
+
+    embeddings = None
+    if with_embeddings:
+        current_priority.set(RequestPriority.BATCH)
+        vector_retriever.load_index(settings.knowledge_index_path)
+        contents = [item['content'] for item in items]
+        vectors = await vector_retriever.get_embeddings(contents)
+        if not vector_retriever.has_embeddings(contents):
+            logging.error("部分知识向量获取失败，快照不包含向量")
+        else:
+            embeddings = np.asarray(vectors, dtype=np.float32)
+            vector_retriever.save_index(settings.knowledge_index_path)
+
+    write_snapshot(
+        output,
+        items,
+        embeddings=embeddings,
+        model=vector_retriever.model if embeddings is not None else None,
+        sources=source_signature(list(knowledge_service.knowledge_files().values()))
+    )
+    return 0 if embeddings is not None or not with_embeddings else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将知识库JSON编译为可内存映射的快照文件")
+    parser.add_argument('--output', default=str(settings.knowledge_snapshot_path), help="快照输出路径")
+    parser.add_argument('--no-embeddings', action='store_true', help="不在快照中包含向量")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    sys.exit(asyncio.run(build(args.output, not args.no_embeddings)))
+
+
+if __name__ == "__main__":
+    main()
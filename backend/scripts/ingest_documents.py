@@ -0,0 +1,102 @@
+"""
+文档入库工具：将长篇健康指南（.txt/.md）切分、去重、向量化后写入知识库
+
+用法（在 backend 目录下执行）：
+    python -m scripts.ingest_documents docs/睡眠指南.md --category sub_health
+    python -m scripts.ingest_documents docs/*.md --category nutrition --dry-run   # 只查看切分结果
+    python -m scripts.ingest_documents guide.txt --category fitness --no-embed    # 只写入文本
+
+向量化按组进行，每组完成后保存向量缓存；中断后重新执行同一命令会跳过已完成的片段；
+向量化失败的片段不写入知识库，重新执行同一命令即可补齐。
+写入后需重新执行 python -m scripts.build_snapshot（或携带管理令牌调用 POST /api/knowledge/reload）才会在服务中生效
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+from app.config.settings import settings
+from app.services.ingestion_service import (
+    chunk_document, deduplicate, embed_chunks, extract_keywords, write_knowledge, ProgressReporter
+)
+from app.services.knowledge_base_service import knowledge_service
+from app.services.scheduler_service import current_priority, RequestPriority
+from app.services.vector_service import vector_retriever
+
+# 知识库目录对应的ID前缀（与现有知识条目一致）
+ID_PREFIXES = {
+    'nutrition': 'nutri',
+    'fitness': 'fit',
+    'sub_health': 'sub',
+    'general': 'gen',
+}
+
+
+async def ingest(args) -> int:
+    chunks = []
+    for path in args.files:
+        path = Path(path)
+        text = path.read_text(encoding='utf-8')
+        document_chunks = chunk_document(text, source=path.stem, max_chars=args.max_chars, overlap_chars=args.overlap)
+        logging.info(f"{path.name}: {len(text)}字，切分为{len(document_chunks)}个片段")
+        chunks.extend(document_chunks)
+
+    knowledge = knowledge_service.load_all_knowledge()
+    existing = [item['content'] for item in knowledge]
+    unique = deduplicate(chunks, existing)
+    logging.info(f"去除近似重复片段{len(chunks) - len(unique)}个，剩余{len(unique)}个")
+    if not unique:
+        return 0
+    extract_keywords(
+        unique,
+        corpus=existing,
+        vocabulary={keyword for item in knowledge for keyword in item.get('keywords', [])}
+    )
+
+    if args.dry_run:
+        for chunk in unique:
+            print(f"[{chunk.section or chunk.source}] {' '.join(chunk.keywords)}\n{chunk.content}\n")
+        return 0
+
+    failed = []
+    if not args.no_embed:
+        current_priority.set(RequestPriority.BATCH)
+        vector_retriever.load_index(settings.knowledge_index_path)
+        failed = await embed_chunks(
+            unique,
+            vector_retriever,
+            index_path=settings.knowledge_index_path,
+            progress=ProgressReporter("向量化进度")
+        )
+        if failed:
+            # 失败的片段暂不写入，重新执行时不会被去重跳过，可继续向量化
+            failed_chunks = set(failed)
+            unique = [chunk for chunk in unique if chunk not in failed_chunks]
+            logging.warning(f"{len(failed)}个片段向量化失败，暂不写入知识库，重新执行本命令可继续")
+
+    file_path = knowledge_service.knowledge_files()[args.category]
+    added = write_knowledge(file_path, unique, ID_PREFIXES[args.category])
+    logging.info(f"写入{file_path}: 新增{added}条")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="切分、去重并向量化长篇文档，写入知识库")
+    parser.add_argument('files', nargs='+', help="文档路径（.txt/.md，UTF-8编码）")
+    parser.add_argument('--category', required=True, choices=list(ID_PREFIXES), help="写入的知识库类别")
+    parser.add_argument('--max-chars', type=int, help="片段最大字符数（默认取 INGEST_CHUNK_CHARS）")
+    parser.add_argument('--overlap', type=int, help="相邻片段重叠字符数（默认取 INGEST_OVERLAP_CHARS）")
+    parser.add_argument('--dry-run', action='store_true', help="只输出切分结果，不向量化也不写入")
+    parser.add_argument('--no-embed', action='store_true', help="不预先计算向量")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    sys.exit(asyncio.run(ingest(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+生产部署启动工具：多进程预fork，充分利用多核
+
+用法（在 backend 目录下执行，Linux/macOS）：
+    python -m scripts.serve                       # 工作进程数取 WEB_CONCURRENCY，默认CPU核数
+    python -m scripts.serve --workers 4 --port 8000
+
+- 主进程在fork之前加载知识库、向量缓存并构建检索索引，工作进程以写时复制方式共享，不再各自加载
+- 安装了 uvloop / httptools 时使用它们作为事件循环和HTTP解析器
+- 收到 SIGTERM/SIGINT 时就绪检查改为503，停止接受新连接，进行中的请求（包括流式对话）
+  最多等待 SHUTDOWN_DRAIN_SECONDS 秒后退出；工作进程异常退出时自动重启
+- 任一工作进程收到 POST /api/knowledge/reload（或主进程收到 SIGHUP）时，主进程重新预加载知识库，
+  启动新的工作进程后让旧工作进程处理完进行中的请求再退出，所有进程的知识库版本保持一致
+
+不支持fork的平台（Windows）退化为单进程。开发时仍使用 uvicorn --reload
+"""
+import argparse
+import gc
+import importlib.util
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import uvicorn
+
+from app.config.logging_config import stop_logging
+from app.config.settings import settings
+from app.main import app
+from app.services.lifecycle_service import service_lifecycle
+
+logger = logging.getLogger("scripts.serve")
+
+# 工作进程异常退出后重启前的等待时间（秒），避免启动失败时反复重启占满CPU
+RESPAWN_DELAY = 1.0
+
+
+class DrainingServer(uvicorn.Server):
+    """收到停止信号时先把服务标记为停止中，再交给 uvicorn 等待进行中的请求完成"""
+
+    def handle_exit(self, sig, frame):
+        service_lifecycle.begin_drain()
+        super().handle_exit(sig, frame)
+
+
+class Supervisor:
+    """预fork主进程：持有监听socket，创建、监控并停止工作进程"""
+
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.socket = config.bind_socket()
+        self.children = set()
+        self.retiring = set()  # 重载后等待退出的旧工作进程
+        self.stopping = False
+        self.reloading = False
+
+    def run(self) -> int:
+        self._spawn_workers()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self._handle_exit)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        logger.info(f"主进程{os.getpid()}已启动{self.workers}个工作进程")
+
+        deadline = None
+        while self.children or self.retiring:
+            if self.reloading and not self.stopping:
+                self.reloading = False
+                self._reload()
+
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                if pid in self.retiring:
+                    self.retiring.discard(pid)
+                    continue
+                self.children.discard(pid)
+                if not self.stopping:
+                    logger.warning(f"工作进程{pid}异常退出（状态{status}），重新启动")
+                    time.sleep(RESPAWN_DELAY)
+                    self._spawn()
+                continue
+
+            if self.stopping:
+                if deadline is None:
+                    deadline = time.monotonic() + settings.shutdown_drain_seconds + 5
+                    self._signal_children(signal.SIGTERM)
+                elif time.monotonic() > deadline:
+                    logger.warning("工作进程未在限定时间内退出，强制结束")
+                    self._signal_children(signal.SIGKILL)
+            time.sleep(0.2)
+
+        self.socket.close()
+        logger.info("所有工作进程已退出")
+        return 0
+
+    def _handle_exit(self, sig, frame):
+        self.stopping = True
+
+    def _handle_reload(self, sig, frame):
+        self.reloading = True
+
+    def _reload(self):
+        """重新预加载知识库，启动新工作进程后让旧工作进程平滑退出"""
+        logger.info("主进程重新加载知识库")
+        try:
+            service_lifecycle.preload()
+        except Exception:
+            logger.exception("重新加载知识库失败，继续使用当前工作进程")
+            return
+        old = self.children
+        self.children = set()
+        self._spawn_workers()
+        self.retiring |= old
+        for pid in old:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.retiring.discard(pid)
+        logger.info(f"知识库重新加载完成，已替换{len(old)}个工作进程")
+
+    def _spawn_workers(self):
+        # 预加载的对象移入永久代，避免工作进程的垃圾回收改写这些对象所在的内存页
+        gc.collect()
+        gc.freeze()
+        for _ in range(self.workers):
+            self._spawn()
+
+    def _signal_children(self, sig):
+        for pid in list(self.children | self.retiring):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                self.children.discard(pid)
+                self.retiring.discard(pid)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        code = 1
+        try:
+            code = self._run_worker()
+        finally:
+            os._exit(code)
+
+    def _run_worker(self) -> int:
+        """工作进程：运行 uvicorn 直到收到停止信号，返回退出码"""
+        # 工作进程自成进程组，终端的Ctrl+C只发给主进程，由主进程统一转发一次
+        os.setpgid(0, 0)
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_IGN)
+
+        server = DrainingServer(self.config)
+        parent = os.getppid()
+        service_lifecycle.supervisor_pid = parent
+
+        def watch_parent():
+            # 主进程被强制结束时工作进程也随之停止
+            while os.getppid() == parent:
+                time.sleep(1.0)
+            server.handle_exit(signal.SIGTERM, None)
+
+        threading.Thread(target=watch_parent, name='parent-watch', daemon=True).start()
+        try:
+            server.run(sockets=[self.socket])
+            code = 0 if server.started else 3
+        except BaseException:
+            logger.exception("工作进程异常退出")
+            code = 1
+        stop_logging()
+        return code
+
+
+def _available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以多进程方式启动后端服务")
+    parser.add_argument('--host', default='0.0.0.0', help="监听地址")
+    parser.add_argument('--port', type=int, default=8000, help="监听端口")
+    parser.add_argument('--workers', type=int, default=settings.web_concurrency,
+                        help="工作进程数（0表示CPU核数）")
+    parser.add_argument('--no-access-log', action='store_true', help="不输出逐请求的访问日志")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not hasattr(os, 'fork'):
+        logger.warning("当前平台不支持fork，以单进程运行")
+        workers = 1
+
+    config = uvicorn.Config(
+        app,
+        host=args.host,
+        port=args.port,
+        loop='uvloop' if _available('uvloop') else 'asyncio',
+        http='httptools' if _available('httptools') else 'h11',
+        timeout_graceful_shutdown=settings.shutdown_drain_seconds,
+        access_log=not args.no_access_log,
+        log_config=None,  # 沿用应用的日志配置（JSON、异步写出）
+    )
+    logger.info(f"事件循环: {config.loop}，HTTP解析: {config.http}，工作进程: {workers}")
+
+    service_lifecycle.preload()
+    if workers == 1:
+        DrainingServer(config).run()
+        sys.exit(0)
+    sys.exit(Supervisor(config, workers).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+查询归一化测试：数值中的标点必须保留，不同数值不能共用同一个缓存键
+"""
+import pytest
+
+from app.services.query_normalizer import normalize_query
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('血糖6.1正常吗', '血糖6.1正常吗'),
+    ('1/2杯', '1/2杯'),
+    ('体温-5度', '体温-5度'),
+    ('12:30吃饭', '12:30吃饭'),
+    ('体脂率25%', '体脂率25%'),
+    ('血压140/90', '血压140/90'),
+    ('每周3-5次', '每周3-5次'),
+    ('１２．５％', '12.5%'),
+])
+def test_numeric_punctuation_is_kept(text, expected):
+    assert normalize_query(text, use_synonyms=False) == expected
+
+
+@pytest.mark.parametrize('first, second', [
+    ('血糖6.1正常吗', '血糖61正常吗'),
+    ('1/2杯', '12杯'),
+    ('体温-5度', '体温5度'),
+])
+def test_different_values_do_not_share_a_key(first, second):
+    assert normalize_query(first, use_synonyms=False) != normalize_query(second, use_synonyms=False)
+
+
+@pytest.mark.parametrize('text', ['失眠怎么办？', ' 失眠 怎么办 ', '失眠，怎么办!', '失眠怎麼辦'])
+def test_punctuation_and_whitespace_are_removed(text):
+    assert normalize_query(text, use_synonyms=False) == '失眠怎么办'
@@ -56,6 +56,13 @@ apiClient.interceptors.response.use(
  * 聊天服务类
  */
 class ChatService {
+  constructor() {
+    // 会话ID：后端据此保存多轮对话历史，页面刷新后开始新会话
+    this.sessionId = (window.crypto && window.crypto.randomUUID)
+      ? window.crypto.randomUUID()
+      : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+  }
+
   /**
    * 发送聊天消息
    * @param {string} message - 用户消息
@@ -65,7 +72,8 @@ class ChatService {
   async sendMessage(message, imageUrl = null) {
     try {
       const payload = {
-        message: message
+        message: message,
+        session_id: this.sessionId
       };
 
       if (imageUrl) {
@@ -116,7 +124,8 @@ class ChatService {
 
     try {
       const payload = {
-        message: message
+        message: message,
+        session_id: this.sessionId
       };
 
       if (imageUrl) {